@@ -34,8 +34,15 @@ __version__ = "2.0.1"  # Added Raspberry Pi compatibility improvements
 # Copyright (c) 2026 Gevin
 # All rights reserved.
 
+import ctypes
+import errno
+import fcntl
 import json
+import mmap
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 import shutil
+import struct
 import subprocess
 import sys
 import threading
@@ -44,11 +51,15 @@ import os
 import re
 import time
 import hashlib
+import hmac
+import http.client
 import urllib.request
 import urllib.parse
 import html
+import xml.etree.ElementTree as ET
 # Pillow splash support removed - no splash screen in this build
 import platform
+import queue
 
 LSBLK_CMD = ["lsblk", "-J", "-o", "NAME,KNAME,SIZE,MODEL,MOUNTPOINT,TYPE,RM"]
 
@@ -61,6 +72,169 @@ FS_CANDIDATES = {
     "btrfs": ["mkfs.btrfs"],
 }
 
+# Native image writer: default chunk size (matches the old dd bs=4M) and the
+# alignment O_DIRECT needs for buffer addresses, lengths and offsets
+WRITE_CHUNK_SIZE = 4 * 1024 * 1024
+DIRECT_IO_ALIGN = 4096
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Per-model write tuning: the chunk sizes and then outstanding-write counts probed on a
+# device (one axis at a time), bytes written per trial at the start of the device, and where
+# results live. At most 5 trials of 16 MiB: a few seconds even on USB 2.0
+CALIBRATION_CHUNK_SIZES = (1 << 20, 4 << 20, 8 << 20)
+CALIBRATION_QUEUE_DEPTHS = (1, 2, 4)
+CALIBRATION_BYTES = 16 * 1024 * 1024
+DEVICE_PROFILES = Path(__file__).with_name('device_profiles.json')
+
+# Resumable writes: journal of durably written extents, updated every JOURNAL_INTERVAL bytes
+WRITE_JOURNAL = Path(__file__).with_name('write_journal.json')
+JOURNAL_INTERVAL = 64 * 1024 * 1024
+
+# Digest cache: image digests and chunk manifests keyed by file identity, most recent entries kept
+DIGEST_CACHE = Path(__file__).with_name('digest_cache.json')
+DIGEST_CACHE_ENTRIES = 64
+
+# Hashing profile: the read-buffer sizes and chunk-manifest algorithms timed on this machine
+# the first time anything is hashed, the bytes or seconds per trial, and where the result lives
+HASH_BENCH_CHUNK_SIZES = (256 * 1024, 1 << 20, 4 << 20, 16 << 20)
+CHUNK_HASH_CANDIDATES = ('sha256', 'sha512', 'blake2b', 'blake2s')
+HASH_BENCH_BYTES = 32 * 1024 * 1024
+HASH_BENCH_SECONDS = 0.2
+HASH_PROFILE = Path(__file__).with_name('hash_profile.json')
+
+# Chunk manifests: a digest of every chunk of an image, stored beside it as <image>.chunks.json
+# and hashed by this many threads (hashlib releases the GIL while hashing large buffers)
+CHUNK_MANIFEST_SUFFIX = '.chunks.json'
+MANIFEST_WORKERS = os.cpu_count() or 4
+
+# Published checksums: hashlib algorithm by hex digest length (BLAKE2b, also 128 hex digits,
+# is told apart from SHA-512 by the checksum file name) and the pattern matching any of them
+DIGEST_HEX_LENGTHS = {32: 'md5', 40: 'sha1', 56: 'sha224', 64: 'sha256', 96: 'sha384', 128: 'sha512'}
+HEX_DIGEST_RE = re.compile(r"\b([a-fA-F0-9]{128}|[a-fA-F0-9]{96}|[a-fA-F0-9]{64}|[a-fA-F0-9]{56}"
+                           r"|[a-fA-F0-9]{40}|[a-fA-F0-9]{32})\b")
+
+# Online checksum lookup: one time budget for the whole search, candidate checksum files
+# fetched in parallel, the most read from any response, and the on-disk cache of results
+# (found digests and misses expire separately, so a miss is retried later)
+ONLINE_LOOKUP_DEADLINE = 15
+ONLINE_FETCH_WORKERS = 4
+ONLINE_MAX_BYTES = 1024 * 1024
+ONLINE_CACHE = Path(__file__).with_name('online_checksums.json')
+ONLINE_CACHE_TTL = 7 * 24 * 3600
+ONLINE_MISS_TTL = 6 * 3600
+
+# Checksum resolvers: (name, image file name pattern, default base URL, checksum file URL
+# templates tried in order). Templates are formatted with the pattern's named groups, each
+# also as _<group> ('_' + value, or '' if the group did not match), {name} (the file name) and
+# {base} (the default, or the catalog's mirror for the resolver). Microsoft publishes Windows
+# hashes only on its download pages, so Windows media have no template: import them instead.
+CHECKSUM_RESOLVERS = [
+    ('ubuntu', r'ubuntu-(?P<series>\d+\.\d+)(?:\.\d+)?-(?:desktop|live-server|server)-(?:amd64|arm64)\.iso',
+     'https://releases.ubuntu.com',
+     ('{base}/{series}/SHA256SUMS', 'https://old-releases.ubuntu.com/releases/{series}/SHA256SUMS')),
+    ('ubuntu-raspi', r'ubuntu-(?P<series>\d+\.\d+)(?:\.\d+)?-preinstalled-(?:server|desktop)-(?:arm64|armhf)'
+     r'\+raspi\.img\.xz', 'https://cdimage.ubuntu.com',
+     ('{base}/releases/{series}/release/SHA256SUMS',)),
+    ('debian', r'debian-(?P<version>\d+\.\d+\.\d+)-(?P<arch>amd64|arm64|armhf|i386|ppc64el|s390x)'
+     r'-(?:netinst|DVD-\d+|xfce-CD-\d+)\.iso', 'https://cdimage.debian.org',
+     ('{base}/debian-cd/{version}/{arch}/iso-cd/SHA256SUMS', '{base}/debian-cd/{version}/{arch}/iso-dvd/SHA256SUMS',
+      '{base}/cdimage/archive/{version}/{arch}/iso-cd/SHA256SUMS',
+      '{base}/cdimage/archive/{version}/{arch}/iso-dvd/SHA256SUMS')),
+    ('debian-live', r'debian-live-(?P<version>\d+\.\d+\.\d+)-(?P<arch>amd64|i386)-\w+\.iso',
+     'https://cdimage.debian.org',
+     ('{base}/debian-cd/{version}-live/{arch}/iso-hybrid/SHA256SUMS',
+      '{base}/cdimage/archive/{version}-live/{arch}/iso-hybrid/SHA256SUMS')),
+    ('fedora', r'Fedora-(?P<edition>Workstation|Server|Everything)-(?:Live|dvd|netinst)-(?P<arch>x86_64|aarch64)'
+     r'-(?P<version>\d+)-(?P<respin>[\d.]+)\.iso', 'https://download.fedoraproject.org',
+     ('{base}/pub/fedora/linux/releases/{version}/{edition}/{arch}/iso/'
+      'Fedora-{edition}-{version}-{respin}-{arch}-CHECKSUM',)),
+    ('fedora', r'Fedora-(?P<edition>Workstation|Server|Everything)-(?:Live|dvd|netinst)-(?P<version>\d+)'
+     r'-(?P<respin>[\d.]+)\.(?P<arch>x86_64|aarch64)\.iso', 'https://download.fedoraproject.org',
+     ('{base}/pub/fedora/linux/releases/{version}/{edition}/{arch}/iso/'
+      'Fedora-{edition}-{version}-{respin}-{arch}-CHECKSUM',)),
+    ('raspios', r'(?P<date>\d{4}-\d{2}-\d{2})-raspios-[a-z]+-(?P<arch>arm64|armhf)(?:-(?P<variant>lite|full))?'
+     r'\.img\.xz', 'https://downloads.raspberrypi.com',
+     ('{base}/raspios{_variant}_{arch}/images/raspios{_variant}_{arch}-{date}/{name}.sha256',)),
+    ('windows', r'(?i)win(?:dows)?[ _-]?(?:7|8\.1|10|11)[^/]*\.iso', None, ()),
+]
+
+# Local checksum files: the per-image suffixes (foo.iso.sha256, foo.iso.md5sum.txt, ...) and
+# the largest file parsed as one (checksum files are small; anything bigger is not one)
+CHECKSUM_FILE_SUFFIXES = tuple(f'.{alg}{ext}' for alg in ('sha256', 'sha512', 'sha1', 'md5', 'sha384', 'sha224', 'b2')
+                               for ext in ('', 'sum', '.txt', 'sum.txt'))
+CHECKSUM_FILE_MAX_BYTES = 16 * 1024 * 1024
+
+# Checksum catalog: published digests by image file name, filled from the checksum files the
+# resolvers fetch or imported offline (Library menu), so a lookup is a dictionary hit
+CHECKSUM_CATALOG = Path(__file__).with_name('checksum_catalog.json')
+
+# Compressed images: suffix -> (command-line decompressors tried in order, the
+# multi-threaded ones first, and the Python module used when none is installed)
+DECOMPRESSORS = {
+    '.xz': ([['xz', '-dc', '-T0']], 'lzma'),
+    '.gz': ([['pigz', '-dc'], ['gzip', '-dc']], 'gzip'),
+    '.zst': ([['zstd', '-dc']], 'zstandard'),
+    '.bz2': ([['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzip2', '-dc']], 'bz2'),
+}
+
+# Sparse writes: granularity of the all-zero scan (a multiple of DIRECT_IO_ALIGN)
+SPARSE_BLOCK_SIZE = 64 * 1024
+ZERO_BLOCK = bytes(SPARSE_BLOCK_SIZE)
+
+# Linux constants not exposed by the os/fcntl modules
+BLKDISCARD = 0x1277
+BLKFLSBUF = 0x1261
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+SYNC_FILE_RANGE_WAIT_BEFORE = 0x01
+SYNC_FILE_RANGE_WRITE = 0x02
+SYNC_FILE_RANGE_WAIT_AFTER = 0x04
+F_SETPIPE_SZ = 1031
+FICLONE = 0x40049409
+
+# Bounded writeback: buffered writes are flushed in windows of this size, so at most
+# about two windows of dirty page cache are outstanding per device
+WRITEBACK_WINDOW = 32 * 1024 * 1024
+
+# Block maps (bmaptool .bmap): block size used when generating a map for a raw image
+BMAP_BLOCK_SIZE = 4096
+
+# Read-back verification: concurrent readers striped across the written range
+VERIFY_READERS = 4
+
+# Fan-out (multi-device) writes: chunks kept in the shared ring, which bounds how far
+# a writer may lag the reader, and the total seconds a slow writer may hold the others
+# back before it is detached onto its own source reader
+FANOUT_RING_SLOTS = 16
+FANOUT_LAG_TIMEOUT = 10
+
+# External (sudo dd) writes: how often progress is sampled from kernel counters, in seconds
+PROGRESS_SAMPLE_INTERVAL = 0.5
+
+# Throughput telemetry: sampling period (seconds), EWMA smoothing factor, and seconds
+# without progress before a job is reported as stalled
+TELEMETRY_INTERVAL = 1.0
+TELEMETRY_EWMA_ALPHA = 0.3
+STALL_SECONDS = 10
+
+# Source prefetch: default distance (MiB) the image is read ahead of the writer, the read
+# size used for it, and tmpfs staging of whole images with the RAM that must stay free
+PREFETCH_AHEAD_MB = 64
+PREFETCH_STEP = 4 * 1024 * 1024
+STAGE_DIR = Path('/dev/shm/usb-formatter-stage')
+STAGE_RAM_RESERVE = 512 * 1024 * 1024
+
+# Page cache: consumed image pages are dropped every CACHE_RELEASE_STEP bytes unless the
+# image is kept hot, and the default memory budget (MiB) of one write job
+CACHE_RELEASE_STEP = 16 * 1024 * 1024
+MEMORY_BUDGET_MB = 256
+
+# Image library: content-addressed copies of flashed images, kept within a disk budget by
+# evicting the least recently used, and how many recent images the Write dialogs offer
+IMAGE_STORE = Path(__file__).with_name('image_store')
+IMAGE_STORE_BUDGET_GB = 32
+RECENT_IMAGES = 10
+
 # Dependency check and installer
 INSTALL_LOG = Path(__file__).with_name('dependency_install_log.txt')
 
@@ -272,6 +446,7 @@ def unmount_children(devname, log):
         collect(j.get("blockdevices", []))
         for name, mp in mounts:
             path = "/dev/"+name
+            sync_mount(mp, log)
             log(f"Unmounting {path} ({mp})...\n")
             subprocess.run(["sudo", "umount", path], check=False)
     except Exception as e:
@@ -311,6 +486,9 @@ def probe_partition_table(devpath, log=None):
         log("Waiting for kernel to reload partition table...\n")
     time.sleep(2)
     return True
+
+
+def find_first_partition(devname):
     """Return the first partition name (e.g. sdb1) for a disk, or None."""
     try:
         out = subprocess.check_output(["lsblk", "-J", "/dev/"+devname, "-o", "NAME,TYPE"], text=True)
@@ -411,55 +589,2778 @@ def build_mkfs_command(mkcmd, fstype_key, devpath, label):
     return ["sudo", "mkfs", "-t", fstype_key.split()[0], devpath]
 
 
-def run_format(devnode, mkcmd, fstype_key, label, log, progress_cb=None):
-    devpath = f"/dev/{devnode}"
-    log(f"Preparing to format {devpath} as {fstype_key}...\n")
-    # phase 1: unmount
-    if progress_cb:
-        progress_cb(10)
-    unmount_children(devnode, log)
+def run_format(devnode, mkcmd, fstype_key, label, log, progress_cb=None, stats_cb=None):
+    devpath = f"/dev/{devnode}"
+    log(f"Preparing to format {devpath} as {fstype_key}...\n")
+    # phase 1: unmount
+    if progress_cb:
+        progress_cb(10)
+    unmount_children(devnode, log)
+
+    # build command
+    cmd = build_mkfs_command(mkcmd, fstype_key, devpath, label)
+    log(f"Running: {' '.join(cmd)}\n")
+
+    # phase 2: starting mkfs
+    if progress_cb:
+        progress_cb(60)
+
+    # mkfs output says nothing about throughput; sample what reaches the device instead
+    monitor = ThroughputMonitor(f"Format {devpath}", None, stats_cb, log, probe=device_write_probe(devpath)).start()
+    try:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        # while process runs, increment progress slowly up to 95
+        pct = 60
+        while True:
+            line = p.stdout.readline()
+            if line:
+                log(line)
+            if p.poll() is not None:
+                break
+            # bump progress a bit to show activity
+            pct = min(95, pct + 1)
+            if progress_cb:
+                progress_cb(pct)
+        out, _ = p.communicate()
+        if out:
+            log(out + "\n")
+        if p.returncode == 0:
+            if progress_cb:
+                progress_cb(100)
+            log("Format completed successfully.\n")
+        else:
+            if progress_cb:
+                progress_cb(100)
+            log(f"Format failed with exit code {p.returncode}\n")
+    except Exception as e:
+        if progress_cb:
+            progress_cb(100)
+        log(f"Error running format: {e}\n")
+    finally:
+        monitor.stop()
+
+
+def alloc_aligned_buffer(size):
+    """Allocate a reusable page-aligned buffer of size bytes (usable with O_DIRECT)."""
+    return mmap.mmap(-1, size)
+
+
+def read_full(src, view):
+    """Fill view from src with readinto(), looping over short reads (pipes). Returns bytes read."""
+    got = 0
+    size = len(view)
+    while got < size:
+        n = src.readinto(view[got:])
+        if not n:
+            break
+        got += n
+    return got
+
+
+def write_all(fd, view):
+    """Write the whole of view to fd, retrying partial writes."""
+    done = 0
+    size = len(view)
+    while done < size:
+        n = os.write(fd, view[done:])
+        if n <= 0:
+            raise OSError(errno.EIO, "short write")
+        done += n
+
+
+def pwrite_all(fd, view, offset):
+    """Write the whole of view to fd at offset, retrying partial writes."""
+    done = 0
+    size = len(view)
+    while done < size:
+        n = os.pwrite(fd, view[done:], offset + done)
+        if n <= 0:
+            raise OSError(errno.EIO, "short write")
+        done += n
+
+
+def open_device_for_write(devpath, direct=False):
+    """Open devpath for writing, with O_DIRECT if requested and supported.
+    Returns (fd, direct_enabled)."""
+    flags = os.O_WRONLY | getattr(os, 'O_CLOEXEC', 0)
+    if direct and hasattr(os, 'O_DIRECT'):
+        try:
+            return os.open(devpath, flags | os.O_DIRECT), True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+    return os.open(devpath, flags), False
+
+
+def clear_direct_flag(fd):
+    """Turn O_DIRECT off on an open fd (needed for a final unaligned block)."""
+    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, fl & ~os.O_DIRECT)
+
+
+def image_compression(path):
+    """Return the compression suffix of path ('.xz', '.gz', '.zst', '.bz2') or None for raw images."""
+    suffix = Path(path).suffix.lower()
+    return suffix if suffix in DECOMPRESSORS else None
+
+
+def uncompressed_image_size(path, kind):
+    """Return the uncompressed size recorded in a compressed image, or None if the container doesn't record it.
+    xz keeps it in its index; zstd in the frame header. gzip only stores it modulo 4 GiB and
+    bzip2 not at all, so those return None."""
+    try:
+        if kind == '.xz' and shutil.which('xz'):
+            out = subprocess.check_output(['xz', '--robot', '--list', path], text=True, stderr=subprocess.DEVNULL)
+            for line in out.splitlines():
+                if line.startswith('totals'):
+                    return int(line.split('\t')[4])
+        if kind == '.zst':
+            with open(path, 'rb') as fh:
+                head = fh.read(18)
+            if len(head) < 6 or struct.unpack('<I', head[:4])[0] != 0xFD2FB528:
+                return None  # e.g. pzstd output starting with a skippable frame
+            fhd = head[4]
+            single_segment = (fhd >> 5) & 1
+            fcs_size = (1 if single_segment else 0, 2, 4, 8)[fhd >> 6]
+            if not fcs_size:
+                return None
+            pos = 5 + (0 if single_segment else 1) + (0, 1, 2, 4)[fhd & 3]
+            field = head[pos:pos + fcs_size]
+            size = int.from_bytes(field, 'little')
+            return size + 256 if fcs_size == 2 else size
+    except Exception:
+        pass
+    return None
+
+
+class DecompressThread:
+    """Runs a Python decompressor file object in its own thread, a few chunks ahead of the reader.
+    zlib/lzma/bz2 release the GIL while decompressing, so this overlaps with device writes."""
+
+    def __init__(self, fileobj, chunk_size=1024 * 1024, depth=8):
+        self._fileobj = fileobj
+        self._chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=depth)
+        self._pending = memoryview(b'')
+        self._eof = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                data = self._fileobj.read(self._chunk_size)
+                self._put(data)
+                if not data:
+                    return
+        except Exception as e:
+            self._put(OSError(errno.EIO, f"decompression failed: {e}"))
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def readinto(self, view):
+        if not self._pending:
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            if not item:
+                self._eof = True
+                return 0
+            self._pending = memoryview(item)
+        n = min(len(view), len(self._pending))
+        view[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=2)
+        self._fileobj.close()
+
+
+def cpu_signature():
+    """Identify what hashing speed depends on: machine, CPU model, the hash-relevant CPU
+    features (ARMv8 sha1/sha2/sha512 crypto extensions, x86 SHA-NI/AVX2), OpenSSL and Python."""
+    models, features = [], set()
+    try:
+        with open('/proc/cpuinfo', 'r', encoding='utf-8', errors='replace') as fh:
+            for line in fh:
+                name, _, value = line.partition(':')
+                name = name.strip().lower()
+                if name in ('model name', 'cpu part', 'model') and value.strip() not in models:
+                    models.append(value.strip())
+                elif name in ('flags', 'features'):
+                    features.update(value.split())
+    except OSError:
+        pass
+    try:
+        import ssl
+        library = ssl.OPENSSL_VERSION
+    except ImportError:
+        library = ''
+    flags = sorted(features & {'sha1', 'sha2', 'sha3', 'sha512', 'sha_ni', 'avx2', 'avx512f', 'asimd'})
+    return '|'.join([platform.machine(), '/'.join(models), ','.join(flags), library, platform.python_version()])
+
+
+def benchmark_hashing(bench_bytes=HASH_BENCH_BYTES, seconds=HASH_BENCH_SECONDS):
+    """Time every CHUNK_HASH_CANDIDATES algorithm at every HASH_BENCH_CHUNK_SIZES size. Each
+    chunk is first copied into one reused buffer, as a read would, so sizes that outgrow the
+    CPU caches show it; a trial stops after bench_bytes or `seconds`. Returns
+    {'chunk_size', 'chunk_algorithm', 'rates': {algorithm: {size: MB/s}}}: the sha256 rate
+    picks the read size for published digests, the fastest algorithm the chunk manifests'."""
+    src = memoryview(os.urandom(max(HASH_BENCH_CHUNK_SIZES)))
+    rates = {}
+    for algorithm in CHUNK_HASH_CANDIDATES:
+        if algorithm not in hashlib.algorithms_available:
+            continue
+        for size in HASH_BENCH_CHUNK_SIZES:
+            buf = memoryview(bytearray(size))
+            h = hashlib.new(algorithm)
+            done = 0
+            start = time.perf_counter()
+            while True:
+                buf[:] = src[:size]
+                h.update(buf)
+                done += size
+                elapsed = time.perf_counter() - start
+                if done >= bench_bytes or elapsed >= seconds:
+                    break
+            rates.setdefault(algorithm, {})[str(size)] = round(done / max(elapsed, 1e-9) / 1e6, 1)
+    best = {a: max(r.values()) for a, r in rates.items()}
+    sha256 = rates['sha256']
+    return {'chunk_size': int(max(sha256, key=sha256.get)), 'chunk_algorithm': max(best, key=best.get),
+            'rates': rates}
+
+
+_hash_profile = None
+_hash_profile_lock = threading.Lock()
+
+
+def hash_profile(log=None):
+    """Return this machine's hashing profile (see benchmark_hashing), measuring it the first
+    time and keeping it in HASH_PROFILE under cpu_signature(), so it is measured again when
+    the CPU, OpenSSL or Python changes."""
+    global _hash_profile
+    with _hash_profile_lock:
+        if _hash_profile is not None:
+            return _hash_profile
+        signature = cpu_signature()
+        try:
+            with open(HASH_PROFILE, 'r', encoding='utf-8') as fh:
+                stored = json.load(fh)
+            if stored.get('signature') == signature and stored.get('chunk_algorithm') in hashlib.algorithms_available:
+                _hash_profile = stored
+                return _hash_profile
+        except (OSError, ValueError):
+            pass
+        if log:
+            log("Measuring hashing speed on this machine (first run only)...\n")
+        profile = dict(benchmark_hashing(), signature=signature, measured=time.asctime())
+        try:
+            with open(HASH_PROFILE, 'w', encoding='utf-8') as fh:
+                json.dump(profile, fh, indent=2)
+        except OSError:
+            pass
+        if log:
+            best = {a: max(r.values()) for a, r in profile['rates'].items()}
+            log(f"Hashing: {', '.join(f'{a} {mbps:.0f} MB/s' for a, mbps in best.items())}; "
+                f"reading in {profile['chunk_size'] // 1024} KiB chunks, "
+                f"chunk manifests use {profile['chunk_algorithm']}.\n")
+        _hash_profile = profile
+        return _hash_profile
+
+
+def chunk_algorithm():
+    """hashlib name of the algorithm for chunk manifests, write journals and verification:
+    the fastest on this machine (hash_profile)."""
+    return hash_profile()['chunk_algorithm']
+
+
+def chunk_digest(data):
+    """Hex digest of one chunk of an image or device (chunk_algorithm())."""
+    return hashlib.new(chunk_algorithm(), data).hexdigest()
+
+
+def hash_fileobj(fileobj, hasher, chunk_size, consumed=None):
+    """Feed fileobj to hasher through one reused chunk_size buffer (readinto, so the loop
+    allocates nothing per chunk). consumed(bytes so far) is called after every chunk.
+    Returns the number of bytes hashed."""
+    view = memoryview(bytearray(chunk_size))
+    total = 0
+    while True:
+        n = fileobj.readinto(view)
+        if not n:
+            break
+        hasher.update(view[:n])
+        total += n
+        if consumed is not None:
+            consumed(total)
+    return total
+
+
+class HashingReader:
+    """Read-only file object wrapper that feeds every byte read through it to hasher."""
+
+    def __init__(self, fileobj, hasher):
+        self._fileobj = fileobj
+        self._hasher = hasher
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._hasher.update(data)
+        return data
+
+    def readinto(self, b):
+        n = self._fileobj.readinto(b)
+        self._hasher.update(memoryview(b)[:n])
+        return n
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self._fileobj.close()
+
+
+def pump_hashed(src, pipe, hasher, chunk_size=HASH_CHUNK_SIZE):
+    """Copy the file object src into pipe from a background thread, feeding every chunk to hasher
+    on the way (a hashing tap in front of a decompressor or dd). The pipe is closed at the end
+    so the consumer sees EOF. Returns the thread; after join() its `error` attribute holds the
+    exception that stopped reading src, or None. A consumer that exits early (EPIPE) is not an
+    error here: its own exit status reports the failure."""
+    def run():
+        view = memoryview(bytearray(chunk_size))
+        try:
+            while True:
+                n = src.readinto(view)
+                if not n:
+                    break
+                hasher.update(view[:n])
+                try:
+                    write_all(pipe.fileno(), view[:n])
+                except BrokenPipeError:
+                    return
+        except (OSError, ValueError) as e:
+            # the consumer would otherwise see a clean EOF and take the truncated image as whole
+            thread.error = e
+        finally:
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.error = None
+    thread.start()
+    return thread
+
+
+class PageCacheReleaser:
+    """Drops an image file's pages from the page cache (POSIX_FADV_DONTNEED) once they are consumed.
+
+    Reading a multi-GB image would otherwise evict the desktop's working set on a small Pi.
+    Consumed ranges are released every `step` bytes and the rest of the file by finish(). The
+    page cache is shared, so this also covers pages another process (dd, pv, a decompressor)
+    read through its own descriptor. Images kept "hot" for repeated flashing skip this."""
+
+    def __init__(self, fd, step=CACHE_RELEASE_STEP):
+        self.fd = fd
+        self.step = step
+        self.released = 0
+
+    def consumed(self, offset):
+        """Note that the file has been used up to offset; drops that range once a step has built up."""
+        if offset - self.released >= self.step:
+            self._drop(offset)
+
+    def finish(self):
+        self._drop(None)
+
+    def _drop(self, offset):
+        length = 0 if offset is None else offset - self.released  # 0: to the end of the file
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(self.fd, self.released, length, os.POSIX_FADV_DONTNEED)
+            except OSError:
+                pass
+        if offset is not None:
+            self.released = offset
+
+
+def plan_memory(budget, chunk_size, queue_depth, prefetch, hot, log):
+    """Fit a write job into budget bytes: the chunk buffers come first, then the writeback window
+    (about two windows are dirty at a time) and the source read-ahead share what is left.
+    Consumed image pages are released (PageCacheReleaser) unless the image is hot, so the
+    footprint does not grow with the image size. Returns (prefetch, writeback_window)."""
+    buffers = chunk_size * queue_depth
+    left = max(0, budget - buffers)
+    window = max(1024 * 1024, min(WRITEBACK_WINDOW, left // 4))
+    prefetch = max(0, min(prefetch, left - 2 * window))
+    note = "; the image stays in the page cache (hot)" if hot else ""
+    log(f"Memory budget {budget >> 20} MiB: {buffers >> 20} MiB buffers, {window >> 20} MiB writeback window, "
+        f"{prefetch >> 20} MiB read-ahead{note}.\n")
+    return prefetch, window
+
+
+class SourcePrefetcher:
+    """Reads an image file into the page cache up to `ahead` bytes past the consumer.
+
+    On a Pi the image usually sits on the microSD card, which can read slower than a USB3
+    stick writes; prefetching makes source reads overlap with device writes instead of
+    alternating with them. The file is advised SEQUENTIAL (a larger kernel readahead window)
+    and WILLNEED one step ahead of a thread that reads it. position() returns the consumer's
+    file offset. Time spent in those reads gives the source's own throughput."""
+
+    def __init__(self, fd, size, ahead, position):
+        self.fd = fd
+        self.size = size
+        self.ahead = ahead
+        self.position = position
+        self.read_bytes = 0
+        self.read_seconds = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+        self._thread.start()
+        return self
+
+    def _run(self):
+        buf = bytearray(PREFETCH_STEP)
+        pos = 0
+        try:
+            while pos < self.size and not self._stop.is_set():
+                consumer = self.position()
+                pos = max(pos, consumer)
+                if pos - consumer >= self.ahead:
+                    self._stop.wait(0.02)
+                    continue
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(self.fd, pos + PREFETCH_STEP, PREFETCH_STEP, os.POSIX_FADV_WILLNEED)
+                start = time.monotonic()
+                n = os.preadv(self.fd, [buf], pos)
+                self.read_seconds += time.monotonic() - start
+                if not n:
+                    break
+                pos += n
+                self.read_bytes += n
+        except (OSError, ValueError):
+            pass  # source closed under us; the consumer reports its own read errors
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=2)
+
+    def summary(self, elapsed):
+        """Log line comparing the source's read rate with the rate the write consumed the image at."""
+        if not self.read_seconds or elapsed <= 0:
+            return None
+        source = self.read_bytes / self.read_seconds / 1e6
+        sink = self.size / elapsed / 1e6
+        text = f"Source read {source:.1f} MB/s, writer consumed the image at {sink:.1f} MB/s"
+        if source < sink * 1.1:
+            return text + ": the image source is the bottleneck (stage it in RAM for repeat flashes).\n"
+        return text + ": the device is the bottleneck.\n"
+
+
+def mem_available():
+    """MemAvailable from /proc/meminfo in bytes, or None."""
+    try:
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def stage_image(path, log):
+    """Copy the image into tmpfs (STAGE_DIR) when RAM allows and return the staged path, so this
+    and later flashes of the same image read from memory. A copy staged earlier for the same file
+    (same device, inode, size and mtime) is reused; other staged images are evicted, least recently
+    used first, to make room. Returns None when the image is not staged."""
+    st = os.stat(path)
+    name = Path(path).name
+    staged = STAGE_DIR / f"{st.st_dev:x}-{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}-{name}"
+    if staged.is_file() and staged.stat().st_size == st.st_size:
+        os.utime(staged)  # most recently used
+        log(f"Reading {name} from its copy staged in RAM ({staged}).\n")
+        return str(staged)
+    if not STAGE_DIR.parent.is_dir():
+        log(f"No tmpfs at {STAGE_DIR.parent}; reading the image from its source.\n")
+        return None
+    try:
+        STAGE_DIR.mkdir(mode=0o700, exist_ok=True)
+        older = sorted(STAGE_DIR.iterdir(), key=lambda p: p.stat().st_mtime)
+
+        def room():
+            available = mem_available()
+            if available is None:
+                return False
+            return (available - st.st_size >= STAGE_RAM_RESERVE
+                    and shutil.disk_usage(str(STAGE_DIR)).free >= st.st_size)
+        while not room() and older:
+            victim = older.pop(0)
+            log(f"Evicting staged image {victim.name} from RAM.\n")
+            victim.unlink()
+        if not room():
+            available = mem_available() or 0
+            log(f"Not staging {name} in RAM: {st.st_size // 2**20} MiB image, "
+                f"{available // 2**20} MiB available ({STAGE_RAM_RESERVE // 2**20} MiB kept free).\n")
+            return None
+    except OSError as e:
+        log(f"Cannot stage {name} in RAM: {e}\n")
+        return None
+    partial = staged.with_name('.partial-' + staged.name)
+    log(f"Staging {name} in RAM ({st.st_size // 2**20} MiB)...\n")
+    start = time.monotonic()
+    try:
+        shutil.copyfile(path, str(partial))
+        os.replace(str(partial), str(staged))
+    except OSError as e:
+        log(f"Staging failed ({e}); reading the image from its source.\n")
+        try:
+            partial.unlink()
+        except OSError:
+            pass
+        return None
+    elapsed = time.monotonic() - start
+    log(f"Staged {name} in {format_duration(elapsed)} "
+        f"({st.st_size / max(elapsed, 1e-6) / 1e6:.1f} MB/s from the source).\n")
+    return str(staged)
+
+
+class ImageSource:
+    """Readable image stream with readinto() that decompresses .xz/.gz/.zst/.bz2 images on the fly.
+
+    Decompression runs as its own pipeline stage: a parallel command-line decompressor
+    (xz -T0, pigz, lbzip2/pbzip2, zstd) when one is installed, otherwise a Python
+    decompressor in a DecompressThread. Nothing is staged to disk.
+    size is the uncompressed size when known (raw images, xz, zstd), else None.
+    If hasher (a hashlib object) is given, every byte of the image file as stored (compressed
+    or not) is fed to it as it is read, so the file's checksum is ready once the stream ends.
+    With prefetch (bytes) a SourcePrefetcher keeps the file read that far ahead of the stream.
+    Consumed pages are dropped from the page cache (PageCacheReleaser) unless hot=True."""
+
+    def __init__(self, path, hasher=None, prefetch=0, hot=False):
+        self.path = path
+        self.kind = image_compression(path)
+        self.compressed_size = os.path.getsize(path)
+        self.size = self.compressed_size if self.kind is None else uncompressed_image_size(path, self.kind)
+        self.method = 'raw'
+        self._last_pos = 0
+        self._raw = open(path, 'rb', buffering=0)
+        self._hasher = hasher
+        self._pump = None
+        self._proc = None
+        self._stream = self._raw
+        self.prefetcher = None
+        self._releaser = None if hot else PageCacheReleaser(self._raw.fileno())
+        if prefetch:
+            # the file offset is shared with a command-line decompressor reading it directly
+            fd = self._raw.fileno()
+            self.prefetcher = SourcePrefetcher(fd, self.compressed_size, prefetch,
+                                               lambda: os.lseek(fd, 0, os.SEEK_CUR)).start()
+        if self.kind is None:
+            return
+        commands, module_name = DECOMPRESSORS[self.kind]
+        for argv in commands:
+            if shutil.which(argv[0]):
+                # the child shares our file offset, which percent() uses when size is unknown;
+                # when hashing, we read the file ourselves and feed the child through a pipe
+                self._proc = subprocess.Popen(argv, stdin=self._raw if hasher is None else subprocess.PIPE,
+                                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
+                if hasher is not None:
+                    self._pump = pump_hashed(self._raw, self._proc.stdin, hasher)
+                self._stream = self._proc.stdout
+                self.method = ' '.join(argv)
+                return
+        raw = self._raw if hasher is None else HashingReader(self._raw, hasher)
+        try:
+            if module_name == 'zstandard':
+                import zstandard  # optional dependency
+                fileobj = zstandard.ZstdDecompressor().stream_reader(raw)
+            else:
+                fileobj = __import__(module_name).open(raw, 'rb')
+        except ImportError:
+            if self.prefetcher is not None:
+                self.prefetcher.stop()
+            self._raw.close()
+            raise OSError(errno.ENOTSUP, f"no decompressor available for {self.kind} images "
+                                         f"(install {commands[-1][0]})")
+        self._stream = DecompressThread(fileobj)
+        self.method = f"python {module_name}"
+
+    def readinto(self, view):
+        n = self._stream.readinto(view)
+        if self._hasher is not None and self.kind is None:
+            self._hasher.update(view[:n])
+        if self._releaser is not None:
+            self._releaser.consumed(os.lseek(self._raw.fileno(), 0, os.SEEK_CUR))
+        return n
+
+    def percent(self, produced):
+        """Progress in percent for produced uncompressed bytes; falls back to the compressed read position."""
+        if self.size:
+            return min(100, produced * 100 // self.size)
+        if not self.compressed_size:
+            return 0
+        try:
+            self._last_pos = os.lseek(self._raw.fileno(), 0, os.SEEK_CUR)
+        except (OSError, ValueError):
+            pass  # source already closed at end of image
+        return min(99, self._last_pos * 100 // self.compressed_size)
+
+    def skip(self, nbytes, scratch):
+        """Advance the stream by nbytes: a seek for raw images (unless hashing), decompress-and-discard otherwise."""
+        if self.kind is None and self._hasher is None:
+            self._raw.seek(nbytes, os.SEEK_CUR)
+            return
+        while nbytes > 0:
+            n = read_full(self, scratch[:min(len(scratch), nbytes)])
+            if not n:
+                raise OSError(errno.EIO, "image ended while skipping to the resume offset")
+            nbytes -= n
+
+    def check(self):
+        """Raise OSError if a command-line decompressor failed (truncated or corrupt image)."""
+        if self._proc is not None:
+            rc = self._proc.wait()
+            if self._pump is not None:
+                self._pump.join()
+                if self._pump.error is not None:
+                    raise OSError(errno.EIO, f"reading the image failed: {self._pump.error}")
+            if rc != 0:
+                err = self._proc.stderr.read().decode('utf-8', errors='ignore').strip()
+                raise OSError(errno.EIO, f"{self.method} failed with code {rc}: {err}")
+
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        if self._releaser is not None and not self._raw.closed:
+            self._releaser.finish()
+        if self._proc is not None:
+            if self._proc.poll() is None:
+                self._proc.kill()
+            self._proc.wait()
+            if self._pump is not None:
+                self._pump.join(timeout=5)
+            self._proc.stdout.close()
+            self._proc.stderr.close()
+        elif self._stream is not self._raw:
+            self._stream.close()
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def is_zero_block(view):
+    """True if view (at most SPARSE_BLOCK_SIZE bytes) is all zeros; compares without copying."""
+    return ZERO_BLOCK.startswith(view)
+
+
+def _libc_fallocate():
+    """Return libc's 64-bit fallocate() via ctypes, or None."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fn = getattr(libc, 'fallocate64', None) or libc.fallocate
+        fn.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        return fn
+    except Exception:
+        return None
+
+
+def zero_device_range(fd, length, log, start=0):
+    """Cheaply clear length bytes from start on the device behind fd before a sparse write.
+    Returns True if the range is guaranteed to read back as zeros afterwards.
+
+    Only hardware-offloaded zeroing is used (fallocate PUNCH_HOLE, which the kernel refuses
+    instead of writing zero pages). Failing that, a plain BLKDISCARD is issued as a hint
+    and False is returned, so the caller must check the device before skipping blocks."""
+    fallocate = _libc_fallocate()
+    if fallocate is not None:
+        if fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, start, length) == 0:
+            log(f"Pre-zeroed {length} bytes with discard/write-zeroes.\n")
+            return True
+        err = ctypes.get_errno()
+        log(f"Device cannot zero cheaply ({os.strerror(err)}).\n")
+    try:
+        fcntl.ioctl(fd, BLKDISCARD, struct.pack('QQ', start, length))
+        log(f"Discarded {length} bytes (contents after discard are not guaranteed to be zero).\n")
+    except OSError:
+        pass
+    return False
+
+
+def write_sparse_chunk(fd, view, offset, device_zeroed, check_fd, check_view):
+    """Write view at offset, skipping all-zero SPARSE_BLOCK_SIZE blocks. Returns physical bytes written.
+    If the device range was not zeroed beforehand, the device chunk is read through check_fd and
+    zero blocks are only skipped where the device already holds zeros."""
+    size = len(view)
+    dev_view = None
+    physical = 0
+    run_start = None  # start of the pending run of blocks that must be written
+    pos = 0
+    while pos < size:
+        end = min(pos + SPARSE_BLOCK_SIZE, size)
+        skip = False
+        if is_zero_block(view[pos:end]):
+            if device_zeroed:
+                skip = True
+            else:
+                if dev_view is None:
+                    got = os.preadv(check_fd, [check_view[:size]], offset)
+                    dev_view = check_view[:got]
+                skip = end <= len(dev_view) and is_zero_block(dev_view[pos:end])
+        if skip:
+            if run_start is not None:
+                pwrite_all(fd, view[run_start:pos], offset + run_start)
+                physical += pos - run_start
+                run_start = None
+        elif run_start is None:
+            run_start = pos
+        pos = end
+    if run_start is not None:
+        pwrite_all(fd, view[run_start:size], offset + run_start)
+        physical += size - run_start
+    return physical
+
+
+def _libc_sync_file_range():
+    """Return libc's sync_file_range() via ctypes, or None."""
+    try:
+        fn = ctypes.CDLL(None, use_errno=True).sync_file_range
+        fn.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+        return fn
+    except Exception:
+        return None
+
+
+class WritebackLimiter:
+    """Bounds the dirty page cache of a buffered device write.
+
+    Every `window` bytes, writeback of the window just written is started (sync_file_range
+    SYNC_FILE_RANGE_WRITE) and the window before it is waited for, so at most about two windows
+    are dirty at any time: a small Pi does not fill its RAM with dirty pages, the final fsync
+    takes moments, and `durable` tracks what has actually been written back to the device.
+    Falls back to an fdatasync per window where sync_file_range is unavailable."""
+
+    def __init__(self, fd, start=0, window=WRITEBACK_WINDOW):
+        self.fd = fd
+        self.window = window
+        self.started = start  # writeback has been started up to here
+        self.durable = start  # and has completed up to here
+        self._sync_file_range = _libc_sync_file_range()
+
+    def _sync(self, offset, length, flags):
+        if self._sync_file_range(self.fd, offset, length, flags) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"writeback failed: {os.strerror(err)}")
+
+    def advance(self, written):
+        """Note that everything below offset written has been written; returns the durable offset."""
+        while written - self.started >= self.window:
+            end = self.started + self.window
+            if self._sync_file_range is None:
+                os.fdatasync(self.fd)
+                self.durable = end
+            else:
+                self._sync(self.started, self.window, SYNC_FILE_RANGE_WRITE)
+                if self.started > self.durable:
+                    self._sync(self.durable, self.started - self.durable,
+                               SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER)
+                    self.durable = self.started
+            self.started = end
+        return self.durable
+
+
+def bdi_path(devpath):
+    """Return the /sys/class/bdi directory (writeback settings) of the disk behind devpath, or None."""
+    try:
+        node = Path(f"/sys/class/block/{os.path.basename(devpath)}").resolve()
+        if (node / 'partition').exists():
+            node = node.parent  # partitions share their disk's bdi
+        bdi = (node / 'bdi').resolve()
+        return bdi if bdi.is_dir() else None
+    except OSError:
+        return None
+
+
+def write_sysfs(path, value):
+    """Write value to a sysfs attribute, through sudo tee when not running as root. Returns True on success."""
+    try:
+        with open(path, 'w') as fh:
+            fh.write(str(value))
+        return True
+    except OSError:
+        pass
+    try:
+        return subprocess.run(['sudo', '-n', 'tee', str(path)], input=str(value), text=True,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+    except OSError:
+        return False
+
+
+class BoundedWriteback:
+    """Caps the dirty page cache of one disk for the duration of a job written by another
+    process (sudo dd, cp onto a mounted stick), through the disk's bdi writeback settings:
+    max_bytes (kernel 6.2+, else max_ratio) plus strict_limit, so the cap holds even while
+    the system-wide dirty limit is far away. apply() sets the cap and restore() puts the
+    old settings back; also usable as a context manager."""
+
+    def __init__(self, devpath, log, limit=2 * WRITEBACK_WINDOW):
+        self.devpath = devpath
+        self.log = log
+        self.limit = limit
+        self._saved = []
+
+    def apply(self):
+        bdi = bdi_path(self.devpath)
+        if bdi is None:
+            return
+        if (bdi / 'max_bytes').exists():
+            wanted = [('max_bytes', self.limit)]
+        else:
+            wanted = [('max_ratio', 1)]
+        if (bdi / 'strict_limit').exists():
+            wanted.append(('strict_limit', 1))
+        applied = []
+        for name, value in wanted:
+            attr = bdi / name
+            # max_bytes is stored as a ratio; putting max_ratio back restores the original setting
+            saved = bdi / 'max_ratio' if name == 'max_bytes' else attr
+            try:
+                old = saved.read_text().strip()
+            except OSError:
+                continue
+            if write_sysfs(attr, value):
+                self._saved.append((saved, old))
+                applied.append(f"{name}={value}")
+        if applied:
+            self.log(f"Limiting the dirty page cache of {self.devpath} ({', '.join(applied)}).\n")
+        else:
+            self.log(f"Could not limit the dirty cache for {self.devpath}; the final flush may take a while.\n")
+
+    def restore(self):
+        # in reverse order, so strict_limit goes back off before the limit is lifted
+        for attr, old in reversed(self._saved):
+            write_sysfs(attr, old)
+        self._saved = []
+
+    def __enter__(self):
+        self.apply()
+        return self
+
+    def __exit__(self, *exc):
+        self.restore()
+
+
+class DeviceReadAhead:
+    """Reads a device sequentially from start in its own thread, up to `depth` chunks ahead of
+    the consumer, so device reads overlap with the writer's work (differential writes).
+    Reads use O_DIRECT where possible so they come from the media, not the page cache."""
+
+    def __init__(self, devpath, chunk_size, start=0, depth=4):
+        self._fd, self._direct = open_device_for_read(devpath)
+        self._chunk_size = chunk_size
+        self._free = queue.Queue()
+        for _ in range(depth):
+            self._free.put(memoryview(alloc_aligned_buffer(chunk_size)))
+        self._ready = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(start,), daemon=True)
+        self._thread.start()
+
+    def _run(self, offset):
+        try:
+            while not self._stop.is_set():
+                view = self._free.get()
+                if view is None:
+                    return
+                got = pread_full(self._fd, view, offset)
+                self._ready.put((view, got))
+                if got < self._chunk_size:
+                    self._ready.put((None, None))  # end of device
+                    return
+                offset += got
+        except OSError as e:
+            self._ready.put((None, e))
+
+    def next(self):
+        """Return (view, bytes_read) for the next device chunk; recycle the view with release().
+        Past the end of the device this returns an empty view."""
+        view, got = self._ready.get()
+        if view is None:
+            self._ready.put((None, got))  # keep reporting end of device / the error
+            if got is None:
+                return memoryview(b''), 0
+            raise got
+        return view, got
+
+    def release(self, view):
+        if len(view):
+            self._free.put(view)
+
+    def close(self):
+        self._stop.set()
+        self._free.put(None)
+        self._thread.join(timeout=5)
+        os.close(self._fd)
+
+
+def zero_copy_methods():
+    """Kernel copy primitives this Python exposes, in order of preference."""
+    methods = []
+    if hasattr(os, 'copy_file_range'):
+        methods.append('copy_file_range')
+    if hasattr(os, 'sendfile'):
+        methods.append('sendfile')
+    if hasattr(os, 'splice'):
+        methods.append('splice')
+    return methods
+
+
+def zero_copy_chunk(method, src_fd, dst_fd, offset, length, pipe=None):
+    """Copy up to length bytes at offset from src_fd to the same offset of dst_fd inside the kernel.
+    splice goes through pipe (a (read_fd, write_fd) pair). Returns bytes copied, 0 at end of source."""
+    if method == 'copy_file_range':
+        return os.copy_file_range(src_fd, dst_fd, length, offset, offset)
+    if method == 'sendfile':
+        os.lseek(dst_fd, offset, os.SEEK_SET)  # sendfile writes at the file position
+        return os.sendfile(dst_fd, src_fd, offset, length)
+    pipe_r, pipe_w = pipe
+    moved = os.splice(src_fd, pipe_w, length, offset_src=offset)
+    done = 0
+    while done < moved:
+        done += os.splice(pipe_r, dst_fd, moved - done, offset_dst=offset + done)
+    return moved
+
+
+def write_image_zero_copy(src_path, devpath, log, progress_cb=None, chunk_size=WRITE_CHUNK_SIZE, monitor=None,
+                          prefetch=0, hot=False, writeback_window=WRITEBACK_WINDOW):
+    """Write a raw image to devpath without copying it through user space: copy_file_range,
+    sendfile or splice through a pipe, whichever the kernel accepts first for this file/device
+    pair. Returns (bytes written or None on failure, method); method is None if no zero-copy
+    primitive works here, in which case nothing has been written. prefetch, hot and
+    writeback_window are as for write_image_native."""
+    methods = zero_copy_methods()
+    if not methods:
+        return 0, None
+    src_fd = fd = None
+    pipe = None
+    prefetcher = releaser = None
+    method = None
+    written = 0
+    started = time.monotonic()
+    try:
+        src_fd = os.open(src_path, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+        total = os.fstat(src_fd).st_size
+        fd = open_device_for_write(devpath)[0]
+        if prefetch:
+            prefetcher = SourcePrefetcher(src_fd, total, prefetch, lambda: written).start()
+        if not hot:
+            releaser = PageCacheReleaser(src_fd)
+        limiter = WritebackLimiter(fd, window=writeback_window)
+        last_pct = -1
+        while written < total:
+            length = min(chunk_size, total - written)
+            if method is None:
+                # the first chunk picks the method: unsupported pairs fail before writing anything
+                for candidate in methods:
+                    if candidate == 'splice' and pipe is None:
+                        pipe = os.pipe()
+                        try:
+                            fcntl.fcntl(pipe[1], F_SETPIPE_SZ, min(chunk_size, 1024 * 1024))
+                        except OSError:
+                            pass  # default 64 KiB pipe
+                    try:
+                        n = zero_copy_chunk(candidate, src_fd, fd, written, length, pipe)
+                    except OSError as e:
+                        if e.errno in (errno.EINVAL, errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF):
+                            continue
+                        raise
+                    method = candidate
+                    log(f"Transfer path: zero-copy {method} from {src_path} to {devpath}.\n")
+                    break
+                else:
+                    return 0, None
+            else:
+                n = zero_copy_chunk(method, src_fd, fd, written, length, pipe)
+            if not n:
+                raise OSError(errno.EIO, "image ended early")
+            written += n
+            if releaser is not None:
+                releaser.consumed(written)
+            durable = limiter.advance(written)
+            if monitor is not None:
+                monitor.update(durable)
+            pct = durable * 100 // total
+            if progress_cb and pct != last_pct:
+                last_pct = pct
+                progress_cb(pct)
+        log("Flushing device...\n")
+        os.fsync(fd)
+        if progress_cb:
+            progress_cb(100)
+        log(f"Wrote {written} of {total} bytes to {devpath}.\n")
+        summary = prefetcher and prefetcher.summary(time.monotonic() - started)
+        if summary:
+            log(summary)
+        return written, method
+    except OSError as e:
+        log(f"Write failed at byte offset {written}: {e}\n")
+        return None, method
+    finally:
+        if prefetcher is not None:
+            prefetcher.stop()
+        if releaser is not None:
+            releaser.finish()
+        for f in (src_fd, fd) + (pipe or ()):
+            if f is not None:
+                os.close(f)
+
+
+def write_image_native(src_path, devpath, log, progress_cb=None, chunk_size=WRITE_CHUNK_SIZE, direct=False,
+                       sparse=False, queue_depth=1, chunk_digests=None, journal=None, diff=False, source_hash=None,
+                       monitor=None, prefetch=0, hot=False, writeback_window=WRITEBACK_WINDOW,
+                       diff_manifest=None):
+    """Stream src_path onto devpath in-process, without pv/dd.
+    The device is opened once and data goes through reusable page-aligned buffers,
+    with up to queue_depth chunk writes outstanding at once.
+    Progress is computed from the exact bytes the kernel accepted. Compressed images
+    (.xz/.gz/.zst/.bz2) are decompressed on the fly by an ImageSource.
+    With sparse=True the image range is pre-zeroed and all-zero blocks are seeked over
+    instead of written; the log then reports logical and physical bytes.
+    If chunk_digests is a list, the digest of every chunk (chunk_digest) is appended to it (for
+    verify_device).
+    With a WriteJournal the durable extent is recorded as the write goes, and a write
+    interrupted earlier resumes after the part of it that still checks out on the device.
+    With diff=True the device is read alongside (DeviceReadAhead) and only chunks that
+    differ from the image are rewritten; with the image's chunk manifest as diff_manifest (raw
+    images) device chunks are compared with it instead, and unchanged chunks of the image are
+    never read. Buffered writes are flushed as they go
+    (WritebackLimiter), so progress follows what has reached the device. A source_hash (hashlib object) is fed the image
+    file as it is read, so its digest is complete when the write returns. A ThroughputMonitor
+    is updated with the bytes written so far. With prefetch (bytes) the image file is read that
+    far ahead of the writer (SourcePrefetcher) and source and writer throughput are compared.
+    Consumed image pages leave the page cache unless hot=True; writeback_window is the
+    WritebackLimiter window.
+    A raw image that nothing needs to inspect in user space (no hashing, digests, journal,
+    sparse, diff or O_DIRECT) is copied with write_image_zero_copy; the chosen path is logged.
+    Returns the number of bytes written, or None on failure (the failing offset is logged)."""
+    needs_data = [why for why, on in (("source hash", source_hash is not None),
+                                      ("chunk digests", chunk_digests is not None or journal is not None),
+                                      ("sparse", sparse), ("differential", diff), ("O_DIRECT", direct)) if on]
+    if image_compression(src_path) is None and not needs_data:
+        written, method = write_image_zero_copy(src_path, devpath, log, progress_cb, chunk_size, monitor,
+                                                prefetch, hot, writeback_window)
+        if method is not None:
+            return written
+        log("Transfer path: zero-copy not supported for this image/device pair; using buffered copy.\n")
+    else:
+        log(f"Transfer path: buffered copy ({', '.join(needs_data) or 'compressed image'} needs the data in user space).\n")
+    started = time.monotonic()
+    try:
+        src = ImageSource(src_path, hasher=source_hash, prefetch=prefetch, hot=hot)
+    except OSError as e:
+        log(f"Cannot open image: {e}\n")
+        return None
+    total = src.size
+    if src.kind:
+        size_note = f"{total} bytes uncompressed" if total else "uncompressed size not recorded"
+        log(f"Decompressing {src.kind} image with {src.method} ({size_note}).\n")
+    queue_depth = max(1, queue_depth)
+    digests = chunk_digests if chunk_digests is not None else ([] if journal is not None else None)
+    resume_chunks = 0
+    if journal is not None:
+        prior = journal.load()
+        if prior:
+            log(f"Journal: up to {len(prior) * chunk_size} bytes of this image may already be on the device; "
+                f"checking them...\n")
+            try:
+                bad = find_first_mismatch(devpath, prior, chunk_size, len(prior) * chunk_size)
+            except OSError as e:
+                log(f"Journal: cannot check previous data ({e}); starting from byte 0.\n")
+                bad = 0
+            resume_chunks = len(prior) if bad is None else bad // chunk_size
+            digests.extend(prior[:resume_chunks])
+    views = [memoryview(alloc_aligned_buffer(chunk_size)) for _ in range(queue_depth)]
+    check_views = [None] * queue_depth
+    pool = ThreadPoolExecutor(max_workers=queue_depth) if queue_depth > 1 else None
+    pending = deque()  # (future, length) of outstanding chunk writes, oldest first
+    submitted = written = resume_chunks * chunk_size
+    physical = 0
+    journaled = written
+    fd = None
+    check_fd = None
+    readahead = None
+    if diff and sparse:
+        log("Differential mode already skips unchanged blocks; sparse pre-zeroing is disabled.\n")
+        sparse = False
+    try:
+        fd, direct = open_device_for_write(devpath, direct)
+        limiter = None if direct else WritebackLimiter(fd, start=written, window=writeback_window)
+        mode = "O_DIRECT" if direct else f"buffered, flushed every {writeback_window >> 20} MiB"
+        log(f"Native writer: {devpath} opened ({mode}, {chunk_size // 1024} KiB chunks, "
+            f"queue depth {queue_depth}{', sparse' if sparse else ''}{', differential' if diff else ''}).\n")
+        if diff:
+            readahead = DeviceReadAhead(devpath, chunk_size, start=written)
+        device_zeroed = False
+        if sparse:
+            device_zeroed = bool(total) and zero_device_range(fd, total - written, log, start=written)
+            if not device_zeroed:
+                log("Zero blocks will only be skipped where the device already reads zero.\n")
+                check_fd = os.open(devpath, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+                check_views = [memoryview(alloc_aligned_buffer(chunk_size)) for _ in range(queue_depth)]
+
+        def write_chunk(slot, n, offset):
+            if sparse:
+                return write_sparse_chunk(fd, views[slot][:n], offset, device_zeroed, check_fd, check_views[slot])
+            pwrite_all(fd, views[slot][:n], offset)
+            return n
+
+        last_pct = -1
+        last_decile = 0
+
+        def chunk_done(n, phys):
+            nonlocal written, physical, journaled, last_pct, last_decile
+            written += n
+            physical += phys
+            durable = written if limiter is None else limiter.advance(written)
+            if monitor is not None:
+                monitor.update(durable)
+            if journal is not None and written - journaled >= JOURNAL_INTERVAL:
+                # only record what is durably on the device
+                os.fdatasync(fd)
+                journal.record(digests[:written // chunk_size])
+                journaled = written
+            pct = src.percent(durable)
+            if progress_cb and pct != last_pct:
+                last_pct = pct
+                progress_cb(pct)
+            if sparse and pct // 10 > last_decile:
+                last_decile = pct // 10
+                log(f"Sparse write: {written} bytes logical, {physical} bytes physical.\n")
+
+        with src:
+            if resume_chunks:
+                log(f"Resuming at byte offset {written}.\n")
+                src.skip(written, views[0])
+            seq = 0
+            while True:
+                slot = seq % queue_depth
+                if len(pending) == queue_depth:
+                    # the buffer for this slot is still being written
+                    fut, n = pending.popleft()
+                    chunk_done(n, fut.result())
+                if diff_manifest is not None:
+                    if submitted >= total:
+                        break
+                    index = submitted // chunk_size
+                    n = min(chunk_size, total - submitted)
+                    dev_view, got = readahead.next()
+                    same = got >= n and chunk_digest(dev_view[:n]) == diff_manifest[index]
+                    readahead.release(dev_view)
+                    if digests is not None:
+                        digests.append(diff_manifest[index])
+                    if same:
+                        src.skip(n, views[slot])
+                    elif read_full(src, views[slot][:n]) < n:
+                        raise OSError(errno.EIO, "image is shorter than its chunk manifest")
+                else:
+                    n = read_full(src, views[slot])
+                    if not n:
+                        break
+                    if digests is not None:
+                        digests.append(chunk_digest(views[slot][:n]))
+                    same = False
+                    if readahead is not None:
+                        dev_view, got = readahead.next()
+                        same = got >= n and hmac.compare_digest(views[slot][:n], dev_view[:n])
+                        readahead.release(dev_view)
+                if same:
+                    # unchanged on the device: nothing to write
+                    if pool is None:
+                        chunk_done(n, 0)
+                    else:
+                        skipped = Future()  # keeps completions in order behind pending writes
+                        skipped.set_result(0)
+                        pending.append((skipped, n))
+                    submitted += n
+                    seq += 1
+                    continue
+                if direct and n % DIRECT_IO_ALIGN:
+                    clear_direct_flag(fd)
+                    direct = False
+                if pool is None:
+                    chunk_done(n, write_chunk(slot, n, submitted))
+                else:
+                    pending.append((pool.submit(write_chunk, slot, n, submitted), n))
+                submitted += n
+                seq += 1
+            while pending:
+                fut, n = pending.popleft()
+                chunk_done(n, fut.result())
+            src.check()
+        total = written if total is None else total
+        log("Flushing device...\n")
+        os.fsync(fd)
+        if progress_cb:
+            progress_cb(src.percent(written))
+        if journal is not None:
+            journal.clear()
+        if resume_chunks:
+            log(f"Resumed write: {resume_chunks * chunk_size} bytes were already on the device.\n")
+        if diff:
+            log(f"Differential write: {physical} of {written} bytes differed and were rewritten.\n")
+        if sparse:
+            processed = written - resume_chunks * chunk_size
+            saved = 100 - (physical * 100 // processed if processed else 100)
+            log(f"Wrote {written} of {total} bytes to {devpath} ({physical} bytes physical, {saved}% skipped as zero).\n")
+        else:
+            log(f"Wrote {written} of {total} bytes to {devpath}.\n")
+        summary = src.prefetcher and src.prefetcher.summary(time.monotonic() - started)
+        if summary:
+            log(summary)
+        return written
+    except OSError as e:
+        of_total = f" of {total}" if total else ""
+        log(f"Write failed at byte offset {written}{of_total}: {e}\n")
+        return None
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True)
+        if readahead is not None:
+            readahead.close()
+        src.close()
+        if fd is not None:
+            os.close(fd)
+        if check_fd is not None:
+            os.close(check_fd)
+
+
+def get_device_identity(devnode):
+    """Return (vendor, model, serial) of /dev/<devnode> as reported by lsblk; unknown fields are ''."""
+    try:
+        out = subprocess.check_output(["lsblk", "-J", "-d", "-o", "VENDOR,MODEL,SERIAL", "/dev/"+devnode], text=True)
+        node = (json.loads(out).get("blockdevices") or [{}])[0]
+    except Exception:
+        node = {}
+    return tuple((node.get(k) or "").strip() for k in ("vendor", "model", "serial"))
+
+
+def load_device_profiles():
+    try:
+        with open(DEVICE_PROFILES, 'r', encoding='utf-8') as fh:
+            return json.load(fh)
+    except Exception:
+        return {}
+
+
+def device_profile_key(identity, direct):
+    vendor, model, serial = identity
+    return f"{vendor}/{model}/{serial}/{'direct' if direct else 'buffered'}"
+
+
+def find_device_profile(identity, direct=False):
+    """Return the stored tuning profile for identity (vendor, model, serial), measured with
+    the same write mode (O_DIRECT or buffered). An exact serial match wins; otherwise any
+    stick of the same vendor/model is used."""
+    vendor, model, serial = identity
+    if not (vendor or model):
+        return None
+    profiles = load_device_profiles()
+    exact = profiles.get(device_profile_key(identity, direct))
+    if exact:
+        return exact
+    for key, profile in profiles.items():
+        # profiles from before the mode was recorded were measured with O_DIRECT
+        if key.startswith(f"{vendor}/{model}/") and profile.get('direct', True) == direct:
+            return profile
+    return None
+
+
+def save_device_profile(identity, profile):
+    vendor, model, serial = identity
+    if not (vendor or model):
+        return False
+    profiles = load_device_profiles()
+    profiles[device_profile_key(identity, profile['direct'])] = dict(profile, calibrated=time.asctime())
+    try:
+        with open(DEVICE_PROFILES, 'w', encoding='utf-8') as fh:
+            json.dump(profiles, fh, indent=2)
+        return True
+    except Exception:
+        return False
+
+
+def calibrate_device(devpath, log, probe_bytes=CALIBRATION_BYTES, direct=False):
+    """Time writes of probe_bytes at the start of devpath in the mode the write will use
+    (O_DIRECT, or buffered and flushed): first every CALIBRATION_CHUNK_SIZES size with one
+    write outstanding, then deeper queues with the fastest size, stopping once a deeper queue
+    is no faster. Returns the fastest as {'chunk_size', 'queue_depth', 'mbps', 'direct'},
+    or None. Overwrites the start of the device: only call it right before the device is written."""
+    size = max(CALIBRATION_CHUNK_SIZES)
+    buf = alloc_aligned_buffer(size)
+    buf[:] = os.urandom(size)  # incompressible, so controllers cannot cheat
+    view = memoryview(buf)
+    try:
+        fd, direct = open_device_for_write(devpath, direct=direct)
+    except OSError as e:
+        log(f"Calibration: cannot open {devpath}: {e}\n")
+        return None
+    log(f"Calibrating {devpath} ({'O_DIRECT' if direct else 'buffered'}, up to "
+        f"{len(CALIBRATION_CHUNK_SIZES) + len(CALIBRATION_QUEUE_DEPTHS) - 1} trials of "
+        f"{probe_bytes // (1024 * 1024)} MiB)...\n")
+
+    def trial(chunk_size, depth):
+        chunk = view[:chunk_size]
+        offsets = range(0, probe_bytes, chunk_size)
+        start = time.monotonic()
+        if depth == 1:
+            for off in offsets:
+                pwrite_all(fd, chunk, off)
+        else:
+            with ThreadPoolExecutor(max_workers=depth) as pool:
+                list(pool.map(lambda off: pwrite_all(fd, chunk, off), offsets))
+        os.fsync(fd)
+        mbps = probe_bytes / max(time.monotonic() - start, 1e-6) / 1e6
+        log(f"  {chunk_size // 1024} KiB x {depth} outstanding: {mbps:.1f} MB/s\n")
+        return mbps, chunk_size, depth
+
+    try:
+        best = max(trial(chunk_size, 1) for chunk_size in CALIBRATION_CHUNK_SIZES)
+        for depth in CALIBRATION_QUEUE_DEPTHS[1:]:
+            result = trial(best[1], depth)
+            if result[0] <= best[0]:
+                break
+            best = result
+    except OSError as e:
+        log(f"Calibration failed: {e}\n")
+        return None
+    finally:
+        os.close(fd)
+    mbps, chunk_size, depth = best
+    log(f"Fastest: {chunk_size // 1024} KiB chunks, {depth} outstanding ({mbps:.1f} MB/s).\n")
+    return {'chunk_size': chunk_size, 'queue_depth': depth, 'mbps': round(mbps, 1), 'direct': direct}
+
+
+def tuned_write_settings(devnode, log, direct=False, preserve=None):
+    """Return (chunk_size, queue_depth) for /dev/<devnode> written with or without O_DIRECT,
+    calibrating in that mode and saving a profile the first time a vendor/model is seen.
+    Calibration overwrites the start of the device; when that data still matters (a
+    differential write, a resume that reads the device), `preserve` names what relies on it:
+    only a stored profile is used then, else WRITE_CHUNK_SIZE with one outstanding."""
+    identity = get_device_identity(devnode)
+    profile = find_device_profile(identity, direct)
+    if profile:
+        log(f"Using tuned settings for {' '.join(p for p in identity[:2] if p)}: "
+            f"{profile['chunk_size'] // 1024} KiB chunks, {profile['queue_depth']} outstanding.\n")
+    elif preserve:
+        log(f"No tuned settings stored for this device model, and calibrating would overwrite data {preserve}; "
+            f"using {WRITE_CHUNK_SIZE // 1024} KiB chunks, 1 outstanding.\n")
+        return WRITE_CHUNK_SIZE, 1
+    else:
+        profile = calibrate_device(f"/dev/{devnode}", log, direct=direct)
+        if not profile:
+            return WRITE_CHUNK_SIZE, 1
+        if not save_device_profile(identity, profile):
+            log("Device reports no vendor/model; tuned settings are used for this write only.\n")
+    return profile['chunk_size'], profile['queue_depth']
+
+
+def decompress_command(iso_path):
+    """Return the argv of an installed command-line decompressor for iso_path, or None."""
+    kind = image_compression(iso_path)
+    if kind is None:
+        return None
+    for argv in DECOMPRESSORS[kind][0]:
+        if shutil.which(argv[0]):
+            return argv
+    return None
+
+
+def drop_device_cache(fd):
+    """Drop cached pages of the device behind fd (BLKFLSBUF, then posix_fadvise) so reads hit the media."""
+    try:
+        fcntl.ioctl(fd, BLKFLSBUF)
+    except OSError:
+        pass  # not a block device, or not root
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+
+def _libc_syncfs():
+    """Return libc's syncfs() via ctypes, or None."""
+    try:
+        fn = ctypes.CDLL(None, use_errno=True).syncfs
+        fn.argtypes = [ctypes.c_int]
+        return fn
+    except Exception:
+        return None
+
+
+def sync_mount(mount_point, log):
+    """Flush only the filesystem mounted at mount_point (syncfs), rather than a global sync that
+    also stalls every other device (sticks being written concurrently, the SD-card root fs).
+    Falls back to `sudo sync -f`. Returns True on success."""
+    start = time.monotonic()
+    syncfs = _libc_syncfs()
+    done = False
+    if syncfs is not None:
+        try:
+            fd = os.open(mount_point, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+        except OSError:
+            fd = None
+        if fd is not None:
+            try:
+                done = syncfs(fd) == 0
+            finally:
+                os.close(fd)
+    if not done:
+        r = subprocess.run(["sudo", "sync", "-f", mount_point], stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT, text=True)
+        if r.returncode != 0:
+            log(f"Flushing {mount_point} failed: {r.stdout.strip()}\n")
+            return False
+    log(f"Flushed {mount_point} in {time.monotonic() - start:.1f} s.\n")
+    return True
+
+
+def flush_block_device(devpath, log):
+    """Flush the dirty pages of one block device and drop its cached pages (fsync + BLKFLSBUF),
+    through `sudo blockdev --flushbufs` when the device cannot be opened here. Returns True on success."""
+    start = time.monotonic()
+    try:
+        fd = os.open(devpath, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+    except OSError:
+        fd = None
+    if fd is not None:
+        try:
+            os.fsync(fd)
+            drop_device_cache(fd)
+        except OSError as e:
+            log(f"Flushing {devpath} failed: {e}\n")
+            return False
+        finally:
+            os.close(fd)
+    else:
+        r = subprocess.run(["sudo", "blockdev", "--flushbufs", devpath], stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT, text=True)
+        if r.returncode != 0:
+            log(f"Flushing {devpath} failed: {r.stdout.strip()}\n")
+            return False
+    log(f"Flushed {devpath} in {time.monotonic() - start:.1f} s.\n")
+    return True
+
+
+def open_device_for_read(devpath, direct=True):
+    """Open devpath read-only, with O_DIRECT if requested and supported. Returns (fd, direct_enabled)."""
+    flags = os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0)
+    if direct and hasattr(os, 'O_DIRECT'):
+        try:
+            return os.open(devpath, flags | os.O_DIRECT), True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+    return os.open(devpath, flags), False
+
+
+def pread_full(fd, view, offset):
+    """Read into view from fd at offset, looping over short reads. Returns bytes read."""
+    got = 0
+    size = len(view)
+    while got < size:
+        n = os.preadv(fd, [view[got:]], offset + got)
+        if not n:
+            break
+        got += n
+    return got
+
+
+def chunk_manifest_path(image_path):
+    return str(image_path) + CHUNK_MANIFEST_SUFFIX
+
+
+def load_chunk_manifest(image_path, chunk_size):
+    """Return (digests, total) of the image's chunk manifest for chunk_size chunks: the
+    <image>.chunks.json beside it if it was made for the image file as it is now (same
+    DigestCache.key identity: device, inode, size, mtime and ctime), else one from the
+    DigestCache. (None, 0) if there is none."""
+    try:
+        identity = DigestCache.key(image_path)
+        with open(chunk_manifest_path(image_path), 'r', encoding='utf-8') as fh:
+            manifest = json.load(fh)
+        if (manifest.get('algorithm') == chunk_algorithm() and manifest.get('chunk_size') == chunk_size
+                and manifest.get('identity') == identity):
+            return manifest['chunks'], manifest['total']
+    except (OSError, ValueError, KeyError):
+        pass
+    return DigestCache().get_chunks(image_path, chunk_size)
+
+
+def save_chunk_manifest(image_path, chunk_size, digests, total, identity=None):
+    """Store a chunk manifest in the DigestCache and as <image>.chunks.json beside the image
+    (best effort: the image's directory may be read-only). identity is as for DigestCache.put."""
+    DigestCache().put(image_path, chunk_size=chunk_size, chunks=digests, total=total, identity=identity)
+    path = chunk_manifest_path(image_path)
+    try:
+        manifest = {'algorithm': chunk_algorithm(), 'chunk_size': chunk_size, 'total': total,
+                    'identity': identity or DigestCache.key(image_path), 'chunks': digests}
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as fh:
+            json.dump(manifest, fh)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def build_chunk_manifest(image_path, chunk_size, log, progress_cb=None, workers=MANIFEST_WORKERS, hot=False):
+    """Hash every chunk_size chunk of the (decompressed) image on `workers` threads and save the
+    result (save_chunk_manifest). hashlib releases the GIL, so this uses every core where one
+    whole-file digest can only use one. Raw images are read by the workers themselves at their
+    own offsets; compressed images are decompressed by one reader and hashed in the pool.
+    Hashed pages leave the page cache unless hot=True. Returns (digests, total), or (None, 0)."""
+    start = time.monotonic()
+    try:
+        identity = DigestCache.key(image_path)
+        if image_compression(image_path) is None:
+            digests, total = _hash_raw_chunks(image_path, chunk_size, progress_cb, workers, hot)
+        else:
+            digests, total = _hash_stream_chunks(image_path, chunk_size, progress_cb, workers, hot)
+    except OSError as e:
+        log(f"Could not hash image chunks: {e}\n")
+        return None, 0
+    elapsed = time.monotonic() - start
+    log(f"Chunk manifest: {len(digests)} chunks of {chunk_size // 1024} KiB hashed on {workers} thread{'s' if workers != 1 else ''} "
+        f"in {format_duration(elapsed)} ({total / max(elapsed, 1e-6) / 1e6:.1f} MB/s).\n")
+    save_chunk_manifest(image_path, chunk_size, digests, total, identity)
+    return digests, total
+
+
+def _hash_raw_chunks(image_path, chunk_size, progress_cb, workers, hot):
+    total = os.path.getsize(image_path)
+    nchunks = -(-total // chunk_size)
+    fd = os.open(image_path, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+    local = threading.local()
+    lock = threading.Lock()
+    state = {'done': 0, 'last_pct': -1}
+
+    def hash_chunk(i):
+        view = getattr(local, 'view', None)
+        if view is None:
+            view = local.view = memoryview(bytearray(chunk_size))
+        offset = i * chunk_size
+        n = pread_full(fd, view[:min(chunk_size, total - offset)], offset)
+        digest = chunk_digest(view[:n])
+        if not hot and hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, offset, n, os.POSIX_FADV_DONTNEED)
+        with lock:
+            state['done'] += n
+            pct = state['done'] * 100 // total if total else 100
+            if progress_cb and pct != state['last_pct']:
+                state['last_pct'] = pct
+                progress_cb(pct)
+        return digest
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(hash_chunk, range(nchunks))), total
+    finally:
+        os.close(fd)
+
+
+def _chunk_digest_of(buf, n):
+    return chunk_digest(memoryview(buf)[:n])
+
+
+def _hash_stream_chunks(image_path, chunk_size, progress_cb, workers, hot):
+    digests = []
+    pending = deque()
+    total = 0
+    # at most 2 * workers chunks are in the pool, so a buffer is free again 2 * workers + 1 chunks later
+    buffers = [bytearray(chunk_size) for _ in range(2 * workers + 1)]
+    with ImageSource(image_path, hot=hot) as src, ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            buf = buffers[(len(digests) + len(pending)) % len(buffers)]
+            n = read_full(src, memoryview(buf))
+            if not n:
+                break
+            pending.append(pool.submit(_chunk_digest_of, buf, n))
+            total += n
+            while len(pending) > 2 * workers:
+                digests.append(pending.popleft().result())
+            if progress_cb:
+                progress_cb(src.percent(total))
+        src.check()
+        digests.extend(f.result() for f in pending)
+    return digests, total
+
+
+def find_first_mismatch(devpath, chunk_digests, chunk_size, total, progress_cb=None, readers=VERIFY_READERS):
+    """Compare the first total bytes of devpath with chunk_digests (chunk_digest() hex digests
+    of the source, one per chunk_size chunk) and return the offset of the first chunk that differs,
+    or None if all match. Reads bypass the page cache (O_DIRECT, or BLKFLSBUF/fadvise when
+    O_DIRECT is unavailable) and chunks are striped across `readers` concurrent readers.
+    Raises OSError if the device cannot be read."""
+    bad = compare_device_chunks(devpath, chunk_digests, chunk_size, total, progress_cb, readers, first_only=True)
+    return bad[0] if bad else None
+
+
+def compare_device_chunks(devpath, chunk_digests, chunk_size, total, progress_cb=None, readers=VERIFY_READERS,
+                          first_only=False):
+    """Return the sorted offsets of the chunks of devpath that differ from chunk_digests (read
+    as in find_first_mismatch). With first_only=True readers stop past the first difference
+    and only that offset is returned."""
+    nchunks = len(chunk_digests)
+    readers = max(1, min(readers, nchunks))
+    lock = threading.Lock()
+    state = {'done': 0, 'first_bad': None, 'last_pct': -1, 'bad': []}
+    fd = os.open(devpath, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+    drop_device_cache(fd)
+    os.close(fd)
+
+    def read_stripe(k):
+        fd, direct = open_device_for_read(devpath)
+        view = memoryview(alloc_aligned_buffer(chunk_size))
+        try:
+            for i in range(k, nchunks, readers):
+                offset = i * chunk_size
+                with lock:
+                    if first_only and state['first_bad'] is not None and state['first_bad'] < offset:
+                        return
+                want = min(chunk_size, total - offset)
+                # O_DIRECT needs an aligned length; the tail is rounded up and hashed at its real size
+                length = -(-want // DIRECT_IO_ALIGN) * DIRECT_IO_ALIGN if direct else want
+                got = pread_full(fd, view[:length], offset)
+                if not direct and hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(fd, offset, want, os.POSIX_FADV_DONTNEED)
+                if got < want or chunk_digest(view[:want]) != chunk_digests[i]:
+                    with lock:
+                        state['bad'].append(offset)
+                        if state['first_bad'] is None or offset < state['first_bad']:
+                            state['first_bad'] = offset
+                    if first_only:
+                        return
+                with lock:
+                    state['done'] += want
+                    pct = min(100, state['done'] * 100 // total) if total else 100
+                    if progress_cb and pct != state['last_pct']:
+                        state['last_pct'] = pct
+                        progress_cb(pct)
+        finally:
+            os.close(fd)
+
+    with ThreadPoolExecutor(max_workers=readers) as pool:
+        for fut in [pool.submit(read_stripe, k) for k in range(readers)]:
+            fut.result()
+    if first_only:
+        return [state['first_bad']] if state['first_bad'] is not None else []
+    return sorted(state['bad'])
+
+
+def verify_device(devpath, chunk_digests, chunk_size, total, log, progress_cb=None, readers=VERIFY_READERS):
+    """Read the first total bytes of devpath back (see find_first_mismatch) and compare them with
+    the image's per-chunk digests. Returns True if the device matches; the first mismatching
+    offset is logged otherwise."""
+    start = time.monotonic()
+    try:
+        first_bad = find_first_mismatch(devpath, chunk_digests, chunk_size, total, progress_cb, readers)
+    except OSError as e:
+        log(f"Verify {devpath}: read failed: {e}\n")
+        return False
+    if first_bad is not None:
+        log(f"Verify {devpath}: MISMATCH - first differing chunk starts at byte offset {first_bad}.\n")
+        return False
+    mbps = total / max(time.monotonic() - start, 1e-6) / 1e6
+    log(f"Verify {devpath}: {total} bytes match the image ({min(readers, len(chunk_digests))} readers, {mbps:.1f} MB/s).\n")
+    return True
+
+
+class WriteJournal:
+    """On-disk record of the part of an image write that is durably on the device,
+    keyed by device serial and image hash, so an interrupted write can be resumed.
+    The completed extent is stored as the chunk_digest() of each chunk_size chunk from byte 0."""
+
+    def __init__(self, serial, image_id, chunk_size, path=WRITE_JOURNAL):
+        self.key = f"{serial}:{image_id}"
+        self.chunk_size = chunk_size
+        self.path = path
+
+    def _load_all(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as fh:
+                return json.load(fh)
+        except Exception:
+            return {}
+
+    def _save_all(self, entries):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as fh:
+            json.dump(entries, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.path)
+
+    def load(self):
+        """Return the chunk digests of the completed extent, or [] if there is nothing to resume."""
+        entry = self._load_all().get(self.key)
+        if (not entry or entry.get('chunk_size') != self.chunk_size
+                or entry.get('algorithm', 'sha256') != chunk_algorithm()):
+            return []
+        return entry.get('digests', [])
+
+    def record(self, digests):
+        entries = self._load_all()
+        entries[self.key] = {'chunk_size': self.chunk_size, 'algorithm': chunk_algorithm(), 'digests': digests,
+                             'updated': time.asctime()}
+        try:
+            self._save_all(entries)
+        except OSError:
+            pass  # resuming is best effort; never fail the write over it
+
+    def clear(self):
+        entries = self._load_all()
+        if entries.pop(self.key, None) is not None:
+            try:
+                self._save_all(entries)
+            except OSError:
+                pass
+
+    @classmethod
+    def stored_chunk_size(cls, serial, image_id, path=WRITE_JOURNAL):
+        """Chunk size of a pending journal entry for this device/image, or None."""
+        entry = cls(serial, image_id, 0, path)._load_all().get(f"{serial}:{image_id}")
+        return entry.get('chunk_size') if entry else None
+
+
+class ManifestJournal:
+    """Stand-in for a WriteJournal when the device reports no serial number to key one by.
+    The image's chunk manifest says what a completed write looks like, so the device itself
+    shows how far an earlier write of this image got (the check stops at the first chunk that
+    differs, so a blank or different stick costs a few chunk reads)."""
+
+    def __init__(self, chunk_digests):
+        self.chunk_digests = chunk_digests
+
+    def load(self):
+        return list(self.chunk_digests)
+
+    def record(self, digests):
+        pass
+
+    def clear(self):
+        pass
+
+
+class DigestCache:
+    """Persistent cache of image digests, so an image that was hashed before is not read again.
+
+    Entries are keyed by the file's identity (device, inode, size, mtime_ns, ctime_ns): any
+    change to the file, including an in-place rewrite or a replacement under the same name,
+    misses. Each entry holds {algorithm: hex digest} and optionally a chunk manifest (the
+    chunk_digest() of every chunk_size chunk of the decompressed image, as used for verification).
+    The least recently used entries beyond DIGEST_CACHE_ENTRIES are dropped."""
+
+    def __init__(self, path=DIGEST_CACHE):
+        self.path = path
+
+    @staticmethod
+    def key(path):
+        st = os.stat(path)
+        return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}:{st.st_ctime_ns}"
+
+    def _load_all(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as fh:
+                return json.load(fh)
+        except Exception:
+            return {}
+
+    def _save_all(self, entries):
+        if len(entries) > DIGEST_CACHE_ENTRIES:
+            keep = sorted(entries, key=lambda k: entries[k].get('used', 0))[-DIGEST_CACHE_ENTRIES:]
+            entries = {k: entries[k] for k in keep}
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as fh:
+            json.dump(entries, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.path)
+
+    def _entry(self, path):
+        try:
+            return self._load_all().get(self.key(path))
+        except OSError:
+            return None
+
+    def get(self, path, algorithm='sha256'):
+        """Cached hex digest of the file at path, or None."""
+        entry = self._entry(path)
+        return entry.get('digests', {}).get(algorithm) if entry else None
+
+    def get_chunks(self, path, chunk_size):
+        """Cached (chunk manifest, bytes it covers) for chunk_size chunks, or (None, 0)."""
+        entry = self._entry(path)
+        if (entry and entry.get('chunk_size') == chunk_size and entry.get('chunks') is not None
+                and entry.get('chunk_algorithm', 'sha256') == chunk_algorithm()):
+            return entry['chunks'], entry.get('chunks_total') or 0
+        return None, 0
+
+    def put(self, path, algorithm=None, digest=None, chunk_size=None, chunks=None, total=None, identity=None):
+        """Record a digest and/or a chunk manifest (covering total bytes) for the file at path
+        (best effort). identity is the key() taken before the file was read, so a file changed
+        while it was being hashed is not cached under its new state; default: as it is now."""
+        try:
+            key = identity or self.key(path)
+            entries = self._load_all()
+            # older states of the same file can never hit again
+            entries = {k: e for k, e in entries.items() if e.get('path') != path or k == key}
+            entry = entries.setdefault(key, {'path': path, 'digests': {}})
+            if digest:
+                entry['digests'][algorithm] = digest.strip().lower()
+            if chunks is not None:
+                entry['chunk_size'], entry['chunks'], entry['chunks_total'] = chunk_size, chunks, total
+                entry['chunk_algorithm'] = chunk_algorithm()
+            entry['used'] = time.time()
+            self._save_all(entries)
+        except OSError:
+            pass  # the cache only saves time; never fail a job over it
+
+
+def image_fingerprint(path):
+    """Cheap stand-in for the image hash: sha256 over size, mtime and the first and last MiB."""
+    st = os.stat(path)
+    h = hashlib.sha256(f"{st.st_size}:{st.st_mtime_ns}".encode())
+    with open(path, 'rb') as fh:
+        h.update(fh.read(1024 * 1024))
+        fh.seek(max(0, st.st_size - 1024 * 1024))
+        h.update(fh.read(1024 * 1024))
+    return "fp-" + h.hexdigest()
+
+
+def probe_image_type(path):
+    """Return (type, volume_id) of an image file: the compression for compressed images,
+    otherwise ISO 9660 (with its volume ID), GPT/MBR disk image or raw image."""
+    kind = image_compression(path)
+    if kind:
+        return f"{kind[1:]}-compressed image", None
+    try:
+        with open(path, 'rb') as fh:
+            head = fh.read(0x8028 + 32)
+    except OSError:
+        return "unknown", None
+    if head[0x8001:0x8006] == b'CD001':
+        volume_id = head[0x8028:0x8028 + 32].decode('ascii', errors='ignore').strip()
+        return "ISO 9660", volume_id or None
+    if head[512:520] == b'EFI PART':
+        return "disk image (GPT)", None
+    if head[510:512] == b'\x55\xaa':
+        return "disk image (MBR)", None
+    return "raw image", None
+
+
+def link_or_copy(src, dst, allow_copy=False):
+    """Place src at dst as cheaply as the filesystem allows: a hardlink or a reflink (FICLONE,
+    shared extents on btrfs/xfs). A full copy is only made with allow_copy=True and when the
+    destination keeps STAGE_RAM_RESERVE free afterwards. Returns the method used; raises
+    OSError if none is possible."""
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except OSError:
+        pass
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return 'reflink'
+        except OSError:
+            pass
+    if not allow_copy:
+        os.unlink(dst)
+        raise OSError(errno.EXDEV, "cannot be hardlinked or reflinked into the library (copying is off)")
+    if shutil.disk_usage(os.path.dirname(dst)).free < os.path.getsize(src) + STAGE_RAM_RESERVE:
+        os.unlink(dst)
+        raise OSError(errno.ENOSPC, "not enough free space to copy it into the library")
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        shutil.copyfileobj(fsrc, fdst, HASH_CHUNK_SIZE)
+    return 'copy'
+
+
+class ImageStore:
+    """Content-addressed library of the images that have been flashed.
+
+    Images live at <root>/objects/<sha256>/<original file name>, so the name (and with it
+    compression and checksum lookups) is kept, and are placed there with link_or_copy (full
+    copies only when 'copy_images' is on). index.json records name, size, detected type, ISO
+    volume ID, last use and the object's inode/size/mtime per digest, plus the disk budget.
+    A hardlinked object shares its inode with the original, so an object whose identity has
+    changed since it was stored (the original rewritten in place) no longer matches its digest
+    and is dropped. Adding an image evicts the least recently used others until the store fits
+    the budget; hardlinked objects whose original still exists cost no space."""
+
+    def __init__(self, root=IMAGE_STORE):
+        self.root = Path(root)
+        self.index_path = self.root / 'index.json'
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as fh:
+                return json.load(fh)
+        except Exception:
+            return {'budget_bytes': IMAGE_STORE_BUDGET_GB * 2**30, 'images': {}}
+
+    def _save(self, index):
+        tmp = f"{self.index_path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as fh:
+            json.dump(index, fh, indent=2)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.index_path)
+
+    def object_path(self, digest, entry):
+        return self.root / 'objects' / digest / entry['name']
+
+    @staticmethod
+    def identity(path):
+        """inode:size:mtime_ns of a stored object (not ctime: linking changes it)."""
+        st = os.stat(path)
+        return f"{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+    def _intact(self, digest, entry):
+        try:
+            return self.identity(self.object_path(digest, entry)) == entry.get('identity')
+        except OSError:
+            return False
+
+    def _prune(self, index):
+        """Drop the entries whose object is gone or changed; returns whether any were."""
+        images = index.get('images', {})
+        stale = [d for d, e in images.items() if not self._intact(d, e)]
+        for digest in stale:
+            shutil.rmtree(str(self.object_path(digest, images.pop(digest)).parent), ignore_errors=True)
+        return bool(stale)
+
+    def _pruned_index(self):
+        index = self._load()
+        if self._prune(index):
+            try:
+                self._save(index)
+            except OSError:
+                pass
+        return index
+
+    @property
+    def copy_images(self):
+        return self._load().get('copy_images', False)
+
+    def set_copy_images(self, enabled):
+        index = self._load()
+        index['copy_images'] = bool(enabled)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._save(index)
+
+    @property
+    def budget(self):
+        return self._load().get('budget_bytes', IMAGE_STORE_BUDGET_GB * 2**30)
+
+    def set_budget(self, budget_bytes, log):
+        index = self._load()
+        index['budget_bytes'] = budget_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._evict(index, log)
+        self._save(index)
+
+    def recent(self, limit=RECENT_IMAGES):
+        """The most recently used images still present and unchanged: dicts of the index fields
+        plus sha256 and path."""
+        images = []
+        for digest, entry in self._pruned_index().get('images', {}).items():
+            images.append(dict(entry, sha256=digest, path=str(self.object_path(digest, entry))))
+        images.sort(key=lambda e: e.get('last_used', 0), reverse=True)
+        return images[:limit]
+
+    def lookup(self, digest):
+        """Index entry (as in recent()) of the stored image with this SHA-256, or None (also if
+        the object changed since it was stored)."""
+        entry = self._pruned_index().get('images', {}).get(digest)
+        if entry:
+            return dict(entry, sha256=digest, path=str(self.object_path(digest, entry)))
+        return None
+
+    def touch(self, digest):
+        index = self._load()
+        entry = index.get('images', {}).get(digest)
+        if entry:
+            entry['last_used'] = time.time()
+            try:
+                self._save(index)
+            except OSError:
+                pass
+
+    def add(self, path, digest, log):
+        """Store the image at path under its SHA-256 digest (already known: the caller hashed it
+        while writing). An image already in the store is only marked as used. Returns the stored path."""
+        index = self._load()
+        self._prune(index)
+        images = index.setdefault('images', {})
+        entry = images.get(digest)
+        if entry:
+            entry['last_used'] = time.time()
+            self._save(index)
+            return str(self.object_path(digest, entry))
+        name = Path(path).name
+        image_type, volume_id = probe_image_type(path)
+        entry = {'name': name, 'size': os.path.getsize(path), 'type': image_type,
+                 'volume_id': volume_id, 'last_used': time.time()}
+        obj = self.object_path(digest, entry)
+        obj.parent.mkdir(parents=True, exist_ok=True)
+        partial = obj.with_name('.partial-' + name)
+        try:
+            if partial.exists():
+                partial.unlink()  # left over from an interrupted copy
+            method = link_or_copy(path, str(partial), allow_copy=index.get('copy_images', False))
+            os.replace(str(partial), str(obj))
+            entry['identity'] = self.identity(obj)
+        except OSError:
+            try:
+                partial.unlink()
+            except OSError:
+                pass
+            raise
+        images[digest] = dict(entry, method=method)
+        log(f"Image library: stored {name} ({image_type}{', ' + volume_id if volume_id else ''}) by {method}.\n")
+        self._evict(index, log, keep=digest)
+        self._save(index)
+        return str(obj)
+
+    def _evict(self, index, log, keep=None):
+        """Drop least recently used images until the space the store holds alone fits the budget."""
+        images = index.get('images', {})
+
+        def cost(digest):
+            try:
+                st = self.object_path(digest, images[digest]).stat()
+            except OSError:
+                return 0
+            return st.st_size if st.st_nlink == 1 else 0  # other links keep the data anyway
+
+        used = sum(cost(d) for d in images)
+        budget = index.get('budget_bytes', IMAGE_STORE_BUDGET_GB * 2**30)
+        for digest in sorted(images, key=lambda d: images[d].get('last_used', 0)):
+            if used <= budget:
+                break
+            if digest == keep:
+                continue
+            used -= cost(digest)
+            shutil.rmtree(str(self.object_path(digest, images[digest]).parent), ignore_errors=True)
+            log(f"Image library: evicted {images.pop(digest)['name']} (over the "
+                f"{budget / 2**30:.1f} GiB budget).\n")
+
+
+class BlockMap:
+    """Block map of an image in the bmaptool .bmap format: the ranges of blocks that carry data,
+    each with a checksum. Blocks outside the ranges are "don't care" and are not written,
+    which is what makes flashing large, mostly-empty disk images fast.
+    ranges is a list of [first_block, last_block, checksum] (checksum may be None)."""
+
+    def __init__(self, image_size, block_size, ranges, checksum_type='sha256', source=None):
+        self.image_size = image_size
+        self.block_size = block_size
+        self.ranges = ranges
+        self.checksum_type = checksum_type
+        self.source = source  # the .bmap file, or None for a generated map
+
+    @property
+    def mapped_bytes(self):
+        return sum(end - start for start, end, _ in self.extents())
+
+    def extents(self):
+        """Yield (start, end, checksum) byte extents of the mapped ranges, clipped to the image size."""
+        for first, last, checksum in self.ranges:
+            yield first * self.block_size, min((last + 1) * self.block_size, self.image_size), checksum
+
+    @classmethod
+    def load(cls, path):
+        """Parse a .bmap file (format 1.x or 2.x). Raises ValueError if it is malformed or its
+        own checksum does not match."""
+        with open(path, 'rb') as fh:
+            raw = fh.read()
+        try:
+            root = ET.fromstring(raw)
+        except ET.ParseError as e:
+            raise ValueError(f"not a valid bmap file: {e}")
+        if root.tag != 'bmap':
+            raise ValueError("not a bmap file")
+        # format 1.x has sha1 range checksums and no ChecksumType element
+        checksum_type = (root.findtext('ChecksumType') or 'sha1').strip().lower()
+        if checksum_type not in hashlib.algorithms_available:
+            raise ValueError(f"unsupported bmap checksum type {checksum_type}")
+        file_checksum = root.findtext('BmapFileChecksum') or root.findtext('BmapFileSHA1')
+        if file_checksum:
+            # the checksum is taken over the file with its own value replaced by zeros
+            file_checksum = file_checksum.strip()
+            zeroed = raw.replace(file_checksum.encode(), b'0' * len(file_checksum), 1)
+            if hashlib.new(checksum_type, zeroed).hexdigest() != file_checksum:
+                raise ValueError("bmap file checksum mismatch (file is corrupt or was edited)")
+        try:
+            image_size = int(root.findtext('ImageSize'))
+            block_size = int(root.findtext('BlockSize'))
+            ranges = []
+            for el in root.find('BlockMap').findall('Range'):
+                first, _, last = el.text.strip().partition('-')
+                checksum = el.get('chksum') or el.get('sha1')
+                ranges.append([int(first), int(last or first), checksum])
+        except (TypeError, ValueError, AttributeError):
+            raise ValueError("bmap file is missing ImageSize, BlockSize or BlockMap")
+        return cls(image_size, block_size, ranges, checksum_type, source=path)
+
+    @classmethod
+    def generate(cls, image_path, log, block_size=BMAP_BLOCK_SIZE):
+        """Build a block map for a raw image from its data extents (SEEK_DATA/SEEK_HOLE): only
+        holes are left unmapped, and every mapped range gets a sha256 checksum. All-zero blocks
+        inside the data are mapped too: the image's zeros (free-cluster tables, inode tables,
+        GPT padding) must overwrite whatever the device held there."""
+        size = os.path.getsize(image_path)
+        fd = os.open(image_path, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+        try:
+            extents = []
+            if hasattr(os, 'SEEK_DATA'):
+                pos = 0
+                try:
+                    while pos < size:
+                        data = os.lseek(fd, pos, os.SEEK_DATA)
+                        hole = os.lseek(fd, data, os.SEEK_HOLE)
+                        extents.append((data, hole))
+                        pos = hole
+                except OSError as e:
+                    if e.errno != errno.ENXIO:  # ENXIO: no data after pos
+                        extents = [(0, size)]
+            else:
+                extents = [(0, size)]
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            ranges = []
+            current = None  # [first, last, hash] of the range being built
+            scanned = 0
+            view = memoryview(alloc_aligned_buffer(HASH_CHUNK_SIZE))
+            for start, end in extents:
+                offset = max(scanned, start - start % block_size)
+                end = min(size, -(-end // block_size) * block_size)
+                if offset >= end:
+                    continue
+                scanned = end
+                if current is None or current[1] != offset // block_size - 1:
+                    # a hole lies between this extent and the last one
+                    if current is not None:
+                        ranges.append(current)
+                    current = [offset // block_size, offset // block_size, hashlib.sha256()]
+                current[1] = (end - 1) // block_size
+                while offset < end:
+                    n = pread_full(fd, view[:min(HASH_CHUNK_SIZE, end - offset)], offset)
+                    if not n:
+                        break
+                    current[2].update(view[:n])
+                    offset += n
+            if current is not None:
+                ranges.append(current)
+        finally:
+            os.close(fd)
+        for r in ranges:
+            r[2] = r[2].hexdigest()
+        bmap = cls(size, block_size, ranges)
+        log(f"Generated block map: {bmap.mapped_bytes} of {size} bytes mapped in {len(ranges)} ranges.\n")
+        return bmap
+
+    @classmethod
+    def for_image(cls, image_path, log):
+        """Return the block map for image_path: the .bmap file next to it if there is one and
+        it was made for an image of this size, else a generated map for raw images. Returns
+        None if neither is available."""
+        path = find_bmap_file(image_path)
+        kind = image_compression(image_path)
+        if path:
+            try:
+                bmap = cls.load(path)
+                # a stale .bmap beside a newer image would write (and verify) the wrong ranges
+                size = uncompressed_image_size(image_path, kind) if kind else os.path.getsize(image_path)
+                if size is not None and size != bmap.image_size:
+                    raise ValueError(f"it maps a {bmap.image_size}-byte image, this image is {size} bytes")
+            except (OSError, ValueError) as e:
+                log(f"Ignoring block map {path}: {e}\n")
+            else:
+                log(f"Using block map {path}: {bmap.mapped_bytes} of {bmap.image_size} bytes mapped.\n")
+                return bmap
+        if kind:
+            log("No usable .bmap file next to the compressed image; writing the full image.\n")
+            return None
+        try:
+            return cls.generate(image_path, log)
+        except OSError as e:
+            log(f"Could not scan the image for a block map: {e}\n")
+            return None
+
+
+def find_bmap_file(image_path):
+    """Return the .bmap file that belongs to image_path, or None.
+    Looks for <image>.bmap and, for compressed images, the name without the compression suffix
+    (foo.img.xz -> foo.img.bmap, then foo.bmap)."""
+    p = Path(image_path)
+    candidates = [p.with_name(p.name + '.bmap')]
+    if image_compression(image_path):
+        p = p.with_suffix('')
+        candidates.append(p.with_name(p.name + '.bmap'))
+    candidates.append(p.with_suffix('.bmap'))
+    for candidate in candidates:
+        if candidate.is_file():
+            return str(candidate)
+    return None
+
 
-    # build command
-    cmd = build_mkfs_command(mkcmd, fstype_key, devpath, label)
-    log(f"Running: {' '.join(cmd)}\n")
+def write_image_bmap(src_path, devpath, bmap, log, progress_cb=None, chunk_size=WRITE_CHUNK_SIZE, direct=False,
+                     source_hash=None, monitor=None):
+    """Write only the mapped ranges of src_path (a BlockMap) to devpath, skipping the rest of the image.
+    Every range's checksum is checked as it is written; a mismatch fails the write.
+    Ranges without a checksum get the computed one filled in (for verify_bmap).
+    source_hash and monitor work as in write_image_native.
+    Returns the number of mapped bytes written, or None on failure."""
+    try:
+        src = ImageSource(src_path, hasher=source_hash)
+    except OSError as e:
+        log(f"Cannot open image: {e}\n")
+        return None
+    mapped = bmap.mapped_bytes
+    view = memoryview(alloc_aligned_buffer(chunk_size))
+    pos = 0  # position in the (decompressed) image stream
+    written = 0
+    fd = None
+    try:
+        fd, direct = open_device_for_write(devpath, direct)
+        limiter = None if direct else WritebackLimiter(fd)
+        log(f"Block map writer: {devpath} opened ({'O_DIRECT' if direct else 'buffered'}, "
+            f"{mapped} of {bmap.image_size} bytes mapped).\n")
+        last_pct = -1
+        with src:
+            for i, (start, end, checksum) in enumerate(bmap.extents()):
+                if start > pos:
+                    src.skip(start - pos, view)
+                    pos = start
+                h = hashlib.new(bmap.checksum_type)
+                while pos < end:
+                    n = read_full(src, view[:min(chunk_size, end - pos)])
+                    if not n:
+                        raise OSError(errno.EIO, "image ended inside a mapped range")
+                    h.update(view[:n])
+                    if direct and (n % DIRECT_IO_ALIGN or pos % DIRECT_IO_ALIGN):
+                        clear_direct_flag(fd)
+                        direct = False
+                    pwrite_all(fd, view[:n], pos)
+                    pos += n
+                    written += n
+                    if limiter is not None:
+                        # gaps between ranges hold no dirty pages, so flushing across them is free
+                        limiter.advance(pos)
+                    if monitor is not None:
+                        monitor.update(written)
+                    pct = written * 100 // mapped if mapped else 100
+                    if progress_cb and pct != last_pct:
+                        last_pct = pct
+                        progress_cb(pct)
+                if checksum is None:
+                    bmap.ranges[i][2] = h.hexdigest()
+                elif h.hexdigest() != checksum:
+                    raise OSError(errno.EIO, f"checksum mismatch in blocks {bmap.ranges[i][0]}-{bmap.ranges[i][1]} "
+                                             f"(the image is corrupt or does not match the block map)")
+            if pos < bmap.image_size:
+                # read the image to its end so a corrupt compressed stream is still detected
+                src.skip(bmap.image_size - pos, view)
+            if read_full(src, view[:1]):
+                # only reachable for gzip/bzip2 images, whose size is unknown until read
+                raise OSError(errno.EINVAL, f"the image is longer than the {bmap.image_size} bytes "
+                                            f"its block map describes")
+            src.check()
+        log("Flushing device...\n")
+        os.fsync(fd)
+        log(f"Wrote {written} mapped bytes of {bmap.image_size} to {devpath} "
+            f"({100 - (written * 100 // bmap.image_size if bmap.image_size else 100)}% skipped as unmapped).\n")
+        return written
+    except OSError as e:
+        log(f"Write failed at byte offset {pos}: {e}\n")
+        return None
+    finally:
+        src.close()
+        if fd is not None:
+            os.close(fd)
+
+
+def verify_bmap(devpath, bmap, log, progress_cb=None):
+    """Read the mapped ranges of a BlockMap back from devpath and compare their checksums.
+    Returns True if every range matches; the first mismatching range is logged otherwise."""
+    start_time = time.monotonic()
+    mapped = bmap.mapped_bytes
+    done = 0
+    last_pct = -1
+    try:
+        fd = os.open(devpath, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+        drop_device_cache(fd)
+        os.close(fd)
+        fd, direct = open_device_for_read(devpath)
+    except OSError as e:
+        log(f"Verify {devpath}: read failed: {e}\n")
+        return False
+    view = memoryview(alloc_aligned_buffer(HASH_CHUNK_SIZE))
+    try:
+        for i, (start, end, checksum) in enumerate(bmap.extents()):
+            h = hashlib.new(bmap.checksum_type)
+            offset = start
+            while offset < end:
+                want = min(HASH_CHUNK_SIZE, end - offset)
+                # O_DIRECT needs an aligned length; the tail is rounded up and hashed at its real size
+                length = -(-want // DIRECT_IO_ALIGN) * DIRECT_IO_ALIGN if direct else want
+                got = pread_full(fd, view[:length], offset)
+                if got < want:
+                    break
+                h.update(view[:want])
+                offset += want
+                done += want
+                pct = done * 100 // mapped if mapped else 100
+                if progress_cb and pct != last_pct:
+                    last_pct = pct
+                    progress_cb(pct)
+            if offset < end or h.hexdigest() != checksum:
+                log(f"Verify {devpath}: MISMATCH in mapped blocks {bmap.ranges[i][0]}-{bmap.ranges[i][1]} "
+                    f"(byte offset {start}).\n")
+                return False
+    except OSError as e:
+        log(f"Verify {devpath}: read failed: {e}\n")
+        return False
+    finally:
+        os.close(fd)
+    mbps = mapped / max(time.monotonic() - start_time, 1e-6) / 1e6
+    log(f"Verify {devpath}: {mapped} mapped bytes in {len(bmap.ranges)} ranges match the image ({mbps:.1f} MB/s).\n")
+    return True
 
-    # phase 2: starting mkfs
-    if progress_cb:
-        progress_cb(60)
 
+def read_proc_io(pid):
+    """Return the counters in /proc/<pid>/io as a dict, or None if they cannot be read
+    (process gone, or owned by another user such as sudo'd dd)."""
     try:
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-        # while process runs, increment progress slowly up to 95
-        pct = 60
-        while True:
-            line = p.stdout.readline()
-            if line:
-                log(line)
-            if p.poll() is not None:
-                break
-            # bump progress a bit to show activity
-            pct = min(95, pct + 1)
-            if progress_cb:
+        with open(f"/proc/{pid}/io", 'r') as fh:
+            return {k.strip(): int(v) for k, v in (line.split(':', 1) for line in fh if ':' in line)}
+    except (OSError, ValueError):
+        return None
+
+
+def child_pids(pid):
+    """Return the pids of the direct children of pid, from /proc/*/stat (readable by any user)."""
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", 'r') as fh:
+                stat = fh.read()
+        except OSError:
+            continue
+        # comm may contain spaces; state and ppid follow its closing parenthesis
+        fields = stat[stat.rfind(')') + 2:].split()
+        if len(fields) > 1 and fields[1] == str(pid):
+            children.append(int(entry))
+    return children
+
+
+def device_bytes_written(devpath, discards=False):
+    """Total bytes written to the block device since boot (sectors written in
+    /sys/class/block/<dev>/stat, always 512-byte units), or None if unavailable.
+    With discards=True, discarded sectors (kernel 4.18+) are counted as well."""
+    try:
+        with open(f"/sys/class/block/{os.path.basename(devpath)}/stat", 'r') as fh:
+            fields = fh.read().split()
+        sectors = int(fields[6])
+        if discards and len(fields) > 13:
+            sectors += int(fields[13])
+        return sectors * 512
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class KernelProgressSampler:
+    """Samples the progress of an external writer (dd) from kernel counters at a fixed rate,
+    independent of what the child prints:
+    - accepted: bytes the kernel accepted from the writer (wchar in /proc/<pid>/io). sudo'd
+      dd is usually not readable by us, so the process feeding it (feeder_pid) is used instead.
+    - on_device: bytes that actually reached the device (sectors written in /sys/class/block).
+    callback(accepted, on_device, read) gets either count as None when it is unavailable;
+    read is the feeder's rchar (bytes of the image file it consumed)."""
+
+    def __init__(self, devpath, writer_pid, callback, feeder_pid=None, interval=PROGRESS_SAMPLE_INTERVAL):
+        self._devpath = devpath
+        self._writer_pid = writer_pid
+        self._feeder_pid = feeder_pid
+        self._callback = callback
+        self._interval = interval
+        self._io_pid = None
+        self._base = device_bytes_written(devpath)
+        self.accepted = None
+        self.on_device = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _writer_io(self):
+        if self._io_pid is None:
+            # sudo itself is a setuid process; the writer is the sudo'd child
+            for pid in [self._writer_pid] + child_pids(self._writer_pid):
+                try:
+                    with open(f"/proc/{pid}/comm", 'r') as fh:
+                        if fh.read().strip() == 'sudo':
+                            continue
+                except OSError:
+                    continue
+                if read_proc_io(pid) is not None:
+                    self._io_pid = pid
+                    break
+            else:
+                return None
+        return read_proc_io(self._io_pid)
+
+    def sample(self):
+        io = self._writer_io()
+        feeder = read_proc_io(self._feeder_pid) if self._feeder_pid else None
+        if io is not None:
+            self.accepted = io['wchar']
+        elif feeder is not None:
+            self.accepted = feeder['wchar']
+        written = device_bytes_written(self._devpath)
+        if written is not None and self._base is not None:
+            self.on_device = written - self._base
+        self._callback(self.accepted, self.on_device, feeder['rchar'] if feeder else None)
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.sample()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=2)
+
+
+def format_duration(seconds):
+    """Format seconds as m:ss, or h:mm:ss from an hour up."""
+    h, rem = divmod(int(seconds), 3600)
+    m, s = divmod(rem, 60)
+    return f"{h}:{m:02d}:{s:02d}" if h else f"{m}:{s:02d}"
+
+
+def device_write_probe(devpath):
+    """Return a probe() for ThroughputMonitor giving the bytes written (or discarded, as mkfs
+    does first) on devpath from now on; it returns None while the device has no block statistics."""
+    base = device_bytes_written(devpath, discards=True)
+
+    def probe():
+        now = device_bytes_written(devpath, discards=True)
+        return None if now is None or base is None else now - base
+    return probe
+
+
+class ThroughputMonitor:
+    """Throughput telemetry for one long-running job (write, hash, copy, format).
+
+    Records a time series of (seconds since start, bytes done) every interval seconds and
+    derives the current and EWMA throughput, an ETA (when the total is known) and stall
+    detection: no progress for stall_seconds is logged as a warning, since a stick that has
+    run out of SLC cache or sits on a bad USB port otherwise just looks hung.
+    Bytes done come from update() calls or, with a probe, from sampling probe() (e.g. bytes
+    written to the device per device_write_probe). The sampler runs in its own thread, so a
+    job that stops reporting is still noticed. Each sample is passed to callback(stats), a dict
+    with job, done, total, mbps, ewma_mbps, eta, stalled, stalled_for and finished."""
+
+    def __init__(self, job, total=None, callback=None, log=None, probe=None,
+                 interval=TELEMETRY_INTERVAL, stall_seconds=STALL_SECONDS, alpha=TELEMETRY_EWMA_ALPHA):
+        self.job = job
+        self.total = total
+        self.samples = []
+        self._callback = callback
+        self._log = log
+        self._probe = probe
+        self._interval = interval
+        self._stall_seconds = stall_seconds
+        self._alpha = alpha
+        self._done = 0
+        self._rate = 0.0
+        self._ewma = None
+        self._peak = 0.0
+        self._start = None
+        self._last_change = None
+        self._stalled = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def update(self, done):
+        """Report the cumulative bytes done."""
+        self._done = done
+
+    def start(self):
+        self._start = self._last_change = time.monotonic()
+        self.samples.append((0.0, 0))
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self._sample()
+
+    def _sample(self):
+        now = time.monotonic()
+        if self._probe is not None:
+            done = self._probe()
+            if done is None:
+                return  # nothing to measure (no block statistics); no rate, no stall
+            self._done = done
+        done = self._done
+        t = now - self._start
+        prev_t, prev_done = self.samples[-1]
+        self.samples.append((t, done))
+        self._rate = max(0, done - prev_done) / max(t - prev_t, 1e-6)
+        self._peak = max(self._peak, self._rate)
+        self._ewma = self._rate if self._ewma is None else self._alpha * self._rate + (1 - self._alpha) * self._ewma
+        if done != prev_done:
+            if self._stalled and self._log:
+                self._log(f"{self.job}: data is moving again after {int(now - self._last_change)} s.\n")
+            self._stalled = False
+            self._last_change = now
+        elif not self._stalled and now - self._last_change >= self._stall_seconds:
+            self._stalled = True
+            if self._log:
+                self._log(f"⚠️  {self.job}: no progress for {int(now - self._last_change)} s "
+                          f"(device cache exhausted, bad USB port or cable?)\n")
+        if self._callback:
+            self._callback(self.stats())
+
+    def stats(self, finished=False):
+        now = time.monotonic()
+        ewma = self._ewma or 0.0
+        eta = None
+        if self.total and ewma > 0 and not finished:
+            eta = max(0, self.total - self._done) / ewma
+        return {'job': self.job, 'done': self._done, 'total': self.total,
+                'mbps': self._rate / 1e6, 'ewma_mbps': ewma / 1e6, 'eta': eta,
+                'stalled': self._stalled, 'stalled_for': now - self._last_change if self._stalled else 0,
+                'finished': finished}
+
+    def stop(self):
+        """Stop sampling, log a summary and report the final stats."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=2)
+        if self._start is None:
+            return None
+        elapsed = time.monotonic() - self._start
+        stats = self.stats(finished=True)
+        stats['mbps'] = self._done / max(elapsed, 1e-6) / 1e6  # average over the whole job
+        if self._log and self._done:
+            self._log(f"{self.job}: {self._done} bytes in {format_duration(elapsed)} "
+                      f"(average {stats['mbps']:.1f} MB/s, peak {self._peak / 1e6:.1f} MB/s).\n")
+        if self._callback:
+            self._callback(stats)
+        return stats
+
+
+def describe_dd_progress(accepted, on_device):
+    """Log text for a KernelProgressSampler reading."""
+    parts = []
+    if accepted is not None:
+        parts.append(f"{accepted} bytes accepted by the kernel")
+    if on_device is not None:
+        parts.append(f"{on_device} bytes reached the device")
+    return ", ".join(parts) if parts else "no kernel counters available"
+
+
+def write_iso_with_dd(devpath, iso_path, log, progress_cb=None, source_hash=None, monitor=None, hot=False,
+                      writeback_limit=2 * WRITEBACK_WINDOW):
+    """Write iso_path to devpath through sudo dd.
+    Used when this process cannot open the device itself. Raw images are fed to dd by pv when
+    available, compressed images by a command-line decompressor. With a source_hash (hashlib
+    object) this process feeds the image in instead, hashing it on the way. Progress is sampled
+    from kernel counters (KernelProgressSampler), not parsed from dd/pv output, and passed on
+    to monitor (a ThroughputMonitor) if given. Unless hot=True the image's pages are dropped from
+    the page cache as the feeder consumes them; writeback_limit caps the device's dirty data
+    (BoundedWriteback). Returns True on success."""
+    kind = image_compression(iso_path)
+    try:
+        compressed_size = os.path.getsize(iso_path)
+    except Exception:
+        compressed_size = None
+    total = compressed_size
+    decompress = decompress_command(iso_path)
+    if kind:
+        if decompress is None:
+            log(f"No command-line decompressor for {kind} images is installed.\n")
+            return False
+        total = uncompressed_image_size(iso_path, kind)
+        log(f"Decompressing with {' '.join(decompress)}.\n")
+
+    cmd = ["sudo", "dd", f"of={devpath}", "bs=4M"]
+    p_feed = None
+    pump = None
+    feed = open(iso_path, 'rb', buffering=0) if source_hash is not None else None
+    # keep dd from filling RAM with dirty pages that would all be flushed at the end
+    writeback = BoundedWriteback(devpath, log, limit=writeback_limit)
+    writeback.apply()
+    release_fd = None
+    try:
+        if not hot:
+            # pv/dd/the decompressor read the file themselves; their pages are dropped through our own fd
+            release_fd = os.open(iso_path, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+        releaser = PageCacheReleaser(release_fd) if release_fd is not None else None
+        if kind:
+            with open(iso_path, 'rb') as fh:
+                p_feed = subprocess.Popen(decompress, stdin=fh if feed is None else subprocess.PIPE,
+                                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if feed is not None:
+                pump = pump_hashed(feed, p_feed.stdin, source_hash)
+            dd_stdin = p_feed.stdout
+            log(f"Running: {' '.join(decompress)} < {iso_path} | {' '.join(cmd)}\n")
+        elif feed is not None:
+            # our own pipe rather than stdin=PIPE, which communicate() would try to close under the pump
+            dd_stdin, pipe_w = os.pipe()
+            log(f"Running: {' '.join(cmd)} < {iso_path}\n")
+        elif shutil.which('pv'):
+            # pv only feeds dd here: as our own process its I/O counters are readable
+            p_feed = subprocess.Popen(['pv', '-q', iso_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            dd_stdin = p_feed.stdout
+            log(f"Running: pv -q {iso_path} | {' '.join(cmd)}\n")
+        else:
+            cmd.insert(2, f"if={iso_path}")
+            dd_stdin = None
+            log(f"Running: {' '.join(cmd)}\n")
+        if source_hash is not None:
+            log("Hashing the image as it is piped to dd.\n")
+        p_dd = subprocess.Popen(cmd, stdin=dd_stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        # close our copies of the pipe so dd sees EOF when the feeder exits
+        if isinstance(dd_stdin, int):
+            os.close(dd_stdin)
+            pump = pump_hashed(feed, open(pipe_w, 'wb', buffering=0), source_hash)
+        elif dd_stdin is not None:
+            dd_stdin.close()
+
+        state = {'pct': -1, 'decile': 0}
+
+        def on_sample(accepted, on_device, read):
+            # progress follows what has reached the device, when the kernel tells us
+            done = on_device if on_device is not None else accepted
+            if monitor is not None and done is not None:
+                monitor.update(done)
+            if releaser is not None and read is not None:
+                releaser.consumed(read)
+            if total and done is not None:
+                pct = min(99, done * 100 // total)
+            elif read is not None and compressed_size:
+                pct = min(99, read * 100 // compressed_size)
+            else:
+                return
+            if progress_cb and pct != state['pct']:
+                state['pct'] = pct
                 progress_cb(pct)
-        out, _ = p.communicate()
+            if pct // 10 > state['decile']:
+                state['decile'] = pct // 10
+                log(f"{pct}%: {describe_dd_progress(accepted, on_device)}\n")
+
+        sampler = KernelProgressSampler(devpath, p_dd.pid, on_sample,
+                                        feeder_pid=p_feed.pid if p_feed else None).start()
+        try:
+            out, err = p_dd.communicate()
+        finally:
+            sampler.stop()
+        sampler.sample()
+        if sampler.on_device is not None:
+            log(f"{sampler.on_device} bytes had reached the device when dd exited; "
+                f"the rest is still being flushed from the page cache.\n")
+        if pump is not None:
+            pump.join()
+            if pump.error is not None:
+                log(f"Reading the image failed: {pump.error}; dd only got part of it.\n")
+                return False
         if out:
             log(out + "\n")
-        if p.returncode == 0:
-            if progress_cb:
-                progress_cb(100)
-            log("Format completed successfully.\n")
-        else:
-            if progress_cb:
-                progress_cb(100)
-            log(f"Format failed with exit code {p.returncode}\n")
+        if err:
+            log(err + "\n")
+        if p_feed is not None:
+            feed_err = p_feed.stderr.read().decode('utf-8', errors='ignore').strip()
+            if p_feed.wait() != 0:
+                log(f"{p_feed.args[0]} exited with code {p_feed.returncode} (corrupt or truncated image?) {feed_err}\n")
+                return False
+        if p_dd.returncode != 0:
+            log(f"dd exited with code {p_dd.returncode}\n")
+            return False
+        # dd returns with data still in the page cache; flush this device only
+        return flush_block_device(devpath, log)
     except Exception as e:
-        if progress_cb:
-            progress_cb(100)
-        log(f"Error running format: {e}\n")
-
-
-def write_iso_to_device(devnode, iso_path, log, progress_cb=None):
-    """Write a bootable ISO image to the raw device (/dev/<devnode>) using dd and report progress."""
+        log(f"Error writing ISO: {e}\n")
+        return False
+    finally:
+        if p_feed is not None:
+            if p_feed.poll() is None:
+                p_feed.kill()
+            p_feed.wait()
+            p_feed.stdout.close()
+            p_feed.stderr.close()
+        if feed is not None:
+            feed.close()
+        if release_fd is not None:
+            releaser.finish()
+            os.close(release_fd)
+        writeback.restore()
+
+
+def write_iso_to_device(devnode, iso_path, log, progress_cb=None, direct=False, sparse=False, autotune=False,
+                        verify=False, resumable=False, image_id=None, diff=False, bmap=False, source_hash=None,
+                        stats_cb=None, stage=False, prefetch_mb=PREFETCH_AHEAD_MB, hot=False,
+                        memory_budget_mb=MEMORY_BUDGET_MB):
+    """Write a bootable ISO image to the raw device (/dev/<devnode>) and report progress.
+    Uses the in-process native writer when the device is writable by this process
+    (running as root), otherwise falls back to sudo dd. sparse=True skips all-zero blocks
+    and autotune=True uses (or first measures) the best chunk size and queue depth for
+    this device model (native writer only). verify=True reads the image back from the
+    device afterwards and compares it chunk by chunk. resumable=True journals progress
+    under the device serial and image_id (the image's SHA-256, or a cheap fingerprint
+    if not given) so an interrupted write continues where it stopped. diff=True rewrites only
+    the chunks that differ from what is already on the device. bmap=True writes only the
+    ranges mapped by the image's .bmap file (or by a map generated for raw images).
+    source_hash (a hashlib object) is fed the image file as it is written, so the caller can
+    check the image checksum without a separate read pass. The write and verify phases are
+    each tracked by a ThroughputMonitor reporting to stats_cb. stage=True copies the image into
+    tmpfs first when RAM allows (stage_image), so repeat flashes read from memory; otherwise the
+    native writer keeps the image read prefetch_mb MiB ahead. Buffers, dirty data and read-ahead
+    are fitted into memory_budget_mb (plan_memory), and the image's pages are dropped from the
+    page cache once written unless hot=True. Returns True on success."""
     devpath = f"/dev/{devnode}"
     log(f"Preparing to write ISO {iso_path} to {devpath} (this will overwrite the device)...\n")
     # ensure ISO exists
@@ -467,115 +3368,414 @@ def write_iso_to_device(devnode, iso_path, log, progress_cb=None):
         log("ISO file not found.\n")
         if progress_cb:
             progress_cb(100)
-        return
+        return False
+
+    identity = DigestCache.key(iso_path)  # for caching what this write learns about the image
+    hash_profile(log)  # measured on first use: chunk manifests and verification use its algorithm
 
     # unmount any children
     progress_cb and progress_cb(5)
     unmount_children(devnode, log)
+    # data is read from src_path; the .bmap, fingerprint and checksum files go by iso_path
+    src_path = (stage_image(iso_path, log) if stage else None) or iso_path
+    prefetch = prefetch_mb * 1024 * 1024 if src_path == iso_path else 0
+
+    # with verify enabled the write phase covers 0-80% and verification 80-100%
+    write_cb = verify_cb = progress_cb
+    if progress_cb and verify:
+        write_cb = lambda pct: progress_cb(pct * 80 // 100)
+        verify_cb = lambda pct: progress_cb(80 + pct // 5)
+
+    def write_monitor(total):
+        return ThroughputMonitor(f"Write {devpath}", total, stats_cb, log).start()
+
+    def verify_monitor(total):
+        """Monitor for the verify phase, fed from its percentage; returns (monitor, progress_cb)."""
+        monitor = ThroughputMonitor(f"Verify {devpath}", total, stats_cb, log).start()
+
+        def cb(pct):
+            monitor.update(total * pct // 100)
+            if verify_cb:
+                verify_cb(pct)
+        return monitor, cb
+
+    kind = image_compression(iso_path)
+    image_size = uncompressed_image_size(iso_path, kind) if kind else os.path.getsize(iso_path)
+    chunk_size = WRITE_CHUNK_SIZE
+    digests = [] if verify else None
+    block_map = None
+    if bmap and os.access(devpath, os.W_OK):
+        block_map = BlockMap.for_image(iso_path, log)
+    if block_map is not None:
+        if sparse or diff or resumable:
+            log("Writing mapped ranges only; sparse, differential and resume options do not apply.\n")
+        if autotune:
+            chunk_size = tuned_write_settings(devnode, log, direct)[0]
+        monitor = write_monitor(block_map.mapped_bytes)
+        try:
+            ok = write_image_bmap(src_path, devpath, block_map, log, progress_cb=write_cb, chunk_size=chunk_size,
+                                  direct=direct, source_hash=source_hash, monitor=monitor) is not None
+        finally:
+            monitor.stop()
+        if ok and verify:
+            log(f"Verifying {devpath} against the block map...\n")
+            monitor, cb = verify_monitor(block_map.mapped_bytes)
+            try:
+                ok = verify_bmap(devpath, block_map, log, progress_cb=cb)
+            finally:
+                monitor.stop()
+        digests = None
+    elif os.access(devpath, os.W_OK):
+        queue_depth = 1
+        journal = None
+        if resumable:
+            serial = get_device_identity(devnode)[2]
+            if serial:
+                image_id = image_id or image_fingerprint(iso_path)
+                pending_chunk = WriteJournal.stored_chunk_size(serial, image_id)
+                if pending_chunk:
+                    # resume with the interrupted job's chunk size; calibrating would overwrite its data
+                    chunk_size, autotune = pending_chunk, False
+        if autotune:
+            if diff:
+                keep = "the differential write compares against"
+            elif resumable and not serial:
+                keep = "a resume would check the device contents against"
+            else:
+                keep = None
+            chunk_size, queue_depth = tuned_write_settings(devnode, log, direct, preserve=keep)
+        if resumable and serial:
+            journal = WriteJournal(serial, image_id, chunk_size)
+        prefetch, window = plan_memory(memory_budget_mb * 1024 * 1024, chunk_size, queue_depth, prefetch, hot, log)
+        manifest, manifest_total = load_chunk_manifest(iso_path, chunk_size)
+        manifest_diff = diff and kind is None and not sparse and source_hash is None
+        if manifest is None and manifest_diff:
+            # hashing the image on every core first lets the differential scan skip reading unchanged chunks
+            manifest, manifest_total = build_chunk_manifest(src_path, chunk_size, log, hot=hot)
+            if manifest is not None and src_path != iso_path:
+                save_chunk_manifest(iso_path, chunk_size, manifest, manifest_total, identity)
+        if manifest is not None:
+            log("Using the image's chunk manifest" + ("; the writer does not need to hash.\n" if verify else ".\n"))
+        if resumable and journal is None:
+            if manifest is not None:
+                # no serial to key a journal by: the device contents show how far a previous write got
+                journal = ManifestJournal(manifest)
+            else:
+                log("Device reports no serial number; this write cannot be resumed if interrupted.\n")
+        diff_manifest = manifest if manifest_diff else None
+        monitor = write_monitor(image_size)
+        try:
+            # unchanged chunks are not read with a manifest, so reading ahead of them is wasted
+            written = write_image_native(src_path, devpath, log, progress_cb=write_cb, chunk_size=chunk_size,
+                                         direct=direct, sparse=sparse, queue_depth=queue_depth,
+                                         chunk_digests=digests if manifest is None else None,
+                                         journal=journal, diff=diff, source_hash=source_hash,
+                                         monitor=monitor, prefetch=0 if diff_manifest else prefetch, hot=hot,
+                                         writeback_window=window, diff_manifest=diff_manifest)
+        finally:
+            monitor.stop()
+        ok = written is not None
+        if manifest is not None:
+            digests = manifest if verify else None
+            written = manifest_total
+        elif ok and digests is not None:
+            save_chunk_manifest(iso_path, chunk_size, digests, written, identity)
+    else:
+        log(f"{devpath} is not writable by this process; falling back to sudo dd.\n")
+        if sparse or diff or bmap:
+            log("Sparse/differential/block map modes need the native writer (run as root); writing every block.\n")
+        window = plan_memory(memory_budget_mb * 1024 * 1024, 4 * 1024 * 1024, 1, 0, hot, log)[1]
+        monitor = write_monitor(image_size)
+        try:
+            ok = write_iso_with_dd(devpath, src_path, log, progress_cb=write_cb, source_hash=source_hash,
+                                   monitor=monitor, hot=hot, writeback_limit=2 * window)
+        finally:
+            monitor.stop()
+        digests = None
+        if ok and verify:
+            if os.access(devpath, os.R_OK):
+                digests, written = load_chunk_manifest(iso_path, chunk_size)
+                if digests is not None:
+                    log("Chunk hashes for verification from the image's chunk manifest.\n")
+                else:
+                    log("Hashing image for verification...\n")
+                    digests, written = build_chunk_manifest(src_path, chunk_size, log, hot=hot)
+                    if digests is not None and src_path != iso_path:
+                        save_chunk_manifest(iso_path, chunk_size, digests, written, identity)
+            else:
+                log(f"{devpath} is not readable by this process; skipping read-back verification.\n")
 
-    # get iso size
-    try:
-        total = os.path.getsize(iso_path)
-    except Exception:
-        total = None
-
-    # prefer pv if available for smoother progress
-    use_pv = shutil.which('pv') is not None
-    if use_pv:
-        log('Using pv to stream ISO to dd for better progress.\n')
+    if ok and source_hash is not None:
+        if isinstance(source_hash, MultiHasher):
+            tapped = source_hash.hexdigests()
+        else:
+            tapped = {source_hash.name: source_hash.hexdigest()}
+        for algorithm, digest in tapped.items():
+            DigestCache().put(iso_path, algorithm, digest, identity=identity)
+    if ok and digests is not None:
+        log(f"Verifying {devpath} against the image...\n")
+        monitor, cb = verify_monitor(written)
         try:
-            # pv stdout -> dd stdin
-            p_pv = subprocess.Popen(['pv', iso_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            p_dd = subprocess.Popen(['sudo', 'dd', f'of={devpath}', 'bs=4M', 'status=progress'], stdin=p_pv.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            # close pv stdout in parent so dd sees EOF when pv exits
-            p_pv.stdout.close()
-
-            # read pv stderr for progress lines and dd stderr for final status
-            pv_stderr = p_pv.stderr
-            dd_stderr = p_dd.stderr
-            # monitor both
+            ok = verify_device(devpath, digests, chunk_size, written, log, progress_cb=cb)
+        finally:
+            monitor.stop()
+
+    if progress_cb:
+        progress_cb(100)
+    if ok:
+        verified = digests is not None or (block_map is not None and verify)
+        log("ISO written and verified successfully.\n" if verified else "ISO written successfully.\n")
+    return ok
+
+
+ 
+
+class FanoutRing:
+    """Ring of reusable chunk buffers shared by one source reader and several device writers.
+
+    Chunk number seq lives in slot seq % slots. The reader only refills a slot once every
+    attached writer has released the chunk it held, so a writer lags the reader by at most
+    `slots` chunks. A writer that has held the reader back (while faster writers were waiting)
+    for more than lag_timeout seconds in total is detached and finishes from its own source
+    reader instead of stalling the others.
+    """
+
+    DETACHED = object()
+
+    def __init__(self, slots, chunk_size, targets, lag_timeout=None):
+        self.slots = slots
+        self.bufs = [alloc_aligned_buffer(chunk_size) for _ in range(slots)]
+        self.views = [memoryview(b) for b in self.bufs]
+        self.lengths = [0] * slots
+        self.produced = 0
+        self.eof = False
+        self.error = None
+        self.next_seq = {t: 0 for t in targets}  # attached writers only
+        self.blocked = {}  # seconds each writer kept the reader waiting while others were ready
+        self.lag_timeout = FANOUT_LAG_TIMEOUT if lag_timeout is None else lag_timeout
+        self.cond = threading.Condition()
+
+    def wait_for_slot(self, seq):
+        """Block the reader until the slot for chunk seq is free. Returns the writers detached meanwhile."""
+        detached = []
+        with self.cond:
             while True:
-                pv_line = pv_stderr.readline()
-                if pv_line:
-                    log(pv_line)
-                    m = re.search(r"(\d+)%", pv_line)
-                    if m and progress_cb:
-                        try:
-                            pct = int(m.group(1))
-                            progress_cb(min(100, pct))
-                        except Exception:
-                            pass
-                # check if dd finished
-                if p_dd.poll() is not None:
+                lagging = [t for t, pos in self.next_seq.items() if pos <= seq - self.slots]
+                if not lagging:
                     break
-                time.sleep(0.1)
-
-            out_dd, err_dd = p_dd.communicate()
-            out_pv, err_pv = p_pv.communicate()
-            if out_pv:
-                log(out_pv + "\n")
-            if err_pv:
-                log(err_pv + "\n")
-            if out_dd:
-                log(out_dd + "\n")
-            if err_dd:
-                log(err_dd + "\n")
-            if p_dd.returncode == 0:
-                if progress_cb:
-                    progress_cb(100)
-                log("ISO written successfully.\n")
-            else:
-                if progress_cb:
-                    progress_cb(100)
-                log(f"dd exited with code {p_dd.returncode}\n")
-        except Exception as e:
-            if progress_cb:
-                progress_cb(100)
-            log(f"Error writing ISO with pv: {e}\n")
-    else:
-        # build dd command; use status=progress where supported
-        cmd = ["sudo", "dd", f"if={iso_path}", f"of={devpath}", "bs=4M", "status=progress"]
-        log(f"Running: {' '.join(cmd)}\n")
+                start = time.monotonic()
+                self.cond.wait(0.5)
+                if len(lagging) == len(self.next_seq):
+                    # every writer is behind: the devices are simply slower than the source
+                    continue
+                waited = time.monotonic() - start
+                for t in lagging:
+                    self.blocked[t] = self.blocked.get(t, 0.0) + waited
+                    if self.blocked[t] > self.lag_timeout and t in self.next_seq:
+                        del self.next_seq[t]
+                        detached.append(t)
+                if detached:
+                    self.cond.notify_all()
+        return detached
+
+    def slot_view(self, seq):
+        return self.views[seq % self.slots]
+
+    def publish(self, seq, n):
+        with self.cond:
+            self.lengths[seq % self.slots] = n
+            self.produced = seq + 1
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.eof = True
+            self.error = error
+            self.cond.notify_all()
+
+    def get(self, target, seq):
+        """Return a view of chunk seq, None at end of image, or DETACHED."""
+        with self.cond:
+            while True:
+                if target not in self.next_seq:
+                    return self.DETACHED
+                if seq < self.produced:
+                    slot = seq % self.slots
+                    return self.views[slot][:self.lengths[slot]]
+                if self.eof:
+                    return None
+                self.cond.wait()
+
+    def release(self, target, seq):
+        """Mark chunk seq consumed. Returns False if target was detached (the slot may have been reused)."""
+        with self.cond:
+            if target not in self.next_seq:
+                return False
+            self.next_seq[target] = seq + 1
+            self.cond.notify_all()
+            return True
 
+    def drop(self, target):
+        with self.cond:
+            self.next_seq.pop(target, None)
+            self.cond.notify_all()
+
+
+def write_image_fanout(src_path, devpaths, log, progress_cb=None, chunk_size=WRITE_CHUNK_SIZE, direct=False,
+                       verify=True, ring_slots=FANOUT_RING_SLOTS, source_hash=None, prefetch=0, hot=False,
+                       writeback_window=WRITEBACK_WINDOW, lag_timeout=None):
+    """Write one image to several devices at once, reading each source chunk only once.
+    A single reader fills a shared FanoutRing; every device has its own writer thread
+    (and verify pass) and reports progress_cb(devpath, pct) on its own.
+    Compressed images are decompressed once by the reader. A writer detached for lagging
+    gets its own ImageSource, positioned at its offset (for compressed images that means
+    decompressing up to it again), so it never holds back the others.
+    source_hash (a hashlib object or MultiHasher) is fed the image file by the reader, so
+    its checksum needs no separate pass; prefetch and hot are as for ImageSource.
+    Returns {devpath: True/False}."""
+    try:
+        src = ImageSource(src_path, hasher=source_hash, prefetch=prefetch, hot=hot)
+    except OSError as e:
+        log(f"Cannot open image: {e}\n")
+        return {d: False for d in devpaths}
+    if src.kind:
+        log(f"Decompressing {src.kind} image once for all devices with {src.method}.\n")
+    ring = FanoutRing(ring_slots, chunk_size, devpaths, lag_timeout=lag_timeout)
+    image_bytes = [0]  # set by the reader at end of image
+    chunk_digests = []
+    digests_ready = threading.Event()
+    results = {}
+    # with verify enabled the write phase covers 0-80% and verification 80-100%
+    write_share = 80 if verify else 100
+
+    def reader():
+        seq = 0
+        try:
+            with src:
+                while True:
+                    for t in ring.wait_for_slot(seq):
+                        note = f" (decompressing the {src.kind} image again up to its position)" if src.kind else ""
+                        log(f"{t} fell {ring.slots} chunks behind; continuing it from its own source reader{note}.\n")
+                    view = ring.slot_view(seq)
+                    n = read_full(src, view)
+                    if not n:
+                        break
+                    chunk_digests.append(chunk_digest(view[:n]))
+                    image_bytes[0] += n
+                    ring.publish(seq, n)
+                    seq += 1
+                src.check()
+            ring.finish()
+        except OSError as e:
+            log(f"Source read failed at byte offset {seq * chunk_size}: {e}\n")
+            ring.finish(e)
+        finally:
+            digests_ready.set()
+
+    def writer(devpath):
+        fd = None
+        offset = 0
+        private_src = None
+        private_view = None
         try:
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            # dd writes progress to stderr; read stderr lines
+            fd, use_direct = open_device_for_write(devpath, direct)
+            limiter = None if use_direct else WritebackLimiter(fd, window=writeback_window)
+            seq = 0
+            last_pct = -1
             while True:
-                err = p.stderr.readline()
-                if err:
-                    log(err)
-                    # try to parse transferred bytes
-                    m = re.search(r"(\d+) bytes", err)
-                    if m and total:
-                        try:
-                            transferred = int(m.group(1))
-                            pct = int(transferred * 100 / total)
-                            if progress_cb:
-                                progress_cb(min(100, pct))
-                        except Exception:
-                            pass
-                if p.poll() is not None:
+                view = ring.get(devpath, seq)
+                if view is FanoutRing.DETACHED:
+                    if private_src is None:
+                        private_src = ImageSource(src_path, hot=hot)
+                        private_view = memoryview(alloc_aligned_buffer(chunk_size))
+                        private_src.skip(offset, private_view)
+                    view = private_view[:read_full(private_src, private_view)]
+                if view is None or not len(view):
                     break
-            out, err = p.communicate()
-            if out:
-                log(out + "\n")
-            if err:
-                log(err + "\n")
-            if p.returncode == 0:
+                if use_direct and len(view) % DIRECT_IO_ALIGN:
+                    clear_direct_flag(fd)
+                    use_direct = False
+                pwrite_all(fd, view, offset)
+                if private_src is None and not ring.release(devpath, seq):
+                    # detached mid-write: the slot may have been refilled, redo this chunk privately
+                    continue
+                offset += len(view)
+                seq += 1
+                durable = offset if limiter is None else limiter.advance(offset)
                 if progress_cb:
-                    progress_cb(100)
-                log("ISO written successfully.\n")
-            else:
+                    pct = src.percent(durable) * write_share // 100
+                    if pct != last_pct:
+                        last_pct = pct
+                        progress_cb(devpath, pct)
+            if ring.error is not None:
+                results[devpath] = False
+                return
+            if private_src is not None:
+                private_src.check()
+            os.fsync(fd)
+            digests_ready.wait()
+            total = image_bytes[0]
+            log(f"{devpath}: wrote {offset} of {total} bytes.\n")
+            if verify:
+                vcb = None
                 if progress_cb:
-                    progress_cb(100)
-                log(f"dd exited with code {p.returncode}\n")
-        except Exception as e:
-            if progress_cb:
-                progress_cb(100)
-            log(f"Error writing ISO: {e}\n")
-
-
- 
+                    vcb = lambda pct: progress_cb(devpath, write_share + pct * (100 - write_share) // 100)
+                results[devpath] = verify_device(devpath, chunk_digests, chunk_size, total, log, vcb)
+            else:
+                results[devpath] = offset == total
+        except OSError as e:
+            log(f"{devpath}: write failed at byte offset {offset}: {e}\n")
+            results[devpath] = False
+        finally:
+            ring.drop(devpath)
+            if fd is not None:
+                os.close(fd)
+            if private_src is not None:
+                private_src.close()
+
+    log(f"Fan-out write of {src_path} to {len(devpaths)} device(s), "
+        f"{ring_slots} x {chunk_size // 1024} KiB shared ring.\n")
+    threads = [threading.Thread(target=reader, daemon=True)]
+    threads += [threading.Thread(target=writer, args=(d,), daemon=True) for d in devpaths]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def write_iso_to_devices(devnodes, iso_path, log, progress_cb=None, direct=False, verify=True, source_hash=None,
+                         stage=False, prefetch_mb=PREFETCH_AHEAD_MB, hot=False, memory_budget_mb=MEMORY_BUDGET_MB):
+    """Fan-out variant of write_iso_to_device() for several /dev/<devnode> targets.
+    progress_cb is called as progress_cb(devnode, pct). direct, verify, source_hash, stage,
+    prefetch_mb, hot and memory_budget_mb are as for write_iso_to_device(); the ring and every
+    device's writeback window are fitted into the memory budget. Returns {devnode: True/False}."""
+    devpaths = [f"/dev/{d}" for d in devnodes]
+    log(f"Preparing to write ISO {iso_path} to {', '.join(devpaths)} (this will overwrite the devices)...\n")
+    if not os.path.isfile(iso_path):
+        log("ISO file not found.\n")
+        return {d: False for d in devnodes}
+    not_writable = [p for p in devpaths if not os.access(p, os.W_OK)]
+    if not_writable:
+        log(f"Batch write needs root; not writable: {', '.join(not_writable)}\n")
+        return {d: False for d in devnodes}
+    for d in devnodes:
+        unmount_children(d, log)
+    src_path = (stage_image(iso_path, log) if stage else None) or iso_path
+    prefetch = prefetch_mb * 1024 * 1024 if src_path == iso_path else 0
+    budget = memory_budget_mb * 1024 * 1024
+    # the ring takes at most half the budget; each device's dirty data shares the rest
+    slots = max(2, min(FANOUT_RING_SLOTS, budget // 2 // WRITE_CHUNK_SIZE))
+    prefetch, window = plan_memory(budget, WRITE_CHUNK_SIZE, slots, prefetch, hot, log)
+    window = max(1024 * 1024, window // len(devpaths))
+
+    cb = None
+    if progress_cb:
+        cb = lambda devpath, pct: progress_cb(Path(devpath).name, pct)
+    results = write_image_fanout(src_path, devpaths, log, progress_cb=cb, direct=direct, verify=verify,
+                                 ring_slots=slots, source_hash=source_hash, prefetch=prefetch, hot=hot,
+                                 writeback_window=window)
+    return {Path(p).name: ok for p, ok in results.items()}
 
 
 def mount_first_partition(devnode, log):
@@ -617,6 +3817,8 @@ def mount_first_partition(devnode, log):
 
 def unmount_mountpoint(mount_point, log):
     try:
+        # flush this filesystem explicitly so umount does not stall on it unannounced
+        sync_mount(mount_point, log)
         log(f"Unmounting {mount_point}...\n")
         r = subprocess.run(["sudo", "umount", mount_point], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
         log(r.stdout + "\n")
@@ -650,6 +3852,9 @@ def mount_and_list(devnode, log):
     except Exception as e:
         log(f"Error mounting/listing: {e}\n")
     finally:
+        if os.path.ismount(mp):
+            # flush this filesystem explicitly so umount does not stall on it unannounced
+            sync_mount(mp, log)
         log(f"Unmounting {mp}...\n")
         subprocess.run(["sudo", "umount", mp], check=False)
         try:
@@ -658,51 +3863,314 @@ def mount_and_list(devnode, log):
             pass
 
 
-def compute_iso_sha256(iso_path, log, progress_cb=None):
-    """Compute SHA-256 of iso_path with progress updates. Returns hex digest or None."""
-    log(f"Computing SHA-256 for {iso_path}...\n")
+def digest_label(algorithm):
+    """Display name of a hashlib algorithm: sha256 -> SHA-256, md5 -> MD5."""
+    return algorithm.upper().replace('SHA', 'SHA-')
+
+
+def checksum_algorithm(hex_digest, filename=''):
+    """hashlib name of a published hex digest, from its length; the checksum file's name
+    tells BLAKE2b (b2sum) apart from SHA-512. None if the length fits no supported algorithm."""
+    name = filename.lower()
+    if len(hex_digest) == 128 and ('b2sum' in name or 'blake2' in name):
+        return 'blake2b'
+    return DIGEST_HEX_LENGTHS.get(len(hex_digest))
+
+
+def unescape_checksum_name(name):
+    """Undo sha256sum's escaping of a file name on a line that starts with a backslash: a
+    doubled backslash stands for one, backslash-n for a newline, backslash-r for a carriage return."""
+    return re.sub(r'\\(.)', lambda m: {'n': '\n', 'r': '\r'}.get(m.group(1), m.group(1)), name)
+
+
+def parse_checksum_text(text, checksum_name=''):
+    """Parse a checksum file: GNU lines (`<hex>  name` or `<hex> *name`, as sha256sum writes),
+    BSD tags (`SHA256 (name) = <hex>`, as in Fedora's CHECKSUM files) and bare digests (a
+    foo.iso.sha256 holding only the hash, credited to foo.iso). A leading backslash marks an
+    escaped name, as `sha256sum -c` reads it. checksum_name is the checksum file's own name.
+    Returns {image file name: {algorithm: lowercase hex digest}}."""
+    found = {}
+    bare = os.path.splitext(checksum_name)[0]
+    for line in text.splitlines():
+        line = line.strip()
+        escaped = line.startswith('\\')
+        if escaped:
+            line = line[1:]
+        m = re.match(r'(\w[\w-]*) ?\((.+)\) ?= ?([a-fA-F0-9]+)$', line)
+        if m:
+            tag, name, digest = m.groups()
+            algorithm = tag.lower().replace('-', '_')
+            if algorithm not in hashlib.algorithms_available:
+                algorithm = checksum_algorithm(digest, checksum_name)
+        else:
+            m = re.match(r'([a-fA-F0-9]+)(?: [ *]?(.+))?$', line)
+            if not m:
+                continue
+            digest, name = m.group(1), m.group(2) or bare
+            algorithm = checksum_algorithm(digest, checksum_name)
+        name = name.strip()
+        if escaped and name != bare:
+            name = unescape_checksum_name(name)
+        name = name.split('/')[-1]
+        if algorithm and name and len(digest) in DIGEST_HEX_LENGTHS:
+            found.setdefault(name, {})[algorithm] = digest.lower()
+    return found
+
+
+class MultiHasher:
+    """Feeds each buffer to several hashlib objects, so every digest the checksum files
+    call for comes out of a single read of the image. Usable wherever one hashlib object is."""
+
+    def __init__(self, algorithms):
+        self.hashers = {a: hashlib.new(a) for a in algorithms}
+        self.name = '+'.join(self.hashers)
+
+    def update(self, data):
+        for h in self.hashers.values():
+            h.update(data)
+
+    def hexdigests(self):
+        return {a: h.hexdigest() for a, h in self.hashers.items()}
+
+
+def compare_digests(expected, actual):
+    """Compare published {algorithm: hex} digests with computed ones.
+    Returns (matched algorithms, mismatched algorithms); algorithms not computed are ignored."""
+    matched, mismatched = [], []
+    for algorithm, digest in expected.items():
+        if algorithm in actual:
+            (matched if actual[algorithm].lower() == digest.lower() else mismatched).append(algorithm)
+    return matched, mismatched
+
+
+def compute_iso_digests(iso_path, algorithms, log, progress_cb=None, chunk_size=None, stats_cb=None,
+                        hot=False):
+    """Compute several digests of iso_path (hashlib names, e.g. sha256 and sha512) in one read pass,
+    with progress updates and throughput through a ThroughputMonitor to stats_cb. Digests in the
+    DigestCache for the file as it is now are not recomputed; if all are cached the file is not
+    read at all. Pages already hashed are dropped from the page cache unless hot=True.
+    The file is read into one reused buffer of chunk_size bytes (default: the size measured
+    fastest on this machine, see hash_profile). Returns {algorithm: hex digest}, or None on error."""
+    cache = DigestCache()
+    digests = {}
+    for algorithm in algorithms:
+        cached = cache.get(iso_path, algorithm)
+        if cached:
+            log(f"{digest_label(algorithm)} (cached): {cached}\n")
+            digests[algorithm] = cached
+    missing = [a for a in algorithms if a not in digests]
+    if not missing:
+        if progress_cb:
+            progress_cb(100)
+        return digests
+    labels = '/'.join(digest_label(a) for a in missing)
+    log(f"Computing {labels} for {iso_path}...\n")
     try:
         total = os.path.getsize(iso_path)
+        identity = DigestCache.key(iso_path)
     except Exception:
-        total = None
-    h = hashlib.sha256()
-    read = 0
+        total = identity = None
+    h = MultiHasher(missing)
+    monitor = ThroughputMonitor(labels, total, stats_cb, log).start()
     try:
-        with open(iso_path, 'rb') as f:
-            while True:
-                chunk = f.read(4 * 1024 * 1024)
-                if not chunk:
-                    break
-                h.update(chunk)
-                read += len(chunk)
+        chunk_size = chunk_size or hash_profile(log)['chunk_size']
+        with open(iso_path, 'rb', buffering=0) as f:
+            releaser = None if hot else PageCacheReleaser(f.fileno())
+
+            def consumed(read):
+                if releaser is not None:
+                    releaser.consumed(read)
+                monitor.update(read)
                 if total and progress_cb:
                     pct = int(read * 100 / total)
                     progress_cb(min(100, pct))
-        digest = h.hexdigest()
-        log(f"SHA-256: {digest}\n")
+
+            hash_fileobj(f, h, chunk_size, consumed)
+            if releaser is not None:
+                releaser.finish()
+        for algorithm, digest in h.hexdigests().items():
+            log(f"{digest_label(algorithm)} (computed): {digest}\n")
+            cache.put(iso_path, algorithm, digest, identity=identity)
+            digests[algorithm] = digest
         if progress_cb:
             progress_cb(100)
-        return digest
+        return digests
     except Exception as e:
         log(f"Error computing hash: {e}\n")
         if progress_cb:
             progress_cb(100)
         return None
+    finally:
+        monitor.stop()
+
+
+def compute_iso_sha256(iso_path, log, progress_cb=None, chunk_size=None, stats_cb=None, hot=False):
+    """Compute SHA-256 of iso_path (see compute_iso_digests). Returns hex digest or None."""
+    digests = compute_iso_digests(iso_path, ('sha256',), log, progress_cb, chunk_size, stats_cb, hot)
+    return digests['sha256'] if digests else None
+
+
+class HTTPConnectionPool:
+    """Keep-alive HTTP(S) connections reused for every request to the same host. http.client
+    connections are not thread-safe, so each thread has its own; close() closes them all,
+    which also aborts requests still running in other threads."""
+
+    def __init__(self, user_agent='curl/7.68.0'):
+        self.user_agent = user_agent
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all = []
+
+    def _connection(self, scheme, netloc, timeout):
+        conns = getattr(self._local, 'conns', None)
+        if conns is None:
+            conns = self._local.conns = {}
+        conn = conns.get((scheme, netloc))
+        if conn is None:
+            cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            conn = conns[(scheme, netloc)] = cls(netloc, timeout=timeout)
+            with self._lock:
+                self._all.append(conn)
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn
+
+    def _drop(self, scheme, netloc):
+        conn = self._local.conns.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def get(self, url, timeout, max_bytes=ONLINE_MAX_BYTES, redirects=3):
+        """GET url, following up to `redirects` redirects, and return at most max_bytes of the
+        body (a longer body is cut off and its connection closed rather than read to the end).
+        Raises OSError, http.client.HTTPException or ValueError."""
+        for _ in range(redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise ValueError(f"unsupported URL {url}")
+            target = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            for attempt in (0, 1):
+                conn = self._connection(parts.scheme, parts.netloc, timeout)
+                try:
+                    conn.request('GET', target, headers={'User-Agent': self.user_agent})
+                    resp = conn.getresponse()
+                    break
+                except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                    # the server closed an idle keep-alive connection: retry once on a new one
+                    self._drop(parts.scheme, parts.netloc)
+                    if attempt:
+                        raise
+            location = resp.getheader('Location')
+            if resp.status in (301, 302, 303, 307, 308) and location:
+                body = resp.read(64 * 1024)
+            elif resp.status != 200:
+                self._drop(parts.scheme, parts.netloc)
+                raise OSError(f"HTTP {resp.status} from {url}")
+            else:
+                body = resp.read(max_bytes)
+            if not resp.isclosed():
+                self._drop(parts.scheme, parts.netloc)
+            if resp.status == 200:
+                return body
+            url = urllib.parse.urljoin(url, location)
+        raise OSError(f"too many redirects from {url}")
+
+    def close(self):
+        with self._lock:
+            conns, self._all = self._all, []
+        for conn in conns:
+            try:
+                conn.close()
+            except OSError:
+                pass
 
 
-def fetch_online_sha256(iso_name, log, timeout=10):
+class OnlineChecksumCache:
+    """On-disk cache of online checksum lookups, keyed by ISO file name and size. A digest
+    found on a line naming the image is kept for ONLINE_CACHE_TTL seconds; a lookup that found
+    nothing is remembered for ONLINE_MISS_TTL, so flashing the same image again does not search
+    again. Guesses (a digest not tied to the image's name) are never stored."""
+
+    def __init__(self, path=ONLINE_CACHE):
+        self.path = path
+
+    @staticmethod
+    def key(name, size):
+        return f"{name}:{size}"
+
+    def _load_all(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as fh:
+                return json.load(fh)
+        except Exception:
+            return {}
+
+    def get(self, name, size):
+        """The fresh cached lookup for name/size as {'digest': hex or None, 'source': url}, or None."""
+        entry = self._load_all().get(self.key(name, size))
+        if not entry:
+            return None
+        ttl = ONLINE_CACHE_TTL if entry.get('digest') else ONLINE_MISS_TTL
+        return entry if time.time() - entry.get('time', 0) < ttl else None
+
+    def put(self, name, size, digest, source=None):
+        entries = self._load_all()
+        now = time.time()
+        # expired entries are dropped whenever the cache is written
+        entries = {k: e for k, e in entries.items() if now - e.get('time', 0) < ONLINE_CACHE_TTL}
+        entries[self.key(name, size)] = {'digest': digest, 'source': source, 'time': now}
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, 'w', encoding='utf-8') as fh:
+                json.dump(entries, fh)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass  # the cache only saves time
+
+
+def fetch_online_sha256(iso_name, log, timeout=10, size=None, deadline=ONLINE_LOOKUP_DEADLINE):
     """Try to find a SHA-256 checksum for iso_name by searching the web (DuckDuckGo HTML) and fetching candidate checksum files.
+    The candidates are fetched in parallel (ONLINE_FETCH_WORKERS) over reused connections, no
+    response is read past ONLINE_MAX_BYTES, and the whole lookup gives up after `deadline`
+    seconds (no single request waits longer than timeout). A digest found on a line naming the
+    image, and finding nothing, are cached by file name and size (OnlineChecksumCache); a guess
+    (the first digest on the results page or in a file that does not name the image) is not,
+    so it never outlives this lookup.
     Returns hex digest string or None.
     """
+    cache = OnlineChecksumCache()
+    entry = cache.get(iso_name, size)
+    if entry is not None:
+        if entry['digest']:
+            log(f"Online checksum (cached) from {entry['source']}\n")
+        else:
+            log("No online checksum was found for this image recently; not searching again yet.\n")
+        return entry['digest']
+    pool = HTTPConnectionPool()
+    try:
+        digest, source, complete, named = _search_online_sha256(iso_name, log, pool, timeout,
+                                                                time.monotonic() + deadline)
+    finally:
+        pool.close()  # also stops fetches still running past the deadline
+    if digest and not named:
+        log("That digest is not on a line naming the image, so it is unverified and not cached.\n")
+    elif digest or complete:
+        cache.put(iso_name, size, digest, source)
+    return digest
+
+
+def _search_online_sha256(iso_name, log, pool, timeout, end):
+    """fetch_online_sha256 without the cache. Returns (digest, source URL, complete, named):
+    complete is False if the search could not finish (network error, deadline), so a miss is
+    not cached, and named is whether the digest was on a line naming iso_name."""
     try:
         q = urllib.parse.quote_plus(f"{iso_name} SHA256")
         url = f"https://duckduckgo.com/html/?q={q}"
-        req = urllib.request.Request(url, headers={'User-Agent': 'curl/7.68.0'})
-        with urllib.request.urlopen(req, timeout=timeout) as resp:
-            page = resp.read().decode('utf-8', errors='ignore')
+        page = pool.get(url, min(timeout, end - time.monotonic())).decode('utf-8', errors='ignore')
     except Exception as e:
         log(f"Online search failed: {e}\n")
-        return None
+        return None, None, False, False
 
     # collect href links
     links = re.findall(r'href=["\']([^"\']+)["\']', page)
@@ -721,30 +4189,167 @@ def fetch_online_sha256(iso_name, log, timeout=10):
     m = re.search(r"\b([a-fA-F0-9]{64})\b", page)
     if m:
         log(f"Found possible hash on search page: {m.group(1)}\n")
-        return m.group(1)
+        return m.group(1), url, True, False
 
-    # Fetch candidate links and look for hash
-    for c in candidates[:8]:
+    # Fetch candidate links in parallel; a digest on a line naming the image wins as soon as it
+    # arrives, otherwise the first digest of the best-ranked candidate that has one
+    candidates = candidates[:8]
+    if not candidates:
+        return None, None, True, False
+    fetcher = ThreadPoolExecutor(max_workers=ONLINE_FETCH_WORKERS)
+    futures = {fetcher.submit(_checksum_from_url, pool, c, iso_name, timeout, end): c for c in candidates}
+    fallback = {}
+    pending = set(futures)
+    try:
+        while pending:
+            left = end - time.monotonic()
+            if left <= 0:
+                log(f"Online checksum lookup: out of time with {len(pending)} candidate(s) still loading; "
+                    f"giving up on them.\n")
+                break
+            done, pending = wait(pending, timeout=left, return_when=FIRST_COMPLETED)
+            for fut in done:
+                named, first = fut.result()
+                if named:
+                    log(f"Found online checksum in {futures[fut]}\n")
+                    return named, futures[fut], True, True
+                if first:
+                    fallback[futures[fut]] = first
+    finally:
+        for fut in futures:
+            fut.cancel()
+        fetcher.shutdown(wait=False)
+    for c in candidates:
+        if c in fallback:
+            log(f"Found online checksum in {c}\n")
+            return fallback[c], c, True, False
+    return None, None, not pending, False
+
+
+def _checksum_from_url(pool, url, iso_name, timeout, end):
+    """Fetch a candidate checksum file. Returns (digest on a line naming iso_name, first digest
+    in the file); either is None if absent or the fetch failed."""
+    try:
+        txt = pool.get(url, max(0.1, min(timeout, end - time.monotonic()))).decode('utf-8', errors='ignore')
+    except Exception:
+        return None, None
+    for line in txt.splitlines():
+        if iso_name in line:
+            mm = re.search(r"\b([a-fA-F0-9]{64})\b", line)
+            if mm:
+                return mm.group(1), mm.group(1)
+    mm = re.search(r"\b([a-fA-F0-9]{64})\b", txt)
+    return None, mm.group(1) if mm else None
+
+
+class ChecksumCatalog:
+    """Published digests by image file name, as {'files': {name: {'digests': {algorithm: hex},
+    'source': URL or path}}, 'mirrors': {resolver name: base URL}} in CHECKSUM_CATALOG. Every
+    image a fetched or imported checksum file lists is added, so the rest of a release verifies
+    offline. 'mirrors' overrides the resolvers' default base URLs (a local mirror or stand-in)."""
+
+    def __init__(self, path=CHECKSUM_CATALOG):
+        self.path = path
+
+    def _load(self):
         try:
-            req = urllib.request.Request(c, headers={'User-Agent': 'curl/7.68.0'})
-            with urllib.request.urlopen(req, timeout=timeout) as r2:
-                txt = r2.read().decode('utf-8', errors='ignore')
-                # look for line mentioning iso_name
-                for line in txt.splitlines():
-                    if iso_name in line and re.search(r"\b([a-fA-F0-9]{64})\b", line):
-                        mm = re.search(r"\b([a-fA-F0-9]{64})\b", line)
-                        if mm:
-                            log(f"Found online checksum in {c}\n")
-                            return mm.group(1)
-                # fallback: first 64-hex in file
-                mm = re.search(r"\b([a-fA-F0-9]{64})\b", txt)
-                if mm:
-                    log(f"Found online checksum in {c}\n")
-                    return mm.group(1)
+            with open(self.path, 'r', encoding='utf-8') as fh:
+                data = json.load(fh)
         except Exception:
-            continue
+            data = {}
+        data.setdefault('files', {})
+        data.setdefault('mirrors', {})
+        return data
+
+    def _save(self, data):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as fh:
+            json.dump(data, fh, indent=1)
+        os.replace(tmp, self.path)
+
+    def lookup(self, name):
+        """Return ({algorithm: hex}, source) for the image file name, or ({}, None)."""
+        entry = self._load()['files'].get(name)
+        return (entry['digests'], entry.get('source')) if entry else ({}, None)
+
+    def mirrors(self):
+        return self._load()['mirrors']
+
+    def set_mirror(self, resolver, base):
+        """Use base instead of the resolver's default base URL (None restores the default)."""
+        data = self._load()
+        if base:
+            data['mirrors'][resolver] = base.rstrip('/')
+        else:
+            data['mirrors'].pop(resolver, None)
+        self._save(data)
+
+    def add_checksum_text(self, text, source, checksum_name=''):
+        """Add every digest in a checksum file's text (parse_checksum_text) and return the
+        number of image files it lists. Saving is best effort."""
+        parsed = parse_checksum_text(text, checksum_name)
+        if not parsed:
+            return 0
+        data = self._load()
+        for name, digests in parsed.items():
+            entry = data['files'].setdefault(name, {'digests': {}})
+            entry['digests'].update(digests)
+            entry['source'] = source
+        try:
+            self._save(data)
+        except OSError:
+            pass
+        return len(parsed)
 
-    return None
+
+def match_checksum_resolver(iso_name, mirrors=None):
+    """Return (resolver name, [checksum file URLs]) for the first CHECKSUM_RESOLVERS pattern
+    matching iso_name, or (None, []). mirrors maps resolver names to replacement base URLs."""
+    for name, pattern, base, templates in CHECKSUM_RESOLVERS:
+        m = re.fullmatch(pattern, iso_name)
+        if not m:
+            continue
+        fields = {'name': iso_name, 'base': (mirrors or {}).get(name) or base}
+        for group, value in m.groupdict().items():
+            fields[group] = value or ''
+            fields[f"_{group}"] = f"_{value}" if value else ''
+        return name, [t.format(**fields) for t in templates]
+    return None, []
+
+
+def fetch_published_digests(iso_name, log, catalog=None, timeout=10, deadline=ONLINE_LOOKUP_DEADLINE):
+    """Fetch the checksum file the image's project publishes (match_checksum_resolver) into the
+    catalog and return the image's {algorithm: hex} digests from it, or {} if no resolver
+    knows the name or no checksum file lists it within `deadline` seconds."""
+    catalog = catalog or ChecksumCatalog()
+    resolver, urls = match_checksum_resolver(iso_name, catalog.mirrors())
+    if resolver and not urls:
+        log(f"{iso_name}: no checksum file is published for this image; import its published SHA-256 "
+            f"into the checksum catalog (Library menu) to have it verified.\n")
+    if not urls:
+        return {}
+    pool = HTTPConnectionPool()
+    end = time.monotonic() + deadline
+    try:
+        for url in urls:
+            left = end - time.monotonic()
+            if left <= 0:
+                log(f"Checksum lookup ({resolver}): out of time.\n")
+                break
+            try:
+                text = pool.get(url, min(timeout, left)).decode('utf-8', errors='ignore')
+            except Exception as e:
+                log(f"Checksum lookup ({resolver}): {url}: {e}\n")
+                continue
+            added = catalog.add_checksum_text(text, url, url.rsplit('/', 1)[-1])
+            digests = catalog.lookup(iso_name)[0]
+            if digests:
+                log(f"Published checksum from {url} ({added} image(s) added to the checksum catalog).\n")
+                return digests
+            log(f"Checksum lookup ({resolver}): {url} does not list {iso_name}.\n")
+    finally:
+        pool.close()
+    return {}
 
 
 def detect_windows_iso(iso_path):
@@ -773,9 +4378,10 @@ def detect_windows_iso(iso_path):
     return False, None
 
 
-def write_windows_iso_to_device(devname, iso_path, log, progress_cb=None):
+def write_windows_iso_to_device(devname, iso_path, log, progress_cb=None, stats_cb=None):
     """Write Windows ISO to USB device. Handles Windows 7, 10, and 11.
     For Windows ISOs larger than 4GB, use exFAT; otherwise use FAT32.
+    Copy throughput (bytes reaching the partition) is reported to stats_cb.
     """
     devpath = f"/dev/{devname}"
     
@@ -890,6 +4496,10 @@ def write_windows_iso_to_device(devname, iso_path, log, progress_cb=None):
         
         # Copy all files from ISO to USB
         log("Copying ISO files to USB (this may take several minutes)...\n")
+        monitor = ThroughputMonitor(f"Copy to {part_path}", iso_size, stats_cb, log,
+                                    probe=device_write_probe(part_path)).start()
+        writeback = BoundedWriteback(part_path, log)
+        writeback.apply()
         try:
             # Use cp -r with sudo to copy everything
             result = subprocess.run(
@@ -909,6 +4519,9 @@ def write_windows_iso_to_device(devname, iso_path, log, progress_cb=None):
         except Exception as e:
             log(f"Error copying files: {e}\n")
             return
+        finally:
+            writeback.restore()
+            monitor.stop()
         
         if progress_cb:
             progress_cb(90)
@@ -940,7 +4553,9 @@ def write_windows_iso_to_device(devname, iso_path, log, progress_cb=None):
     # Step 6: Sync and unmount
     try:
         log("Syncing filesystem...\n")
-        subprocess.run(["sudo", "sync"], check=True)
+        if not sync_mount(mp, log):
+            subprocess.run(["sudo", "umount", mp], check=False)
+            return
         log(f"Unmounting {part_path}...\n")
         subprocess.run(["sudo", "umount", mp], check=True)
     except subprocess.CalledProcessError as e:
@@ -954,45 +4569,117 @@ def write_windows_iso_to_device(devname, iso_path, log, progress_cb=None):
     log(f"USB is now bootable for Windows {win_version}\n")
 
 
-def find_checksum_file(iso_path):
-    """Search the ISO's directory for a checksum file and try to extract an expected SHA-256 for the ISO.
-    Returns (checksum_file_path, expected_hash) or (None, None).
-    """
-    directory = os.path.dirname(iso_path) or '.'
-    iso_name = os.path.basename(iso_path)
-    candidates = []
-    # exact name matches first
-    for ext in ('.sha256', '.sha256sum', '.sha256.txt', '.sha256sum.txt', '.sha256sum', '.sha256.sig'):
-        p = os.path.join(directory, iso_name + ext)
-        if os.path.isfile(p):
-            candidates.append(p)
+def is_checksum_file(fname):
+    """Whether a file name looks like a checksum file: foo.iso.sha256 and the other
+    CHECKSUM_FILE_SUFFIXES, SHA256SUMS, md5sum.txt, b2sums, Fedora's ...-CHECKSUM, ..."""
+    lf = fname.lower()
+    if lf.endswith(('.json', '.tmp')):
+        return False  # this app's own state files (checksum_catalog.json, ...) and their temporaries
+    if lf.endswith(CHECKSUM_FILE_SUFFIXES) or 'checksum' in lf:
+        return True
+    return (any(x in lf for x in ('sha', 'md5', 'b2sum'))
+            and lf.endswith(('.txt', '.sum', '.sha256', '.sha512', '.sha1', '.md5', 'sums')))
 
-    # then look for other files that look like checksums
-    if not candidates:
-        for fname in os.listdir(directory):
-            lf = fname.lower()
-            if 'sha' in lf and (lf.endswith('.txt') or lf.endswith('.sum') or lf.endswith('.sha256') or 'checksum' in lf):
-                candidates.append(os.path.join(directory, fname))
 
-    # parse candidates for a 64-hex and optional filename match
-    for p in candidates:
+class ChecksumIndex:
+    """Every checksum file of one directory parsed once (parse_checksum_text) into
+    {image file name: {algorithm: digest}} per file. refresh() is incremental: the directory
+    is listed again only when its mtime changes, and a checksum file is parsed again only
+    when its mtime or size does. Use checksum_index() to share one per directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._dir_mtime = None
+        self._names = []
+        self._files = {}  # name -> (mtime_ns, size, {image: {algorithm: digest}}, first digests)
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        st = os.stat(self.directory)
+        if st.st_mtime_ns != self._dir_mtime:
+            self._names = sorted(f for f in os.listdir(self.directory) if is_checksum_file(f))
+            self._dir_mtime = st.st_mtime_ns
+        files = {}
+        for name in self._names:
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            known = self._files.get(name)
+            if known and known[:2] == (st.st_mtime_ns, st.st_size):
+                files[name] = known
+            elif os.path.isfile(path) and st.st_size <= CHECKSUM_FILE_MAX_BYTES:
+                files[name] = (st.st_mtime_ns, st.st_size) + self._parse(path, name)
+        self._files = files
+
+    @staticmethod
+    def _parse(path, name):
         try:
-            with open(p, 'r', encoding='utf-8', errors='ignore') as fh:
-                for line in fh:
-                    m = re.search(r"\b([a-fA-F0-9]{64})\b", line)
-                    if m:
-                        # prefer lines that mention the ISO filename
-                        if iso_name in line:
-                            return (p, m.group(1))
-                # second pass: take first hash if no filename match
-                fh.seek(0)
-                for line in fh:
-                    m = re.search(r"\b([a-fA-F0-9]{64})\b", line)
-                    if m:
-                        return (p, m.group(1))
-        except Exception:
-            continue
-    return (None, None)
+            with open(path, 'r', encoding='utf-8', errors='ignore') as fh:
+                text = fh.read()
+        except OSError:
+            return {}, {}
+        parsed = parse_checksum_text(text, name)
+        if parsed:
+            return parsed, next(iter(parsed.values()))
+        # a digest in some other layout ("SHA-256: <hex>"): usable from the image's own checksum file
+        m = HEX_DIGEST_RE.search(text)
+        alg = checksum_algorithm(m.group(1), name) if m else None
+        return {}, ({alg: m.group(1).lower()} if alg else {})
+
+    def lookup(self, iso_name):
+        """Return {algorithm: (checksum_file_path, digest)} for iso_name. The image's own
+        checksum files (iso_name + suffix) come first and may hold just an unnamed digest;
+        other files count only where they list iso_name. The first file per algorithm wins."""
+        with self._lock:
+            self.refresh()
+            own = [n for n in self._names if n.startswith(iso_name + '.') and n in self._files]
+            others = [n for n in self._names if n not in own and n in self._files]
+            found = {}
+            for name in own + others:
+                parsed, first = self._files[name][2:]
+                digests = parsed.get(iso_name) or (first if name in own else {})
+                for alg, digest in digests.items():
+                    found.setdefault(alg, (os.path.join(self.directory, name), digest))
+            return found
+
+
+_checksum_indexes = {}
+_checksum_indexes_lock = threading.Lock()
+
+
+def checksum_index(directory):
+    """The process-wide ChecksumIndex of directory."""
+    key = os.path.realpath(directory)
+    with _checksum_indexes_lock:
+        index = _checksum_indexes.get(key)
+        if index is None:
+            index = _checksum_indexes[key] = ChecksumIndex(key)
+        return index
+
+
+def find_checksums(iso_path):
+    """Find every published digest of the ISO in the checksum files of its directory
+    (SHA256SUMS, SHA512SUMS, md5sum.txt, foo.iso.sha1, Fedora CHECKSUM, ...), whatever the
+    algorithm, through the directory's ChecksumIndex: files are parsed once and again only
+    when they change. Returns {algorithm: (checksum_file_path, expected_hash)}; the ISO's own
+    checksum files win over directory-wide ones."""
+    try:
+        return checksum_index(os.path.dirname(iso_path) or '.').lookup(os.path.basename(iso_path))
+    except OSError:
+        return {}
+
+
+def find_checksum_file(iso_path):
+    """Search the ISO's directory for a checksum file and extract an expected hash for the ISO,
+    preferring SHA-256 (see find_checksums for every algorithm).
+    Returns (checksum_file_path, expected_hash) or (None, None).
+    """
+    found = find_checksums(iso_path)
+    if not found:
+        return (None, None)
+    return found.get('sha256') or next(iter(found.values()))
 
 
 class App:
@@ -1045,6 +4732,13 @@ class App:
             helpmenu.add_command(label="About", command=self.show_about)
             helpmenu.add_separator()
             helpmenu.add_command(label="Exit", command=root.quit)
+            librarymenu = Menu(menubar, tearoff=0)
+            librarymenu.add_command(label="Image library budget...", command=self.set_library_budget)
+            self.library_copy_var = BooleanVar(root, value=ImageStore().copy_images)
+            librarymenu.add_checkbutton(label="Copy images that cannot be linked", variable=self.library_copy_var,
+                                        command=self.set_library_copy)
+            librarymenu.add_command(label="Import checksum file...", command=self.import_checksums)
+            menubar.add_cascade(label="Library", menu=librarymenu)
             menubar.add_cascade(label="Help", menu=helpmenu)
             root.config(menu=menubar)
         except Exception:
@@ -1056,7 +4750,7 @@ class App:
         dev_frame.pack(fill='both', expand=True, pady=(0, 8))
 
         self.lb = Listbox(dev_frame, width=100, height=6, font=self.font_monospace,
-                         relief='solid', borderwidth=1)
+                         relief='solid', borderwidth=1, selectmode='extended')
         self.lb.pack(fill='both', expand=True)
         
         # Scrollbar for listbox
@@ -1113,6 +4807,77 @@ class App:
                           bg=self.frame_bg, fg='#999999')
         label_hint.grid(row=1, column=2, sticky='w', pady=(12, 0))
 
+        # ISO write options row
+        self.direct_io_var = BooleanVar(opt_frame, value=False)
+        direct_cb = Checkbutton(opt_frame, text="Direct I/O (O_DIRECT, bypass page cache)",
+                                variable=self.direct_io_var, font=self.font_normal,
+                                bg=self.frame_bg, fg=self.text_color, activebackground=self.frame_bg)
+        direct_cb.grid(row=2, column=0, columnspan=2, sticky='w', pady=(12, 0))
+
+        self.sparse_var = BooleanVar(opt_frame, value=False)
+        sparse_cb = Checkbutton(opt_frame, text="Sparse write (skip zero blocks)",
+                                variable=self.sparse_var, font=self.font_normal,
+                                bg=self.frame_bg, fg=self.text_color, activebackground=self.frame_bg)
+        sparse_cb.grid(row=2, column=2, columnspan=2, sticky='w', pady=(12, 0))
+
+        self.autotune_var = BooleanVar(opt_frame, value=True)
+        autotune_cb = Checkbutton(opt_frame, text="Auto-tune block size per device model",
+                                  variable=self.autotune_var, font=self.font_normal,
+                                  bg=self.frame_bg, fg=self.text_color, activebackground=self.frame_bg)
+        autotune_cb.grid(row=3, column=0, columnspan=2, sticky='w', pady=(4, 0))
+
+        self.verify_var = BooleanVar(opt_frame, value=True)
+        verify_cb = Checkbutton(opt_frame, text="Verify after write (read back from device)",
+                                variable=self.verify_var, font=self.font_normal,
+                                bg=self.frame_bg, fg=self.text_color, activebackground=self.frame_bg)
+        verify_cb.grid(row=3, column=2, columnspan=2, sticky='w', pady=(4, 0))
+
+        self.diff_var = BooleanVar(opt_frame, value=False)
+        diff_cb = Checkbutton(opt_frame, text="Differential re-flash (rewrite changed blocks only)",
+                              variable=self.diff_var, font=self.font_normal,
+                              bg=self.frame_bg, fg=self.text_color, activebackground=self.frame_bg)
+        diff_cb.grid(row=4, column=0, columnspan=2, sticky='w', pady=(4, 0))
+
+        self.bmap_var = BooleanVar(opt_frame, value=False)
+        bmap_cb = Checkbutton(opt_frame, text="Use block map (.bmap): write mapped ranges only",
+                              variable=self.bmap_var, font=self.font_normal,
+                              bg=self.frame_bg, fg=self.text_color, activebackground=self.frame_bg)
+        bmap_cb.grid(row=4, column=2, columnspan=2, sticky='w', pady=(4, 0))
+
+        self.hash_tap_var = BooleanVar(opt_frame, value=True)
+        hash_tap_cb = Checkbutton(opt_frame, text="Check image checksum while writing (single pass)",
+                                  variable=self.hash_tap_var, font=self.font_normal,
+                                  bg=self.frame_bg, fg=self.text_color, activebackground=self.frame_bg)
+        hash_tap_cb.grid(row=5, column=0, columnspan=2, sticky='w', pady=(4, 0))
+
+        self.stage_var = BooleanVar(opt_frame, value=False)
+        stage_cb = Checkbutton(opt_frame, text="Stage image in RAM when it fits (fast repeat flashes)",
+                               variable=self.stage_var, font=self.font_normal,
+                               bg=self.frame_bg, fg=self.text_color, activebackground=self.frame_bg)
+        stage_cb.grid(row=5, column=2, columnspan=2, sticky='w', pady=(4, 0))
+
+        prefetch_label = Label(opt_frame, text="Read-ahead (MB):", font=self.font_normal,
+                               bg=self.frame_bg, fg=self.text_color)
+        prefetch_label.grid(row=6, column=0, sticky='w', padx=(0, 12), pady=(4, 0))
+        self.prefetch_var = IntVar(opt_frame, value=PREFETCH_AHEAD_MB)
+        prefetch_spin = Spinbox(opt_frame, from_=0, to=1024, increment=16, textvariable=self.prefetch_var,
+                                font=self.font_normal, width=6)
+        prefetch_spin.grid(row=6, column=1, sticky='w', padx=(0, 24), pady=(4, 0))
+
+        self.hot_var = BooleanVar(opt_frame, value=False)
+        hot_cb = Checkbutton(opt_frame, text="Keep image in page cache (hot, for repeated flashing)",
+                             variable=self.hot_var, font=self.font_normal,
+                             bg=self.frame_bg, fg=self.text_color, activebackground=self.frame_bg)
+        hot_cb.grid(row=6, column=2, columnspan=2, sticky='w', pady=(4, 0))
+
+        budget_label = Label(opt_frame, text="Memory budget (MB):", font=self.font_normal,
+                             bg=self.frame_bg, fg=self.text_color)
+        budget_label.grid(row=7, column=0, sticky='w', padx=(0, 12), pady=(4, 0))
+        self.budget_var = IntVar(opt_frame, value=MEMORY_BUDGET_MB)
+        budget_spin = Spinbox(opt_frame, from_=32, to=4096, increment=32, textvariable=self.budget_var,
+                              font=self.font_normal, width=6)
+        budget_spin.grid(row=7, column=1, sticky='w', padx=(0, 24), pady=(4, 0))
+
         # Action buttons frame
         action_frame = LabelFrame(main_frame, text="Operations", font=self.font_heading,
                                  bg=self.frame_bg, fg=self.text_color, padx=12, pady=12)
@@ -1148,6 +4913,11 @@ class App:
                                    bg=self.frame_bg, fg='#666666')
         self.progress_label.pack(anchor='e', padx=12, pady=(0, 4))
 
+        # throughput telemetry of the running job (ThroughputMonitor samples)
+        self.rate_label = Label(status_frame, text="", font=self.font_small,
+                                bg=self.frame_bg, fg='#666666')
+        self.rate_label.pack(anchor='w', padx=12, pady=(0, 6))
+
         # Log frame
         log_frame = LabelFrame(main_frame, text="Activity Log", font=self.font_heading,
                               bg=self.frame_bg, fg=self.text_color, padx=8, pady=8)
@@ -1214,6 +4984,46 @@ class App:
             self.progress_label.config(text=f"{pct}%")
         self.root.after(0, _set)
 
+    def set_telemetry(self, stats):
+        """Show a ThroughputMonitor sample: current and EWMA MB/s and ETA, or a stall warning."""
+        color = '#666666'
+        if stats['finished']:
+            text = f"{stats['job']}: finished, average {stats['mbps']:.1f} MB/s"
+        elif stats['stalled']:
+            text = f"{stats['job']}: STALLED - no progress for {int(stats['stalled_for'])} s"
+            color = self.warning_color
+        else:
+            text = f"{stats['job']}: {stats['mbps']:.1f} MB/s now, {stats['ewma_mbps']:.1f} MB/s smoothed"
+            if stats['eta'] is not None:
+                text += f", ETA {format_duration(stats['eta'])}"
+        self.root.after(0, lambda: self.rate_label.config(text=text, fg=color))
+
+    def open_batch_progress(self, devnames):
+        """Open a window with one progress bar per device for a fan-out write.
+        Returns a thread-safe callback(devname, pct); the main bar shows the average."""
+        win = Toplevel(self.root)
+        win.title("Batch Write Progress")
+        win.configure(bg=self.frame_bg)
+        bars = {}
+        done = {name: 0 for name in devnames}
+        for row, name in enumerate(devnames):
+            Label(win, text=f"/dev/{name}", font=self.font_normal, bg=self.frame_bg,
+                  fg=self.text_color).grid(row=row, column=0, sticky='w', padx=12, pady=4)
+            bar = ttk.Progressbar(win, length=300, mode='determinate', maximum=100)
+            bar.grid(row=row, column=1, sticky='ew', padx=12, pady=4)
+            bars[name] = bar
+
+        def update(name, pct):
+            done[name] = pct
+            def _set():
+                try:
+                    bars[name]['value'] = pct
+                except Exception:
+                    pass  # window closed by the user
+            self.root.after(0, _set)
+            self.set_progress(sum(done.values()) // len(done))
+        return update
+
     def refresh(self):
         """Refresh device list with better error handling."""
         try:
@@ -1269,6 +5079,99 @@ class App:
             except Exception:
                 pass
 
+    def choose_image(self, title, filetypes, iso_only=False):
+        """Let the user pick an image: one of the recent images from the image library (its SHA-256
+        is already known, so no hashing is needed) or any file through the file dialog.
+        Returns (path, sha256 or None); path is None if the user cancelled."""
+        recent = [e for e in ImageStore().recent() if not iso_only or e.get('type') == "ISO 9660"]
+        if not recent:
+            return filedialog.askopenfilename(title=title, filetypes=filetypes) or None, None
+        choice = {'path': None, 'sha256': None}
+        win = Toplevel(self.root)
+        win.title(title)
+        win.configure(bg=self.frame_bg)
+        win.transient(self.root)
+        Label(win, text="Recent images:", font=self.font_normal, bg=self.frame_bg,
+              fg=self.text_color).pack(anchor='w', padx=12, pady=(12, 4))
+        lb = Listbox(win, font=self.font_normal, width=70, height=min(len(recent), RECENT_IMAGES))
+        for e in recent:
+            volume = f", {e['volume_id']}" if e.get('volume_id') else ""
+            used = time.strftime('%Y-%m-%d %H:%M', time.localtime(e.get('last_used', 0)))
+            lb.insert(END, f"{e['name']}  ({e['size'] / 1e9:.2f} GB, {e.get('type')}{volume}; used {used})")
+        lb.selection_set(0)
+        lb.pack(fill='both', expand=True, padx=12)
+
+        def use_selected(event=None):
+            sel = lb.curselection()
+            if sel:
+                choice['path'], choice['sha256'] = recent[sel[0]]['path'], recent[sel[0]]['sha256']
+                win.destroy()
+
+        def browse():
+            win.destroy()
+            choice['path'] = filedialog.askopenfilename(title=title, filetypes=filetypes) or None
+
+        lb.bind('<Double-Button-1>', use_selected)
+        buttons = Frame(win, bg=self.frame_bg)
+        buttons.pack(fill='x', padx=12, pady=12)
+        Button(buttons, text="Use selected", command=use_selected, font=self.font_normal).pack(side='left')
+        Button(buttons, text="Browse...", command=browse, font=self.font_normal).pack(side='left', padx=8)
+        Button(buttons, text="Cancel", command=win.destroy, font=self.font_normal).pack(side='right')
+        win.grab_set()
+        self.root.wait_window(win)
+        return choice['path'], choice['sha256']
+
+    def store_image(self, path, digest):
+        """Add a successfully written image to the image library (best effort)."""
+        try:
+            ImageStore().add(path, digest.strip().lower(), self.log_write)
+        except OSError as e:
+            self.log_warning(f"Could not add the image to the library: {e}\n")
+
+    def set_library_budget(self):
+        """Ask for the image library's disk budget and evict images that no longer fit."""
+        store = ImageStore()
+        gb = simpledialog.askinteger("Image Library", "Disk budget for stored images (GB):",
+                                     initialvalue=store.budget // 2**30, minvalue=0, parent=self.root)
+        if gb is None:
+            return
+        try:
+            store.set_budget(gb * 2**30, self.log_write)
+            self.log_info(f"Image library budget set to {gb} GB.\n")
+        except OSError as e:
+            self.log_error(f"Could not update the image library: {e}\n")
+
+    def set_library_copy(self):
+        """Turn full copies into the image library (when an image cannot be hardlinked or
+        reflinked, e.g. on another filesystem) on or off."""
+        enabled = self.library_copy_var.get()
+        try:
+            ImageStore().set_copy_images(enabled)
+        except OSError as e:
+            self.log_error(f"Could not update the image library: {e}\n")
+            return
+        self.log_info(f"Image library: images that cannot be linked are {'copied' if enabled else 'not stored'}.\n")
+
+    def import_checksums(self):
+        """Add the digests in a checksum file (SHA256SUMS, foo.iso.sha256, Fedora CHECKSUM, ...)
+        to the checksum catalog, so the images it lists are verified without going online."""
+        path = filedialog.askopenfilename(title="Import checksum file",
+                                          filetypes=[("Checksum files", "*SUMS *sums *CHECKSUM *.sha256 *.sha512 *.txt"),
+                                                     ("All files", "*.*")])
+        if not path:
+            return
+        try:
+            with open(path, 'r', encoding='utf-8', errors='ignore') as fh:
+                text = fh.read()
+        except OSError as e:
+            self.log_error(f"Could not read {path}: {e}\n")
+            return
+        added = ChecksumCatalog().add_checksum_text(text, path, os.path.basename(path))
+        if added:
+            self.log_info(f"Checksum catalog: {added} image(s) imported from {path}.\n")
+        else:
+            self.log_warning(f"No checksums found in {path}.\n")
+
     def on_format(self):
         """Format selected device with improved validation."""
         if self.operation_in_progress:
@@ -1279,6 +5182,9 @@ class App:
         if not sel:
             messagebox.showwarning("No Device Selected", "Please select a device to format from the list.")
             return
+        if len(sel) > 1:
+            messagebox.showwarning("Multiple Devices Selected", "Formatting works on one device at a time. Please select a single device.")
+            return
         
         idx = sel[0]
         dev = self.devs[idx]
@@ -1347,7 +5253,8 @@ class App:
             try:
                 if action == 'format_partition':
                     self.log_info(f"Formatting partition /dev/{target_node} as {fs_key}...\n")
-                    run_format(target_node, mkcmd, fs_key, label, self.log_write, progress_cb=self.set_progress)
+                    run_format(target_node, mkcmd, fs_key, label, self.log_write, progress_cb=self.set_progress,
+                               stats_cb=self.set_telemetry)
                     self.log_success(f"Successfully formatted /dev/{target_node}\n")
                 else:
                     # create a partition then format it using selected label type
@@ -1359,7 +5266,8 @@ class App:
                         return
                     self.log_info(f"Created new partition: /dev/{newp}\n")
                     self.log_info(f"Formatting /dev/{newp} as {fs_key}...\n")
-                    run_format(newp, mkcmd, fs_key, label, self.log_write, progress_cb=self.set_progress)
+                    run_format(newp, mkcmd, fs_key, label, self.log_write, progress_cb=self.set_progress,
+                               stats_cb=self.set_telemetry)
                     self.log_success(f"Successfully formatted /dev/{newp}\n")
             except Exception as e:
                 self.log_error(f"Format operation failed: {e}\n")
@@ -1390,22 +5298,33 @@ class App:
         dev = self.devs[idx]
         devname = dev.get("name")
         devsize = dev.get("size", "Unknown")
-        
-        msg = (
-            f"WARNING: WRITE LINUX ISO TO USB\n\n"
-            f"Device: /dev/{devname}\n"
-            f"Size: {devsize}\n\n"
-            f"WARNING: ALL DATA WILL BE LOST\n\n"
-            f"Do you want to continue?"
-        )
+        # several selected devices -> fan-out batch write
+        batch = [self.devs[i].get("name") for i in sel] if len(sel) > 1 else None
+
+        if batch:
+            dev_lines = "\n".join(f"/dev/{self.devs[i].get('name')} ({self.devs[i].get('size', 'Unknown')})" for i in sel)
+            msg = (
+                f"WARNING: WRITE LINUX ISO TO {len(batch)} USB DEVICES\n\n"
+                f"{dev_lines}\n\n"
+                f"WARNING: ALL DATA ON ALL OF THEM WILL BE LOST\n\n"
+                f"Do you want to continue?"
+            )
+        else:
+            msg = (
+                f"WARNING: WRITE LINUX ISO TO USB\n\n"
+                f"Device: /dev/{devname}\n"
+                f"Size: {devsize}\n\n"
+                f"WARNING: ALL DATA WILL BE LOST\n\n"
+                f"Do you want to continue?"
+            )
         if not messagebox.askyesno("Confirm Write", msg):
             self.log_info("ISO write operation cancelled by user.\n")
             return
 
-        # Prompt user to select a local ISO file
-        iso_path = filedialog.askopenfilename(
-            title="Select Linux ISO file",
-            filetypes=[("ISO files", "*.iso"), ("All files", "*")]
+        # Prompt user to select a recent image from the library or a local ISO file
+        iso_path, known_digest = self.choose_image(
+            "Select Linux ISO or disk image",
+            [("ISO and disk images", "*.iso *.img *.xz *.gz *.zst *.bz2"), ("ISO files", "*.iso"), ("All files", "*")]
         )
         if not iso_path:
             self.log_info("ISO file selection cancelled.\n")
@@ -1419,36 +5338,136 @@ class App:
 
         def proceed_with_iso(chosen_iso):
             """Compute hash (if enabled) and write ISO to device in background."""
-            compute_hash_local = True
+            # images from the library were hashed when they were stored (and are unchanged since)
+            library_digest = known_digest if known_digest and ImageStore().lookup(known_digest) else None
+            if known_digest and not library_digest:
+                self.log_warning("The library image changed since it was stored; it will be hashed again.\n")
+            compute_hash_local = library_digest is None
+            direct_io = self.direct_io_var.get()
+            sparse = self.sparse_var.get()
+            autotune = self.autotune_var.get()
+            verify = self.verify_var.get()
+            diff = self.diff_var.get()
+            use_bmap = self.bmap_var.get()
+            stage = self.stage_var.get()
+            try:
+                prefetch_mb = max(0, self.prefetch_var.get())
+            except Exception:
+                prefetch_mb = PREFETCH_AHEAD_MB  # not a number in the spinbox
+            hot = self.hot_var.get()
+            try:
+                budget_mb = max(32, self.budget_var.get())
+            except Exception:
+                budget_mb = MEMORY_BUDGET_MB
+            # the image can be hashed as a tap in the write (the fan-out reader, for batches)
+            hash_tap = compute_hash_local and self.hash_tap_var.get()
             self.operation_in_progress = True
 
             def worker_all():
                 try:
+                    digest = library_digest
+                    if library_digest:
+                        self.log_info(f"Image from the library, SHA-256 {library_digest} (no hashing needed).\n")
+                        ImageStore().touch(library_digest)
+                    # SHA-256 always (library, online lookup), plus whatever the local checksum files use
+                    local_sums = find_checksums(chosen_iso) if compute_hash_local else {}
+                    algorithms = ['sha256'] + sorted(a for a in local_sums if a != 'sha256')
+                    labels = ', '.join(digest_label(a) for a in algorithms)
+                    # digests cached for the file as it is now make the up-front check instant
+                    use_tap = hash_tap and any(DigestCache().get(chosen_iso, a) is None for a in algorithms)
+                    late_digests = None  # hashed before the write, compared once the lookup is done
                     if compute_hash_local:
-                        self.log_info("Computing SHA-256 checksum...\n")
-                        digest = compute_iso_sha256(chosen_iso, self.log_write, progress_cb=self.set_progress)
-                        if digest:
-                            iso_name = os.path.basename(chosen_iso)
+                        # look up the published checksum while the image is hashed or written
+                        lookup_pool = ThreadPoolExecutor(max_workers=1)
+                        expected_future = lookup_pool.submit(self.lookup_expected_digests, chosen_iso, local_sums)
+                        lookup_pool.shutdown(wait=False)
+                    if use_tap:
+                        self.log_info(f"{labels} will be computed while writing (single pass over the image).\n")
+                    elif compute_hash_local:
+                        self.log_info(f"Computing {labels} checksum...\n")
+                        digests = compute_iso_digests(chosen_iso, algorithms, self.log_write,
+                                                      progress_cb=self.set_progress, stats_cb=self.set_telemetry,
+                                                      hot=hot)
+                        if digests:
+                            digest = digests['sha256']
                             self.log_info(f"Local checksum: {digest}\n")
-                            self.log_info("Checking online checksum...\n")
-                            online_digest = fetch_online_sha256(iso_name, self.log_write)
-                            if online_digest:
-                                if online_digest.strip().lower() != digest.strip().lower():
-                                    self.log_warning("⚠️  Online checksum does NOT match. Proceeding anyway.\n")
-                                else:
-                                    self.log_success("[OK] Online checksum matches!\n")
+                            if not expected_future.done():
+                                # the network never holds up the write
+                                self.log_info("Checksum lookup still running; it is compared after the write.\n")
+                                late_digests = digests
                             else:
-                                chk_file, expected = find_checksum_file(chosen_iso)
-                                if chk_file and expected:
-                                    if expected.strip().lower() != digest.strip().lower():
-                                        self.log_warning("⚠️  Local checksum file does NOT match. Proceeding anyway.\n")
-                                    else:
-                                        self.log_success("[OK] Local checksum matches!\n")
-                                else:
-                                    self.log_info("No checksum file found for verification.\n")
+                                source, expected = expected_future.result()
+                                if self.report_checksum(source, expected, digests, chosen_iso) is False:
+                                    self.log_warning(f"⚠️  {source} checksum does NOT match. Proceeding anyway.\n")
+                                    digest = None  # keep a corrupt image out of the library
+
+                    # compares late_digests once the lookup is done; False on a mismatch
+                    def late_check():
+                        source, expected = expected_future.result()
+                        if self.report_checksum(source, expected, late_digests, chosen_iso) is False:
+                            self.log_warning(f"⚠️  {source} checksum does NOT match the image just written.\n")
+                            return False
+                        return True
                     # proceed to write
+                    if batch:
+                        self.log_info(f"Writing ISO to {len(batch)} devices in fan-out mode...\n")
+                        ignored = [label for label, on in (("sparse", sparse), ("auto-tune", autotune),
+                                                           ("differential", diff), ("block map", use_bmap)) if on]
+                        if ignored:
+                            self.log_warning(f"Batch writes ignore these options: {', '.join(ignored)}; "
+                                             f"every block is written with {WRITE_CHUNK_SIZE // 1024} KiB chunks.\n")
+                        tap = MultiHasher(algorithms) if use_tap else None
+                        results = write_iso_to_devices(batch, chosen_iso, self.log_write,
+                                                       progress_cb=batch_progress, direct=direct_io,
+                                                       verify=verify, source_hash=tap, stage=stage,
+                                                       prefetch_mb=prefetch_mb, hot=hot, memory_budget_mb=budget_mb)
+                        for name in batch:
+                            if results.get(name):
+                                self.log_success(f"[OK] /dev/{name} written{' and verified' if verify else ''}.\n")
+                            else:
+                                self.log_error(f"[FAILED] /dev/{name}. See the log above for details.\n")
+                        if tap is not None and any(results.values()):
+                            digests = tap.hexdigests()
+                            digest = digests['sha256']
+                            self.log_info(f"Local checksum: {digest}\n")
+                            source, expected = expected_future.result()
+                            if self.report_checksum(source, expected, digests, chosen_iso) is False:
+                                self.log_error(f"{source} checksum does NOT match: image corrupt, "
+                                               f"contents of the written devices invalid.\n")
+                                return
+                        if late_digests is not None and not late_check():
+                            digest = None
+                        if digest and not library_digest and any(results.values()):
+                            self.store_image(chosen_iso, digest)
+                        return
                     self.log_info(f"Writing ISO to /dev/{devname}...\n")
-                    write_iso_to_device(devname, chosen_iso, self.log_write, progress_cb=self.set_progress)
+                    tap = MultiHasher(algorithms) if use_tap else None
+                    ok = write_iso_to_device(devname, chosen_iso, self.log_write, progress_cb=self.set_progress,
+                                             direct=direct_io, sparse=sparse, autotune=autotune,
+                                             verify=verify, resumable=True, image_id=digest, diff=diff,
+                                             bmap=use_bmap, source_hash=tap, stats_cb=self.set_telemetry,
+                                             stage=stage, prefetch_mb=prefetch_mb, hot=hot,
+                                             memory_budget_mb=budget_mb)
+                    if not ok:
+                        self.log_error(f"Writing ISO to /dev/{devname} failed. See the log above for details.\n")
+                        return
+                    if tap is not None:
+                        digests = tap.hexdigests()
+                        digest = digests['sha256']
+                        self.log_info(f"Local checksum: {digest}\n")
+                        source, expected = expected_future.result()
+                        if self.report_checksum(source, expected, digests, chosen_iso) is False:
+                            self.log_error(f"{source} checksum does NOT match: image corrupt, device contents invalid.\n")
+                            self.root.after(0, lambda: messagebox.showerror(
+                                "Image Corrupt",
+                                f"The image checksum does not match the {source.lower()} checksum.\n\n"
+                                f"Image corrupt, device contents invalid.\n\n"
+                                f"Download the image again and rewrite /dev/{devname}."))
+                            return
+                    if late_digests is not None and not late_check():
+                        digest = None
+                    if digest and not library_digest:
+                        self.store_image(chosen_iso, digest)
                     # after writing, ask user if they want to mount to inspect files
                     def ask_mount():
                         try:
@@ -1484,6 +5503,8 @@ class App:
                         self.log_success("ISO write operation completed.\n")
                     self.root.after(0, finish_all)
 
+            batch_progress = self.open_batch_progress(batch) if batch else None
+
             # start background worker
             self.format_btn.config(state='disabled')
             self.iso_btn.config(state='disabled')
@@ -1493,6 +5514,66 @@ class App:
         
         proceed_with_iso(iso_path)
 
+    def lookup_expected_digests(self, iso_path, local_sums=None):
+        """Find the published digests of iso_path, most trustworthy source first: the checksum
+        files next to it (local_sums, as returned by find_checksums, if already known), the
+        checksum catalog, the project's published checksum file (fetch_published_digests) and,
+        as a last resort, a web search (source "Web search", which report_checksum does not
+        trust with a mismatch). Returns (source, {algorithm: lowercase hex digest}); source is
+        None if none was found."""
+        if local_sums is None:
+            local_sums = find_checksums(iso_path)
+        if local_sums:
+            return "Local", {alg: digest for alg, (path, digest) in local_sums.items()}
+        name = os.path.basename(iso_path)
+        catalog = ChecksumCatalog()
+        digests, source = catalog.lookup(name)
+        if digests:
+            self.log_info(f"Published checksum from the checksum catalog ({source}).\n")
+            return "Catalog", digests
+        self.log_info("Checking online checksum...\n")
+        digests = fetch_published_digests(name, self.log_write, catalog)
+        if digests:
+            return "Online", digests
+        try:
+            size = os.path.getsize(iso_path)
+        except OSError:
+            size = None
+        online_digest = fetch_online_sha256(name, self.log_write, size=size)
+        if online_digest:
+            return "Web search", {'sha256': online_digest.strip().lower()}
+        return None, {}
+
+    def report_checksum(self, source, expected, actual, image_path=None):
+        """Log how the published digests compare with the computed ones ({algorithm: hex}).
+        Returns False on a mismatch (left to the caller to report), True if everything
+        comparable matches, None if there was nothing to compare. A web search's digest may
+        belong to another file, so its mismatch is only warned about (None). When only
+        algorithms that were not computed are published, image_path is hashed for them."""
+        matched, mismatched = compare_digests(expected, actual)
+        if expected and not (matched or mismatched):
+            published = [a for a in expected if a in hashlib.algorithms_available]
+            labels = ', '.join(digest_label(a) for a in expected)
+            if image_path and published:
+                self.log_info(f"{source} publishes {labels}, which was not computed; hashing the image for it...\n")
+                extra = compute_iso_digests(image_path, published, self.log_write, progress_cb=self.set_progress,
+                                            stats_cb=self.set_telemetry)
+                if extra:
+                    return self.report_checksum(source, expected, dict(actual, **extra))
+            self.log_warning(f"{source} {labels} checksum found but not computed; the image was not checked.\n")
+            return None
+        if mismatched and source == "Web search":
+            self.log_warning("⚠️  The checksum a web search turned up does NOT match; it may belong to another "
+                             "file, so the image is not treated as corrupt.\n")
+            return None
+        if mismatched:
+            return False
+        if matched:
+            self.log_success(f"[OK] {source} {', '.join(digest_label(a) for a in matched)} checksum matches!\n")
+            return True
+        self.log_info("No checksum file found for verification.\n")
+        return None
+
     def on_write_windows_iso(self):
         """Handle writing Windows ISO (7, 10, or 11) to USB device."""
         if self.operation_in_progress:
@@ -1503,6 +5584,9 @@ class App:
         if not sel:
             messagebox.showwarning("No Device Selected", "Please select a device to write the Windows ISO to.")
             return
+        if len(sel) > 1:
+            messagebox.showwarning("Multiple Devices Selected", "Windows ISOs are written to one device at a time. Please select a single device.")
+            return
         idx = sel[0]
         dev = self.devs[idx]
         devname = dev.get("name")
@@ -1520,11 +5604,13 @@ class App:
             self.log_info("Windows ISO write operation cancelled by user.\n")
             return
         
-        # Prompt user to select a Windows ISO file
-        iso_path = filedialog.askopenfilename(
-            title="Select Windows ISO (7, 10, or 11)",
-            filetypes=[("ISO files", "*.iso"), ("All files", "*")]
+        # Prompt user to select a recent ISO from the library or a Windows ISO file
+        iso_path, known_digest = self.choose_image(
+            "Select Windows ISO (7, 10, or 11)",
+            [("ISO files", "*.iso"), ("All files", "*")], iso_only=True
         )
+        if known_digest:
+            ImageStore().touch(known_digest)
         if not iso_path:
             self.log_info("ISO file selection cancelled.\n")
             return
@@ -1550,7 +5636,8 @@ class App:
         def worker():
             try:
                 self.operation_in_progress = True
-                write_windows_iso_to_device(devname, iso_path, self.log_write, progress_cb=self.set_progress)
+                write_windows_iso_to_device(devname, iso_path, self.log_write, progress_cb=self.set_progress,
+                                            stats_cb=self.set_telemetry)
                 self.log_success(f"Windows ISO written successfully to /dev/{devname}\n")
             except Exception as e:
                 self.log_error(f"Windows ISO write failed: {e}\n")
@@ -1587,7 +5674,7 @@ if __name__ == '__main__':
         sys.exit(1)
 
     # Now import tkinter widgets into globals (safe after dependencies are present)
-    from tkinter import Tk, Listbox, StringVar, OptionMenu, Button, Label, Entry, Text, END, Scrollbar, RIGHT, Y, BOTH, Frame, messagebox, filedialog, simpledialog, Menu, LabelFrame
+    from tkinter import Tk, Listbox, StringVar, OptionMenu, Button, Label, Entry, Text, END, Scrollbar, RIGHT, Y, BOTH, Frame, messagebox, filedialog, simpledialog, Menu, LabelFrame, Checkbutton, BooleanVar, Toplevel, Spinbox, IntVar
     from tkinter import ttk
 
     # Splash support removed; start application directly
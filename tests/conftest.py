@@ -0,0 +1,43 @@
+"""Shared fixtures: the app module on sys.path, and every state file the app keeps next to
+itself (digest cache, write journal, image library, ...) redirected into the test's tmp_path."""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import format_usb_gui as app  # noqa: E402
+
+# a fixed hashing profile, so no test runs (or stores) the hashing benchmark
+HASH_PROFILE = {'chunk_algorithm': 'sha256', 'chunk_size': 256 * 1024, 'rates': {'sha256': {'262144': 1.0}}}
+
+
+@pytest.fixture(autouse=True)
+def state_files(tmp_path, monkeypatch):
+    state = tmp_path / 'state'
+    state.mkdir()
+    monkeypatch.setattr(app, '_hash_profile', dict(HASH_PROFILE))
+    monkeypatch.setattr(app, 'HASH_PROFILE', state / 'hash_profile.json')
+    monkeypatch.setattr(app, 'DEVICE_PROFILES', state / 'device_profiles.json')
+    for func, name in ((app.DigestCache.__init__, 'digest_cache.json'),
+                       (app.WriteJournal.__init__, 'write_journal.json'),
+                       (app.WriteJournal.stored_chunk_size.__func__, 'write_journal.json'),
+                       (app.OnlineChecksumCache.__init__, 'online_checksums.json'),
+                       (app.ChecksumCatalog.__init__, 'checksum_catalog.json'),
+                       (app.ImageStore.__init__, 'image_store')):
+        monkeypatch.setattr(func, '__defaults__', func.__defaults__[:-1] + (str(state / name),))
+    monkeypatch.setattr(app, '_checksum_indexes', {})
+    return state
+
+
+@pytest.fixture
+def log():
+    """A log callback that keeps what it was given; str(log) is the whole log."""
+    class Log(list):
+        def __call__(self, text):
+            self.append(text)
+
+        def __str__(self):
+            return ''.join(self)
+    return Log()
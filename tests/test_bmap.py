@@ -0,0 +1,129 @@
+"""Block maps: generating one from a sparse image, loading .bmap files, writing and verifying
+the mapped ranges, with regular files standing in for the device."""
+import gzip
+import hashlib
+import os
+
+import pytest
+
+import format_usb_gui as app
+
+MIB = 1024 * 1024
+
+
+@pytest.fixture
+def sparse_image(tmp_path):
+    """1 MiB of data, a 2 MiB hole, 1 MiB of zeros written as data, 1 MiB of data."""
+    path = tmp_path / 'sparse.img'
+    data, tail = os.urandom(MIB), os.urandom(MIB)
+    with open(path, 'wb') as fh:
+        fh.write(data)
+        fh.seek(3 * MIB)
+        fh.write(bytes(MIB))
+        fh.write(tail)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        has_hole = os.lseek(fd, 0, os.SEEK_HOLE) < os.path.getsize(path)
+    finally:
+        os.close(fd)
+    if not has_hole:
+        pytest.skip("the temporary filesystem does not report holes")
+    return path
+
+
+def bmap_xml(image_size, ranges, checksum_type='sha256', with_file_checksum=True):
+    body = ''.join(f'<Range chksum="{c}">{first}-{last}</Range>' for first, last, c in ranges)
+    placeholder = '0' * len(hashlib.new(checksum_type).hexdigest())
+    xml = (f'<?xml version="1.0" ?>\n<bmap version="2.0">\n<ImageSize>{image_size}</ImageSize>\n'
+           f'<BlockSize>4096</BlockSize>\n<ChecksumType>{checksum_type}</ChecksumType>\n'
+           + (f'<BmapFileChecksum>{placeholder}</BmapFileChecksum>\n' if with_file_checksum else '')
+           + f'<BlockMap>{body}</BlockMap>\n</bmap>\n')
+    if with_file_checksum:
+        xml = xml.replace(placeholder, hashlib.new(checksum_type, xml.encode()).hexdigest())
+    return xml
+
+
+def test_generate_leaves_only_holes_unmapped(sparse_image, log):
+    bmap = app.BlockMap.generate(str(sparse_image), log)
+    data = sparse_image.read_bytes()
+    assert [(start, end) for start, end, _ in bmap.extents()] == [(0, MIB), (3 * MIB, 5 * MIB)]
+    for start, end, checksum in bmap.extents():
+        assert checksum == hashlib.sha256(data[start:end]).hexdigest()
+    assert bmap.mapped_bytes == 3 * MIB
+
+
+def test_write_and_verify_mapped_ranges(sparse_image, tmp_path, log):
+    bmap = app.BlockMap.generate(str(sparse_image), log)
+    device = tmp_path / 'device'
+    device.write_bytes(b'\xaa' * 5 * MIB)
+    assert app.write_image_bmap(str(sparse_image), str(device), bmap, log, chunk_size=MIB // 2) == 3 * MIB
+    written, data = device.read_bytes(), sparse_image.read_bytes()
+    assert written[:MIB] == data[:MIB] and written[3 * MIB:] == data[3 * MIB:]
+    assert written[MIB:3 * MIB] == b'\xaa' * 2 * MIB  # the hole is left as the device had it
+    assert app.verify_bmap(str(device), bmap, log)
+    with open(device, 'r+b') as fh:
+        fh.seek(4 * MIB)
+        fh.write(b'\1')
+    assert not app.verify_bmap(str(device), bmap, log)
+
+
+def test_load_checks_the_file_checksum(tmp_path):
+    data = os.urandom(8192)
+    ranges = [(0, 1, hashlib.sha256(data).hexdigest())]
+    path = tmp_path / 'a.img.bmap'
+    path.write_text(bmap_xml(len(data), ranges))
+    bmap = app.BlockMap.load(str(path))
+    assert (bmap.image_size, bmap.block_size, bmap.ranges) == (8192, 4096, [[0, 1, ranges[0][2]]])
+    path.write_text(bmap_xml(len(data), ranges).replace('0-1', '0-0'))
+    with pytest.raises(ValueError):
+        app.BlockMap.load(str(path))
+
+
+def test_for_image_uses_a_matching_bmap(tmp_path, log):
+    data = os.urandom(8192)
+    image = tmp_path / 'a.img'
+    image.write_bytes(data)
+    (tmp_path / 'a.img.bmap').write_text(bmap_xml(len(data), [(0, 0, hashlib.sha256(data[:4096]).hexdigest())]))
+    bmap = app.BlockMap.for_image(str(image), log)
+    assert bmap.source == str(tmp_path / 'a.img.bmap')
+    assert bmap.mapped_bytes == 4096
+
+
+def test_for_image_ignores_a_stale_bmap(tmp_path, log):
+    data = os.urandom(8192)
+    image = tmp_path / 'a.img'
+    image.write_bytes(data + os.urandom(4096))  # the image was rebuilt after the map
+    (tmp_path / 'a.img.bmap').write_text(bmap_xml(len(data), [(0, 1, hashlib.sha256(data).hexdigest())]))
+    bmap = app.BlockMap.for_image(str(image), log)
+    assert "Ignoring block map" in str(log)
+    assert bmap.source is None and bmap.image_size == len(data) + 4096
+
+
+def test_write_fails_on_a_range_checksum_mismatch(tmp_path, log):
+    data = os.urandom(8192)
+    image = tmp_path / 'a.img'
+    image.write_bytes(data)
+    bmap = app.BlockMap(len(data), 4096, [[0, 1, hashlib.sha256(b'something else').hexdigest()]])
+    device = tmp_path / 'device'
+    device.write_bytes(b'')
+    assert app.write_image_bmap(str(image), str(device), bmap, log) is None
+    assert "checksum mismatch" in str(log)
+
+
+def test_write_fails_when_a_gzip_image_outgrows_its_bmap(tmp_path, log):
+    data = os.urandom(8192)
+    image = tmp_path / 'a.img.gz'
+    image.write_bytes(gzip.compress(data + os.urandom(4096)))
+    bmap = app.BlockMap(len(data), 4096, [[0, 1, hashlib.sha256(data).hexdigest()]])
+    device = tmp_path / 'device'
+    device.write_bytes(b'')
+    assert app.write_image_bmap(str(image), str(device), bmap, log) is None
+    assert "longer than" in str(log)
+
+
+def test_find_bmap_file_for_compressed_images(tmp_path):
+    image = tmp_path / 'foo.img.xz'
+    image.write_bytes(b'')
+    assert app.find_bmap_file(str(image)) is None
+    (tmp_path / 'foo.img.bmap').write_text('')
+    assert app.find_bmap_file(str(image)) == str(tmp_path / 'foo.img.bmap')
@@ -0,0 +1,187 @@
+"""What the app remembers about image files: the digest cache, the image library and the
+per-directory checksum index, each keyed so a changed file is never taken for the old one."""
+import hashlib
+import os
+
+import pytest
+
+import format_usb_gui as app
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def touch_ctime_only(path):
+    """Change a file's contents in place but put its mtime back, as some tools do."""
+    st = os.stat(path)
+    with open(path, 'r+b') as fh:
+        fh.write(b'X')
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def test_digest_cache_hit(tmp_path):
+    image = tmp_path / 'a.iso'
+    image.write_bytes(b'image')
+    cache = app.DigestCache()
+    cache.put(str(image), 'sha256', sha256(b'image'))
+    assert cache.get(str(image)) == sha256(b'image')
+    assert cache.get(str(image), 'sha512') is None
+
+
+@pytest.mark.parametrize('change', ['rewrite', 'mtime restored', 'replaced'])
+def test_digest_cache_misses_a_changed_file(tmp_path, change):
+    image = tmp_path / 'a.iso'
+    image.write_bytes(b'image')
+    cache = app.DigestCache()
+    cache.put(str(image), 'sha256', sha256(b'image'))
+    if change == 'rewrite':
+        image.write_bytes(b'other')
+    elif change == 'mtime restored':
+        touch_ctime_only(image)
+    else:
+        replacement = tmp_path / 'new.iso'
+        replacement.write_bytes(b'image')
+        os.replace(replacement, image)
+    assert cache.get(str(image)) is None
+
+
+def test_digest_cache_keeps_the_identity_taken_before_hashing(tmp_path):
+    image = tmp_path / 'a.iso'
+    image.write_bytes(b'image')
+    identity = app.DigestCache.key(str(image))
+    image.write_bytes(b'changed while hashing')
+    app.DigestCache().put(str(image), 'sha256', sha256(b'image'), identity=identity)
+    assert app.DigestCache().get(str(image)) is None
+
+
+def test_digest_cache_drops_older_states_of_a_file(tmp_path):
+    image = tmp_path / 'a.iso'
+    image.write_bytes(b'one')
+    cache = app.DigestCache()
+    cache.put(str(image), 'sha256', sha256(b'one'))
+    image.write_bytes(b'two!')
+    cache.put(str(image), 'sha256', sha256(b'two!'))
+    assert len(cache._load_all()) == 1
+
+
+def add_image(store, tmp_path, name, size, log):
+    path = tmp_path / name
+    data = os.urandom(size)
+    path.write_bytes(data)
+    digest = sha256(data)
+    store.add(str(path), digest, log)
+    return path, digest
+
+
+def test_image_store_hardlinks_and_finds_images(tmp_path, log):
+    store = app.ImageStore()
+    path, digest = add_image(store, tmp_path, 'a.img', 4096, log)
+    entry = store.lookup(digest)
+    assert entry['name'] == 'a.img' and entry['method'] == 'hardlink'
+    assert os.path.samefile(entry['path'], path)
+    assert [e['sha256'] for e in store.recent()] == [digest]
+
+
+def test_image_store_evicts_least_recently_used(tmp_path, log):
+    store = app.ImageStore()
+    first, d1 = add_image(store, tmp_path, 'first.img', 40000, log)
+    second, d2 = add_image(store, tmp_path, 'second.img', 40000, log)
+    # with the originals gone the library's links are the only copies and count against the budget
+    first.unlink()
+    second.unlink()
+    store.touch(d1)
+    store.set_budget(100000, log)
+    third, d3 = add_image(store, tmp_path, 'third.img', 40000, log)
+    third.unlink()
+    store.set_budget(100000, log)
+    assert store.lookup(d2) is None
+    assert store.lookup(d1) is not None and store.lookup(d3) is not None
+    assert "evicted second.img" in str(log)
+
+
+def test_image_store_linked_originals_cost_nothing(tmp_path, log):
+    store = app.ImageStore()
+    store.set_budget(1000, log)
+    _, digest = add_image(store, tmp_path, 'big.img', 40000, log)
+    assert store.lookup(digest) is not None
+
+
+def test_image_store_drops_an_object_changed_through_its_hardlink(tmp_path, log):
+    store = app.ImageStore()
+    path, digest = add_image(store, tmp_path, 'a.img', 4096, log)
+    touch_ctime_only(path)
+    os.utime(path)  # the rewrite moved the mtime on
+    assert store.lookup(digest) is None
+    assert store.recent() == []
+    assert not (store.root / 'objects' / digest).exists()
+
+
+def test_link_or_copy_only_copies_when_allowed(tmp_path):
+    shm = '/dev/shm'
+    if not os.path.isdir(shm) or os.stat(shm).st_dev == os.stat(tmp_path).st_dev:
+        pytest.skip("needs a second filesystem")
+    src = os.path.join(shm, f"link-or-copy-{os.getpid()}")
+    with open(src, 'wb') as fh:
+        fh.write(b'data')
+    try:
+        with pytest.raises(OSError):
+            app.link_or_copy(src, str(tmp_path / 'dst'))
+        assert not (tmp_path / 'dst').exists()
+        assert app.link_or_copy(src, str(tmp_path / 'dst'), allow_copy=True) == 'copy'
+        assert (tmp_path / 'dst').read_bytes() == b'data'
+    finally:
+        os.unlink(src)
+
+
+@pytest.fixture
+def parse_count(monkeypatch):
+    """Count the checksum files ChecksumIndex parses."""
+    parsed = []
+    parse = app.ChecksumIndex._parse
+
+    def counting(path, name):
+        parsed.append(name)
+        return parse(path, name)
+    monkeypatch.setattr(app.ChecksumIndex, '_parse', staticmethod(counting))
+    return parsed
+
+
+def bump_mtime(path, step=1):
+    """Move a directory's mtime on explicitly: creating files within one timestamp tick may not."""
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + step * 1000000000))
+
+
+def test_checksum_index_parses_each_file_once(tmp_path, parse_count):
+    (tmp_path / 'SHA256SUMS').write_text(f"{'a' * 64}  one.iso\n{'b' * 64}  two.iso\n")
+    (tmp_path / 'notes.txt').write_text("not a checksum file\n")
+    index = app.checksum_index(str(tmp_path))
+    assert index.lookup('one.iso') == {'sha256': (str(tmp_path / 'SHA256SUMS'), 'a' * 64)}
+    assert index.lookup('two.iso')['sha256'][1] == 'b' * 64
+    assert index.lookup('three.iso') == {}
+    assert parse_count == ['SHA256SUMS']
+    assert app.checksum_index(str(tmp_path)) is index
+
+
+def test_checksum_index_sees_changed_and_new_files(tmp_path, parse_count):
+    sums = tmp_path / 'SHA256SUMS'
+    sums.write_text(f"{'a' * 64}  one.iso\n")
+    index = app.checksum_index(str(tmp_path))
+    assert index.lookup('one.iso')['sha256'][1] == 'a' * 64
+    sums.write_text(f"{'c' * 64}  one.iso\n{'d' * 64}  two.iso\n")
+    assert index.lookup('one.iso')['sha256'][1] == 'c' * 64
+    (tmp_path / 'three.iso.sha512').write_text('e' * 128 + '\n')
+    bump_mtime(tmp_path)
+    assert index.lookup('three.iso') == {'sha512': (str(tmp_path / 'three.iso.sha512'), 'e' * 128)}
+    assert parse_count == ['SHA256SUMS', 'SHA256SUMS', 'three.iso.sha512']
+    (tmp_path / 'three.iso.sha512').unlink()
+    bump_mtime(tmp_path, 2)
+    assert index.lookup('three.iso') == {}
+
+
+def test_checksum_index_ignores_the_apps_own_state_files(tmp_path, parse_count):
+    catalog = app.ChecksumCatalog(str(tmp_path / 'checksum_catalog.json'))
+    catalog.add_checksum_text(f"{'a' * 64}  one.iso\n", 'test', 'SHA256SUMS')
+    assert app.checksum_index(str(tmp_path)).lookup('one.iso') == {}
+    assert parse_count == []
@@ -0,0 +1,169 @@
+"""Checksum file parsing and the distribution resolvers (no network: the fetch test serves
+the checksum file from a local HTTP server configured as the resolver's mirror)."""
+import functools
+import http.server
+import threading
+
+import pytest
+
+import format_usb_gui as app
+
+SHA256_A = 'a' * 64
+SHA256_B = '0123456789abcdef' * 4
+SHA512_C = 'c' * 128
+
+
+def test_parse_gnu_lines():
+    text = (f"{SHA256_A}  ubuntu-24.04.1-desktop-amd64.iso\n"
+            f"{SHA256_B} *ubuntu-24.04.1-live-server-amd64.iso\n")
+    assert app.parse_checksum_text(text, 'SHA256SUMS') == {
+        'ubuntu-24.04.1-desktop-amd64.iso': {'sha256': SHA256_A},
+        'ubuntu-24.04.1-live-server-amd64.iso': {'sha256': SHA256_B},
+    }
+
+
+def test_parse_gnu_lines_with_paths_and_uppercase_hex():
+    text = f"{SHA256_B.upper()}  ./iso-cd/debian-12.7.0-amd64-netinst.iso\n"
+    assert app.parse_checksum_text(text, 'SHA256SUMS') == {
+        'debian-12.7.0-amd64-netinst.iso': {'sha256': SHA256_B}}
+
+
+def test_parse_gnu_sha512_by_length():
+    text = f"{SHA512_C}  debian-12.7.0-amd64-netinst.iso\n"
+    assert app.parse_checksum_text(text, 'SHA512SUMS') == {
+        'debian-12.7.0-amd64-netinst.iso': {'sha512': SHA512_C}}
+
+
+def test_parse_escaped_names():
+    # sha256sum starts the line with a backslash and escapes names holding \\ or a newline
+    text = (f"\\{SHA256_A}  my\\\\disk.iso\n"
+            f"\\{SHA256_B} *two\\nlines.iso\n"
+            f"\\SHA256 (back\\\\slash.iso) = {SHA256_A}\n")
+    assert app.parse_checksum_text(text, 'SHA256SUMS') == {
+        'my\\disk.iso': {'sha256': SHA256_A},
+        'two\nlines.iso': {'sha256': SHA256_B},
+        'back\\slash.iso': {'sha256': SHA256_A},
+    }
+
+
+def test_parse_bsd_tags():
+    text = (f"SHA256 (Fedora-Workstation-Live-41-1.4.x86_64.iso) = {SHA256_A}\n"
+            f"SHA512 (Fedora-Workstation-Live-41-1.4.x86_64.iso) = {SHA512_C}\n")
+    assert app.parse_checksum_text(text, 'Fedora-Workstation-41-1.4-x86_64-CHECKSUM') == {
+        'Fedora-Workstation-Live-41-1.4.x86_64.iso': {'sha256': SHA256_A, 'sha512': SHA512_C}}
+
+
+def test_parse_bare_digest_is_credited_to_the_image():
+    name = '2024-07-04-raspios-bookworm-arm64-lite.img.xz'
+    assert app.parse_checksum_text(f"{SHA256_A}\n", name + '.sha256') == {name: {'sha256': SHA256_A}}
+
+
+def test_parse_clearsigned_checksum_file():
+    text = ("-----BEGIN PGP SIGNED MESSAGE-----\n"
+            "Hash: SHA256\n"
+            "\n"
+            "# Fedora-Workstation-Live-41-1.4.x86_64.iso: 2398523392 bytes\n"
+            f"SHA256 (Fedora-Workstation-Live-41-1.4.x86_64.iso) = {SHA256_B}\n"
+            "-----BEGIN PGP SIGNATURE-----\n"
+            "\n"
+            "iQIzBAEBCAAdFiEEEV35rr8K6n3oVnGh2NWNQqT5ZNYFAmcaAbcACgkQ2NWNQqT5\n"
+            "ZNZ0aQ/+NmTZ4Zbp+0fZLqlEuOD5cWrb3Kf0mh8s6P3T8gB0N2A=\n"
+            "=abcd\n"
+            "-----END PGP SIGNATURE-----\n")
+    assert app.parse_checksum_text(text, 'Fedora-Workstation-41-1.4-x86_64-CHECKSUM') == {
+        'Fedora-Workstation-Live-41-1.4.x86_64.iso': {'sha256': SHA256_B}}
+
+
+@pytest.mark.parametrize('iso_name, resolver, url', [
+    ('ubuntu-24.04.1-desktop-amd64.iso', 'ubuntu',
+     'https://releases.ubuntu.com/24.04/SHA256SUMS'),
+    ('ubuntu-22.04.5-live-server-amd64.iso', 'ubuntu',
+     'https://releases.ubuntu.com/22.04/SHA256SUMS'),
+    ('ubuntu-24.04-preinstalled-server-arm64+raspi.img.xz', 'ubuntu-raspi',
+     'https://cdimage.ubuntu.com/releases/24.04/release/SHA256SUMS'),
+    ('debian-12.7.0-amd64-netinst.iso', 'debian',
+     'https://cdimage.debian.org/debian-cd/12.7.0/amd64/iso-cd/SHA256SUMS'),
+    ('debian-12.7.0-arm64-DVD-1.iso', 'debian',
+     'https://cdimage.debian.org/debian-cd/12.7.0/arm64/iso-cd/SHA256SUMS'),
+    ('debian-live-12.7.0-amd64-gnome.iso', 'debian-live',
+     'https://cdimage.debian.org/debian-cd/12.7.0-live/amd64/iso-hybrid/SHA256SUMS'),
+    ('Fedora-Workstation-Live-x86_64-40-1.14.iso', 'fedora',
+     'https://download.fedoraproject.org/pub/fedora/linux/releases/40/Workstation/x86_64/iso/'
+     'Fedora-Workstation-40-1.14-x86_64-CHECKSUM'),
+    ('Fedora-Workstation-Live-41-1.4.x86_64.iso', 'fedora',
+     'https://download.fedoraproject.org/pub/fedora/linux/releases/41/Workstation/x86_64/iso/'
+     'Fedora-Workstation-41-1.4-x86_64-CHECKSUM'),
+    ('Fedora-Server-dvd-x86_64-40-1.14.iso', 'fedora',
+     'https://download.fedoraproject.org/pub/fedora/linux/releases/40/Server/x86_64/iso/'
+     'Fedora-Server-40-1.14-x86_64-CHECKSUM'),
+    ('2024-07-04-raspios-bookworm-arm64-lite.img.xz', 'raspios',
+     'https://downloads.raspberrypi.com/raspios_lite_arm64/images/raspios_lite_arm64-2024-07-04/'
+     '2024-07-04-raspios-bookworm-arm64-lite.img.xz.sha256'),
+    ('2024-07-04-raspios-bookworm-armhf-full.img.xz', 'raspios',
+     'https://downloads.raspberrypi.com/raspios_full_armhf/images/raspios_full_armhf-2024-07-04/'
+     '2024-07-04-raspios-bookworm-armhf-full.img.xz.sha256'),
+    ('2024-07-04-raspios-bookworm-arm64.img.xz', 'raspios',
+     'https://downloads.raspberrypi.com/raspios_arm64/images/raspios_arm64-2024-07-04/'
+     '2024-07-04-raspios-bookworm-arm64.img.xz.sha256'),
+])
+def test_resolver_urls(iso_name, resolver, url):
+    name, urls = app.match_checksum_resolver(iso_name)
+    assert name == resolver
+    assert urls[0] == url
+
+
+def test_ubuntu_falls_back_to_old_releases():
+    assert app.match_checksum_resolver('ubuntu-23.04-desktop-amd64.iso')[1] == [
+        'https://releases.ubuntu.com/23.04/SHA256SUMS',
+        'https://old-releases.ubuntu.com/releases/23.04/SHA256SUMS']
+
+
+def test_windows_is_recognised_without_urls():
+    assert app.match_checksum_resolver('Win11_24H2_English_x64.iso') == ('windows', [])
+    assert app.match_checksum_resolver('Win10_22H2_EnglishInternational_x64v1.iso') == ('windows', [])
+
+
+def test_unknown_image_has_no_resolver():
+    assert app.match_checksum_resolver('archlinux-2024.10.01-x86_64.iso') == (None, [])
+
+
+def test_mirror_replaces_the_base_url():
+    assert app.match_checksum_resolver('debian-12.7.0-amd64-netinst.iso', {'debian': 'http://mirror.local'})[1][0] == \
+        'http://mirror.local/debian-cd/12.7.0/amd64/iso-cd/SHA256SUMS'
+
+
+def test_fetch_published_digests_from_a_mirror(tmp_path):
+    release = tmp_path / 'www' / 'debian-cd' / '12.7.0' / 'amd64' / 'iso-cd'
+    release.mkdir(parents=True)
+    (release / 'SHA256SUMS').write_text(f"{SHA256_A}  debian-12.7.0-amd64-netinst.iso\n"
+                                        f"{SHA256_B}  debian-12.7.0-amd64-DVD-1.iso\n")
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=str(tmp_path / 'www'))
+    handler.log_message = lambda *args: None
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        catalog = app.ChecksumCatalog(str(tmp_path / 'catalog.json'))
+        catalog.set_mirror('debian', f"http://127.0.0.1:{server.server_port}")
+        logged = []
+        digests = app.fetch_published_digests('debian-12.7.0-amd64-netinst.iso', logged.append, catalog)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert digests == {'sha256': SHA256_A}
+    # the rest of the release now verifies from the catalog, offline
+    assert catalog.lookup('debian-12.7.0-amd64-DVD-1.iso')[0] == {'sha256': SHA256_B}
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('SHA256SUMS', True),
+    ('SHA512SUMS', True),
+    ('md5sum.txt', True),
+    ('debian-12.7.0-amd64-netinst.iso.sha256', True),
+    ('Fedora-Workstation-41-1.4-x86_64-CHECKSUM', True),
+    ('checksum_catalog.json', False),
+    ('online_checksums.json', False),
+    ('SHA256SUMS.tmp', False),
+    ('debian-12.7.0-amd64-netinst.iso', False),
+])
+def test_is_checksum_file(name, expected):
+    assert app.is_checksum_file(name) is expected
@@ -0,0 +1,111 @@
+"""Fan-out writes: the shared ring's lag accounting and detaching, and whole fan-out writes
+to regular files, with one of them slowed down."""
+import gzip
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+
+import format_usb_gui as app
+
+CHUNK = 256 * 1024
+
+
+def test_ring_bounds_how_far_a_writer_lags():
+    ring = app.FanoutRing(2, 16, ['a', 'b'], lag_timeout=60)
+    for seq in range(2):
+        assert ring.wait_for_slot(seq) == []
+        ring.slot_view(seq)[:3] = b'abc'
+        ring.publish(seq, 3)
+    assert bytes(ring.get('a', 0)) == b'abc'
+    filled = threading.Event()
+
+    def reader():
+        ring.wait_for_slot(2)  # slot 0 is still held by both writers
+        filled.set()
+    threading.Thread(target=reader, daemon=True).start()
+    assert ring.release('a', 0)
+    assert not filled.wait(0.2)
+    assert ring.release('b', 0)
+    assert filled.wait(2)
+
+
+def test_ring_detaches_a_writer_that_holds_the_others_back():
+    ring = app.FanoutRing(2, 16, ['fast', 'slow'], lag_timeout=0.3)
+    for seq in range(2):
+        ring.wait_for_slot(seq)
+        ring.publish(seq, 16)
+    for seq in range(2):
+        ring.get('fast', seq)
+        ring.release('fast', seq)
+    assert ring.wait_for_slot(2) == ['slow']
+    assert ring.get('slow', 0) is app.FanoutRing.DETACHED
+    assert not ring.release('slow', 0)
+
+
+def test_ring_never_detaches_when_every_writer_is_behind():
+    ring = app.FanoutRing(1, 16, ['a', 'b'], lag_timeout=0.2)
+    ring.wait_for_slot(0)
+    ring.publish(0, 16)
+    timer = threading.Timer(0.8, lambda: [ring.release(t, 0) for t in ('a', 'b')])
+    timer.start()
+    assert ring.wait_for_slot(1) == []
+    timer.join()
+
+
+def test_ring_end_of_image():
+    ring = app.FanoutRing(2, 16, ['a'])
+    ring.finish()
+    assert ring.get('a', 0) is None
+
+
+@pytest.fixture
+def slow_target(monkeypatch):
+    """Make pwrite_all slow for file descriptors opened on paths ending in 'slow'."""
+    pwrite_all = app.pwrite_all
+
+    def pwrite(fd, view, offset):
+        if os.readlink(f"/proc/self/fd/{fd}").endswith('slow'):
+            time.sleep(0.04)
+        return pwrite_all(fd, view, offset)
+    monkeypatch.setattr(app, 'pwrite_all', pwrite)
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_fanout_detaches_a_slow_target(tmp_path, log, slow_target, compress):
+    data = os.urandom(CHUNK * 16 + 123)
+    image = tmp_path / ('image.img.gz' if compress else 'image.img')
+    image.write_bytes(gzip.compress(data, compresslevel=1) if compress else data)
+    targets = [tmp_path / name for name in ('fast1', 'fast2', 'slow')]
+    for target in targets:
+        target.write_bytes(b'')
+    finished = {}
+    h = hashlib.sha256()
+
+    def progress(devpath, pct):
+        if pct == 100:
+            finished.setdefault(devpath, time.monotonic())
+    results = app.write_image_fanout(str(image), [str(t) for t in targets], log, progress_cb=progress,
+                                     chunk_size=CHUNK, ring_slots=4, lag_timeout=0.1, source_hash=h)
+    assert results == {str(t): True for t in targets}
+    assert all(t.read_bytes() == data for t in targets)
+    assert h.hexdigest() == hashlib.sha256(image.read_bytes()).hexdigest()
+    assert f"{tmp_path / 'slow'} fell 4 chunks behind" in str(log)
+    if compress:
+        assert "decompressing the .gz image again" in str(log)
+    # the fast targets were not held back to the slow one's pace
+    assert max(finished[str(tmp_path / n)] for n in ('fast1', 'fast2')) < finished[str(tmp_path / 'slow')]
+
+
+def test_fanout_reports_a_failing_target_and_finishes_the_others(tmp_path, log):
+    data = os.urandom(CHUNK * 5)
+    image = tmp_path / 'image.img'
+    image.write_bytes(data)
+    good = tmp_path / 'good'
+    good.write_bytes(b'')
+    missing = tmp_path / 'no-such-dir' / 'device'
+    results = app.write_image_fanout(str(image), [str(good), str(missing)], log, chunk_size=CHUNK, ring_slots=2)
+    assert results == {str(good): True, str(missing): False}
+    assert good.read_bytes() == data
@@ -0,0 +1,164 @@
+"""The native writer, its resume journal, differential writes and chunk manifests, run
+against regular files standing in for the device."""
+import gzip
+import os
+
+import pytest
+
+import format_usb_gui as app
+
+CHUNK = 256 * 1024
+
+
+@pytest.fixture
+def image(tmp_path):
+    data = os.urandom(CHUNK * 6 + 1000)  # a short last chunk
+    path = tmp_path / 'image.img'
+    path.write_bytes(data)
+    return path, data
+
+
+@pytest.fixture
+def device(tmp_path):
+    path = tmp_path / 'device'
+    path.write_bytes(b'')
+    return path
+
+
+def chunk_digests(data):
+    return [app.chunk_digest(data[i:i + CHUNK]) for i in range(0, len(data), CHUNK)]
+
+
+def test_plain_write(image, device, log):
+    path, data = image
+    written = app.write_image_native(str(path), str(device), log, chunk_size=CHUNK)
+    assert written == len(data)
+    assert device.read_bytes() == data
+
+
+@pytest.mark.parametrize('queue_depth', [1, 3])
+def test_write_records_chunk_digests_and_verifies(image, device, log, queue_depth):
+    path, data = image
+    digests = []
+    assert app.write_image_native(str(path), str(device), log, chunk_size=CHUNK, queue_depth=queue_depth,
+                                  chunk_digests=digests) == len(data)
+    assert digests == chunk_digests(data)
+    assert app.verify_device(str(device), digests, CHUNK, len(data), log)
+    with open(device, 'r+b') as fh:
+        fh.seek(CHUNK * 4 + 17)
+        fh.write(b'\0')
+    assert not app.verify_device(str(device), digests, CHUNK, len(data), log)
+    assert f"first differing chunk starts at byte offset {CHUNK * 4}" in str(log)
+
+
+def test_compressed_image_with_source_hash(tmp_path, image, device, log):
+    path, data = image
+    gz = tmp_path / 'image.img.gz'
+    gz.write_bytes(gzip.compress(data, compresslevel=1))
+    h = app.hashlib.sha256()
+    assert app.write_image_native(str(gz), str(device), log, chunk_size=CHUNK, source_hash=h) == len(data)
+    assert device.read_bytes() == data
+    assert h.hexdigest() == app.hashlib.sha256(gz.read_bytes()).hexdigest()
+
+
+def test_journal_resumes_after_the_part_that_checks_out(image, device, log):
+    path, data = image
+    digests = chunk_digests(data)
+    # an earlier write got four chunks onto the device before it was interrupted
+    device.write_bytes(data[:CHUNK * 4])
+    journal = app.WriteJournal('SERIAL1', 'image-id', CHUNK)
+    journal.record(digests[:4])
+    assert app.WriteJournal.stored_chunk_size('SERIAL1', 'image-id') == CHUNK
+    assert app.write_image_native(str(path), str(device), log, chunk_size=CHUNK, journal=journal) == len(data)
+    assert f"Resuming at byte offset {CHUNK * 4}" in str(log)
+    assert device.read_bytes() == data
+    assert journal.load() == []  # a finished write leaves nothing to resume
+
+
+def test_journal_resume_stops_at_a_chunk_changed_since(image, device, log):
+    path, data = image
+    damaged = bytearray(data[:CHUNK * 4])
+    damaged[CHUNK * 2 + 5] ^= 0xff
+    device.write_bytes(bytes(damaged))
+    journal = app.WriteJournal('SERIAL1', 'image-id', CHUNK)
+    journal.record(chunk_digests(data)[:4])
+    assert app.write_image_native(str(path), str(device), log, chunk_size=CHUNK, journal=journal) == len(data)
+    assert f"Resuming at byte offset {CHUNK * 2}" in str(log)
+    assert device.read_bytes() == data
+
+
+def test_journal_of_another_chunk_size_is_ignored():
+    app.WriteJournal('SERIAL1', 'image-id', CHUNK).record(['00'] * 3)
+    assert app.WriteJournal('SERIAL1', 'image-id', CHUNK * 2).load() == []
+    assert app.WriteJournal('SERIAL2', 'image-id', CHUNK).load() == []
+
+
+def test_manifest_journal_resumes_without_a_serial(image, device, log):
+    path, data = image
+    device.write_bytes(data[:CHUNK * 3])
+    journal = app.ManifestJournal(chunk_digests(data))
+    assert app.write_image_native(str(path), str(device), log, chunk_size=CHUNK, journal=journal) == len(data)
+    assert f"Resuming at byte offset {CHUNK * 3}" in str(log)
+    assert device.read_bytes() == data
+
+
+def changed_device(data, device, chunks):
+    stale = bytearray(data)
+    for index in chunks:
+        stale[index * CHUNK] ^= 0xff
+    device.write_bytes(bytes(stale))
+
+
+@pytest.mark.parametrize('queue_depth', [1, 3])
+def test_differential_write_reads_the_device(image, device, log, queue_depth):
+    path, data = image
+    changed_device(data, device, [1, 6])
+    assert app.write_image_native(str(path), str(device), log, chunk_size=CHUNK, diff=True,
+                                  queue_depth=queue_depth) == len(data)
+    assert device.read_bytes() == data
+    assert f"Differential write: {CHUNK + 1000} of {len(data)} bytes differed" in str(log)
+
+
+@pytest.mark.parametrize('queue_depth', [1, 3])
+def test_differential_write_against_the_manifest(image, device, log, queue_depth):
+    path, data = image
+    changed_device(data, device, [0, 4])
+    manifest, total = app.build_chunk_manifest(str(path), CHUNK, log)
+    assert (manifest, total) == (chunk_digests(data), len(data))
+    assert app.write_image_native(str(path), str(device), log, chunk_size=CHUNK, diff=True,
+                                  queue_depth=queue_depth, diff_manifest=manifest) == len(data)
+    assert device.read_bytes() == data
+    assert f"Differential write: {2 * CHUNK} of {len(data)} bytes differed" in str(log)
+
+
+def test_differential_write_to_a_shorter_device_file(image, device, log):
+    path, data = image
+    device.write_bytes(data[:CHUNK * 2])
+    assert app.write_image_native(str(path), str(device), log, chunk_size=CHUNK, diff=True) == len(data)
+    assert device.read_bytes() == data
+
+
+def test_chunk_manifest_sidecar_and_cache(image, log):
+    path, data = image
+    manifest, total = app.build_chunk_manifest(str(path), CHUNK, log, workers=3)
+    assert manifest == chunk_digests(data)
+    assert os.path.isfile(app.chunk_manifest_path(str(path)))
+    assert app.load_chunk_manifest(str(path), CHUNK) == (manifest, total)
+    assert app.load_chunk_manifest(str(path), CHUNK * 2) == (None, 0)
+
+
+def test_chunk_manifest_is_dropped_when_the_image_changes_in_place(image, log):
+    path, data = image
+    app.build_chunk_manifest(str(path), CHUNK, log)
+    st = os.stat(path)
+    with open(path, 'r+b') as fh:
+        fh.write(b'changed')
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))  # same size and mtime: only ctime tells
+    assert app.load_chunk_manifest(str(path), CHUNK) == (None, 0)
+
+
+def test_compressed_chunk_manifest(tmp_path, image, log):
+    path, data = image
+    gz = tmp_path / 'image.img.gz'
+    gz.write_bytes(gzip.compress(data, compresslevel=1))
+    assert app.build_chunk_manifest(str(gz), CHUNK, log, workers=2) == (chunk_digests(data), len(data))